@@ -14,7 +14,7 @@ import gzip
 import anyio
 import base64
 from dotenv import load_dotenv
-from nintendo.nex import backend, ranking, settings
+from nintendo.nex import backend, ranking, settings, common
 from anynet import http
 
 load_dotenv()
@@ -120,6 +120,13 @@ async def scrape():
 		leaderboard = []
 		seen_rankings = []
 
+		window_offset = 0
+		shift_window = True
+		unshifted_index = None
+		requests = 0
+		received = 0
+		duplicates = 0
+
 		while remaining > 0:
 			print("Category {0} on offset {1}. {2}/{3} remaining".format(category, offset, remaining, total))
 
@@ -134,11 +141,55 @@ async def scrape():
 			order_param = ranking.RankingOrderParam()
 			unique_id = 0
 
-			order_param.offset = 0
+			order_param.offset = window_offset
 			order_param.count = 0xFF # * Max we can do in one go
 
-			result = await ranking_client.get_ranking(mode, category, order_param, unique_id, principal_id)
+			try:
+				result = await ranking_client.get_ranking(mode, category, order_param, unique_id, principal_id)
+			except common.RMCError as e:
+				if window_offset == 0:
+					raise
+
+				# * Shifted past the end of the leaderboard
+				print("Category {0}: shifted window failed ({1}), no longer shifting".format(category, e))
+				window_offset = 0
+				shift_window = False
+				continue
+
 			rankings = result.data
+			requests += 1
+			received += len(rankings)
+
+			'''
+			The window is centred on the entry we pretend to be, so
+			about half of every response was already seen. Shift the
+			next window by where that entry landed so it becomes the
+			first one returned. If a shifted window no longer contains
+			it, entries may have been skipped, so ask again unshifted
+			and stop shifting for this category
+			'''
+			seed_index = None
+			for i, entry in enumerate(rankings):
+				if entry.pid == principal_id:
+					seed_index = i
+					break
+
+			if window_offset != 0 and seed_index is None:
+				print("Category {0}: shifted window lost PID {1}, asking again unshifted and no longer shifting".format(category, principal_id))
+				duplicates += len(rankings)
+				window_offset = 0
+				shift_window = False
+				continue
+
+			if shift_window and seed_index is not None:
+				if window_offset == 0:
+					unshifted_index = seed_index
+				elif seed_index == unshifted_index:
+					# * Server ignores the offset in this mode
+					print("Category {0}: server ignores the window offset, no longer shifting".format(category))
+					shift_window = False
+
+				window_offset = window_offset + seed_index if shift_window else 0
 
 			for entry in rankings:
 				ranking_entry = {
@@ -155,6 +206,7 @@ async def scrape():
 
 				if ranking_entry in seen_rankings:
 					# * Ignore duplicates
+					duplicates += 1
 					continue
 
 				leaderboard.append(ranking_entry)
@@ -163,6 +215,8 @@ async def scrape():
 				remaining -= 1
 				seen_rankings.append(ranking_entry)
 
+		print("{0} requests, {1}/{2} entries were duplicates, window offset {3}".format(requests, duplicates, received, window_offset))
+
 		print("Writing ./data/{0}/rankings.json.gz".format(category))
 		leaderboard_data = json.dumps(leaderboard)
 		os.makedirs("./data/{0}".format(category), exist_ok=True)
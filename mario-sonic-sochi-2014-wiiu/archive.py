@@ -8,7 +8,7 @@ Use at your own risk, we are not resposible for any bans
 Requires Python 3 and https://github.com/Kinnay/NintendoClients
 '''
 
-from nintendo.nex import backend, ranking, datastore, settings
+from nintendo.nex import backend, ranking, datastore, settings, common
 from nintendo import nnas
 from anynet import http
 import anyio
@@ -233,6 +233,13 @@ async def scrape():
 		leaderboard = []
 		seen_rankings = []
 
+		window_offset = 0
+		shift_window = True
+		unshifted_index = None
+		requests = 0
+		received = 0
+		duplicates = 0
+
 		principal_id = result.data[0].pid
 
 		while remaining > 0:
@@ -249,11 +256,55 @@ async def scrape():
 			order_param = ranking.RankingOrderParam()
 			unique_id = 0
 
-			order_param.offset = 0
+			order_param.offset = window_offset
 			order_param.count = 0xFF # Max we can do in one go
 
-			result = await ranking_client.get_ranking(mode, category, order_param, unique_id, principal_id)
+			try:
+				result = await ranking_client.get_ranking(mode, category, order_param, unique_id, principal_id)
+			except common.RMCError as e:
+				if window_offset == 0:
+					raise
+
+				# * Shifted past the end of the leaderboard
+				print("Category {0}: shifted window failed ({1}), no longer shifting".format(category, e))
+				window_offset = 0
+				shift_window = False
+				continue
+
 			rankings = result.data
+			requests += 1
+			received += len(rankings)
+
+			'''
+			The window is centred on the entry we pretend to be, so
+			about half of every response was already seen. Shift the
+			next window by where that entry landed so it becomes the
+			first one returned. If a shifted window no longer contains
+			it, entries may have been skipped, so ask again unshifted
+			and stop shifting for this category
+			'''
+			seed_index = None
+			for i, user in enumerate(rankings):
+				if user.pid == principal_id:
+					seed_index = i
+					break
+
+			if window_offset != 0 and seed_index is None:
+				print("Category {0}: shifted window lost PID {1}, asking again unshifted and no longer shifting".format(category, principal_id))
+				duplicates += len(rankings)
+				window_offset = 0
+				shift_window = False
+				continue
+
+			if shift_window and seed_index is not None:
+				if window_offset == 0:
+					unshifted_index = seed_index
+				elif seed_index == unshifted_index:
+					# * Server ignores the offset in this mode
+					print("Category {0}: server ignores the window offset, no longer shifting".format(category))
+					shift_window = False
+
+				window_offset = window_offset + seed_index if shift_window else 0
 
 			for user in rankings:
 				ranking_entry = {
@@ -269,6 +320,7 @@ async def scrape():
 
 				if ranking_entry in seen_rankings:
 					# * Ignore duplicates
+					duplicates += 1
 					continue
 
 				[completed_country, completed_character] = user.groups
@@ -353,6 +405,8 @@ async def scrape():
 				remaining -= 1
 				seen_rankings.append(ranking_entry)
 
+		print("{0} requests, {1}/{2} entries were duplicates, window offset {3}".format(requests, duplicates, received, window_offset))
+
 		print("Writing ./data/rankings/{0}.json.gz".format(category))
 		leaderboard_data = json.dumps(leaderboard)
 		await write_to_file("./data/rankings/{0}.json.gz".format(category), leaderboard_data.encode("utf-8"))
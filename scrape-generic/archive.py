@@ -10,8 +10,10 @@ from nintendo.nex import (
     settings,
     prudp,
     authentication,
+    secure,
     rmc,
     common,
+    streams,
 )
 from nintendo.nex.common import RMCError
 from nintendo import nnas, nasc
@@ -23,7 +25,7 @@ import struct
 import threading
 import time
 import sqlite3
-from multiprocessing import Process, Lock, Queue, Array, Value
+from multiprocessing import Process, Queue, Array
 import multiprocessing
 import json
 import queue
@@ -31,6 +33,11 @@ import traceback
 import asyncio
 import gzip
 import httpx
+import urllib.parse
+import calendar
+import random
+import contextvars
+import http.server
 
 import logging
 
@@ -62,125 +69,1436 @@ LANGUAGE_3DS = int(os.getenv("3DS_LANG"))
 ORDINAL_RANKING = 1  # 1234 rather than 1224
 
 RANKING_DB = "3ds_ranking_first_batch.db"
-RANKING_LOG = "3ds_ranking_first_batch_log.txt"
+RANKING_LOG = "3ds_ranking_first_batch_log.ndjson"
+
+# Backoff between reconnect attempts, in seconds
+RMC_RETRY_BASE_DELAY = 0.5
+RMC_RETRY_MAX_DELAY = 60
+RMC_MAX_ATTEMPTS = 20
+# Consecutive connection failures before every caller stops hitting a host
+CIRCUIT_BREAKER_THRESHOLD = 5
+CIRCUIT_BREAKER_COOLDOWN = 30
+CIRCUIT_BREAKER_MAX_COOLDOWN = 600
+
+# "default" keeps WAL with synchronous=NORMAL, "bulk" turns off fsync and only
+# builds the ranking indexes once every game has been scraped
+INGEST_PROFILE = os.getenv("INGEST_PROFILE", "default")
+DEFER_RANKING_INDEXES = INGEST_PROFILE == "bulk"
+SQLITE_PAGE_SIZE = 16384
+SQLITE_CACHE_SIZE_KIB = 256 * 1024
+SQLITE_MMAP_SIZE = 1024 * 1024 * 1024
+
+# Layout of ranking and ranking_group in new databases. "compact" keeps them in
+# ranking_compact behind views, existing databases keep whatever they already
+# use until they are converted with migrate_compact
+RANKING_SCHEMA = os.getenv("RANKING_SCHEMA", "legacy")
+
+# The compact schema stores common_data once per hash, legacy databases keep
+# it inline so ranking.data stays readable as is.
+# common_data shorter than this stays inline, it would not be smaller as a hash.
+# Hashes this process has already sent to the writer are remembered until there
+# are RANKING_COMMON_DATA_CACHE of them
+RANKING_COMMON_DATA_MIN_SIZE = 32
+RANKING_COMMON_DATA_CACHE = 1000000
+ranking_common_data_written = set()
+
+# Offset pages requested at once per category, and the most RMC calls allowed
+# in flight to a single host across every task in the process
+RANKING_PIPELINE_DEPTH = 8
+HOST_MAX_IN_FLIGHT = int(os.getenv("HOST_MAX_IN_FLIGHT", "64"))
+
+# Number of ranking categories scraped at once per game
+RANKING_CATEGORY_CONCURRENCY = int(os.getenv("RANKING_CATEGORY_CONCURRENCY", "32"))
+
+# Around self cursors walking one category at once, each given at least
+# RANKING_CURSOR_MIN_SPAN ranks
+RANKING_CURSORS = int(os.getenv("RANKING_CURSORS", "4"))
+RANKING_CURSOR_MIN_SPAN = 50000
+
+# Categories below RANKING_CATEGORY_PROBE_END are probed once per game, at most
+# RANKING_CATEGORY_PROBE_CONCURRENCY at once. Others have to be imported
+RANKING_CATEGORY_PROBE_END = 1000
+RANKING_CATEGORY_PROBE_CONCURRENCY = 64
+RANKING_CATEGORIES_FILE = os.getenv(
+    "RANKING_CATEGORIES_FILE", "ranking_categories.json"
+)
+
+# Set to refresh categories archived before by checking the entry at every
+# RANKING_DELTA_REGION-th rank and only walking again the regions that moved
+RANKING_DELTA_SYNC = os.getenv("RANKING_DELTA_SYNC") == "1"
+RANKING_DELTA_REGION = int(os.getenv("RANKING_DELTA_REGION", "2550"))
+
+# Set to download the DataStore object behind every ranking param while the
+# rankings are scraped, RANKING_PARAM_CONCURRENCY downloads at once per game
+RANKING_PARAM_DOWNLOAD = os.getenv("RANKING_PARAM_DOWNLOAD") == "1"
+RANKING_PARAM_CONCURRENCY = int(os.getenv("RANKING_PARAM_CONCURRENCY", "16"))
+RANKING_PARAM_QUEUE_SIZE = 100000
+RANKING_PARAM_MISSING_BATCH = 10000
+
+# Set to sweep the whole 32 bit category space of every game before scraping.
+# Requests go over RANKING_CATEGORY_SWEEP_SESSIONS connections with
+# RANKING_CATEGORY_SWEEP_WINDOW in flight on each, still capped by
+# HOST_MAX_IN_FLIGHT, and progress is checkpointed every chunk
+RANKING_CATEGORY_SWEEP = os.getenv("RANKING_CATEGORY_SWEEP") == "1"
+RANKING_CATEGORY_SWEEP_SESSIONS = int(os.getenv("RANKING_CATEGORY_SWEEP_SESSIONS", "4"))
+RANKING_CATEGORY_SWEEP_WINDOW = int(os.getenv("RANKING_CATEGORY_SWEEP_WINDOW", "16"))
+RANKING_CATEGORY_SWEEP_CHUNK = 65536
+RANKING_CATEGORY_SWEEP_REPORT_SECONDS = 60
 
 if "datastore" in sys.argv[1]:
     DATASTORE_DB = "%s.db" % sys.argv[2]
-    DATASTORE_LOG = "%s_log.txt" % sys.argv[2]
+    DATASTORE_LOG = "%s_log.ndjson" % sys.argv[2]
+
+
+# Pooled sessions unused for NEX_SESSION_IDLE_TIMEOUT seconds are closed, and
+# once more than NEX_SESSION_POOL_MAX are open the least recently used idle ones
+# are closed before connecting again. Sessions in use are never closed
+NEX_SESSION_IDLE_TIMEOUT = int(os.getenv("NEX_SESSION_IDLE_TIMEOUT", "120"))
+NEX_SESSION_POOL_MAX = int(os.getenv("NEX_SESSION_POOL_MAX", "64"))
+NEX_SESSION_POOL = None
+
+
+class NEXSession:
+    def __init__(self, key):
+        self.key = key
+        self.client = None
+        self.dead = False
+        self.close_event = anyio.Event()
+        self.users = 0
+        self.last_used = time.monotonic()
+
+    def is_alive(self):
+        # The RMC client is marked closed as soon as PRUDP reports the connection is gone
+        return not self.dead and self.client is not None and not self.client.closed
+
+
+# Keeps logged in secure server connections alive across RMC calls, keyed by
+# (host, port, pid, access key, nex version, auth info, slot). Every session
+# lives in its own task so it can be torn down independently of whichever task
+# used it last.
+# Callers wanting several connections to the same server use different slots,
+# and hand the session back with release once done with it
+class NEXSessionPool:
+    def __init__(self):
+        self.sessions = {}
+        self.locks = {}
+        self.group = None
+        self.previous_pool = None
+
+    async def __aenter__(self):
+        global NEX_SESSION_POOL
+        self.group = anyio.create_task_group()
+        await self.group.__aenter__()
+        self.previous_pool = NEX_SESSION_POOL
+        NEX_SESSION_POOL = self
+        return self
+
+    async def __aexit__(self, typ, val, tb):
+        global NEX_SESSION_POOL
+        NEX_SESSION_POOL = self.previous_pool
+        for session in self.sessions.values():
+            session.close_event.set()
+        self.sessions = {}
+        return await self.group.__aexit__(typ, val, tb)
+
+    async def keep_session(
+        self,
+        session,
+        s,
+        host,
+        port,
+        pid,
+        password,
+        auth_info,
+        task_status=anyio.TASK_STATUS_IGNORED,
+    ):
+        started = False
+        try:
+            async with backend.connect(s, host, port) as be:
+                async with be.login(pid, password, auth_info) as client:
+                    session.client = client
+                    started = True
+                    task_status.started(session)
+                    await session.close_event.wait()
+        except Exception as e:
+            # Errors before login are reported to whoever asked for the session
+            if not started:
+                raise
+            print('"NEX session closed" encountered: ', e)
+        finally:
+            session.dead = True
+
+    async def get(self, s, host, port, pid, password, auth_info=None, slot=0):
+        key = (
+            host,
+            port,
+            str(pid),
+            s["prudp.access_key"],
+            s["nex.version"],
+            auth_info,
+            slot,
+        )
+        if key not in self.locks:
+            self.locks[key] = anyio.Lock()
+
+        async with self.locks[key]:
+            session = self.sessions.get(key)
+            if session is None or not session.is_alive():
+                if session is not None:
+                    self.discard(session)
+                self.evict()
+
+                session = await self.group.start(
+                    self.keep_session,
+                    NEXSession(key),
+                    s,
+                    host,
+                    port,
+                    pid,
+                    password,
+                    auth_info,
+                )
+                self.sessions[key] = session
+
+            session.users += 1
+            return session
+
+    def release(self, session):
+        session.users -= 1
+        session.last_used = time.monotonic()
+
+    def discard(self, session):
+        session.dead = True
+        session.close_event.set()
+        if self.sessions.get(session.key) is session:
+            del self.sessions[session.key]
+
+    def evict(self):
+        now = time.monotonic()
+        idle = sorted(
+            (session for session in self.sessions.values() if session.users == 0),
+            key=lambda session: session.last_used,
+        )
+        num_over = len(self.sessions) + 1 - NEX_SESSION_POOL_MAX
+        for session in idle:
+            if num_over <= 0 and now - session.last_used < NEX_SESSION_IDLE_TIMEOUT:
+                break
+            self.discard(session)
+            num_over -= 1
+            METRICS.inc("nex_sessions_evicted_total")
+
+
+# Object downloads go through one keep-alive client per process instead of a
+# new connection (DNS, TCP, TLS) per object. HTTP2 needs the h2 package
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", str(60 * 10)))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "64"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "32"))
+HTTP_MAX_PER_HOST = int(os.getenv("HTTP_MAX_PER_HOST", "16"))
+HTTP2 = os.getenv("HTTP2") == "1"
+HTTP_CLIENT_POOL = None
+
+
+class HTTPClientPool:
+    def __init__(self):
+        self.client = None
+        self.host_limiters = {}
+        self.previous_pool = None
+
+    async def __aenter__(self):
+        global HTTP_CLIENT_POOL
+        self.client = httpx.AsyncClient(
+            http2=HTTP2,
+            timeout=HTTP_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            ),
+        )
+        await self.client.__aenter__()
+        self.previous_pool = HTTP_CLIENT_POOL
+        HTTP_CLIENT_POOL = self
+        return self
 
+    async def __aexit__(self, typ, val, tb):
+        global HTTP_CLIENT_POOL
+        HTTP_CLIENT_POOL = self.previous_pool
+        return await self.client.__aexit__(typ, val, tb)
 
-async def retry_if_rmc_error(func, s, host, port, pid, password, auth_info=None):
-    try:
-        async with backend.connect(s, host, port) as be:
+    async def get(self, url, headers):
+        # httpx only limits connections overall, keep one host from taking them all
+        host = httpx.URL(url).host
+        if host not in self.host_limiters:
+            self.host_limiters[host] = anyio.CapacityLimiter(HTTP_MAX_PER_HOST)
+
+        async with self.host_limiters[host]:
+            return await self.client.get(url, headers=headers)
+
+
+async def run_with_session_pool(func):
+    async with NEXSessionPool(), HTTPClientPool():
+        return await func()
+
+
+# NNAS access tokens are refreshed this long before they expire. NEX and NASC
+# tokens are fetched again once TOKEN_MAX_AGE old, the refresher does it
+# TOKEN_REFRESH_MARGIN early so the scrape never waits on it
+TOKEN_MAX_AGE = int(os.getenv("TOKEN_MAX_AGE", "3600"))
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_REFRESH_INTERVAL = 60
+TOKEN_MANAGER = None
+
+
+def get_nnas_client(game=None):
+    nas = nnas.NNASClient()
+    nas.set_device(DEVICE_ID, SERIAL_NUMBER, SYSTEM_VERSION)
+    if game is not None:
+        nas.set_title(game["aid"], game["av"])
+    nas.set_locale(REGION_ID, COUNTRY_NAME, LANGUAGE)
+    return nas
+
+
+def get_nasc_client(game):
+    title_version = (
+        game["nex"][0][0] * 10000 + game["nex"][0][1] * 100 + game["nex"][0][2]
+    )
+
+    nas = nasc.NASCClient()
+    nas.set_title(game["aid"], title_version)
+    nas.set_device(SERIAL_NUMBER_3DS, MAC_ADDRESS_3DS, FCD_CERT_3DS, "")
+    nas.set_locale(REGION_3DS, LANGUAGE_3DS)
+    nas.set_user(USERNAME_3DS, USERNAME_HMAC_3DS)
+    return nas
+
+
+# Hands out NEX and NASC tokens for every game. One NNAS access token is shared
+# by all of them, tokens are cached and fetched at most once at a time, the
+# next game's token can be fetched while the current one is scraped, and a
+# background task refreshes everything before it gets old
+class TokenManager:
+    def __init__(self):
+        self.access_token = None
+        self.access_token_time = 0
+        self.access_token_lock = anyio.Lock()
+        # Key -> (token, time fetched, function fetching it again)
+        self.tokens = {}
+        self.pending = {}
+        self.auth_infos = {}
+        self.group = None
+        self.previous_manager = None
+
+    async def __aenter__(self):
+        global TOKEN_MANAGER
+        self.group = anyio.create_task_group()
+        await self.group.__aenter__()
+        self.group.start_soon(self.refresh)
+        self.previous_manager = TOKEN_MANAGER
+        TOKEN_MANAGER = self
+        return self
+
+    async def __aexit__(self, typ, val, tb):
+        global TOKEN_MANAGER
+        TOKEN_MANAGER = self.previous_manager
+        self.group.cancel_scope.cancel()
+        return await self.group.__aexit__(typ, val, tb)
+
+    async def get_access_token(self):
+        async with self.access_token_lock:
+            if (
+                self.access_token is None
+                or time.time()
+                >= self.access_token_time
+                + self.access_token.expires_in
+                - TOKEN_REFRESH_MARGIN
+            ):
+                self.access_token = await get_nnas_client().login(USERNAME, PASSWORD)
+                self.access_token_time = time.time()
+                METRICS.inc("token_fetches_total", kind="access")
+
+            return self.access_token.token
+
+    async def get(self, key, fetch):
+        while True:
+            if key in self.tokens and time.time() - self.tokens[key][1] < TOKEN_MAX_AGE:
+                return self.tokens[key][0]
+
+            if key in self.pending:
+                # Someone else is already fetching it
+                await self.pending[key].wait()
+                continue
+
+            self.pending[key] = anyio.Event()
             try:
-                async with be.login(pid, password, auth_info) as client:
-                    return await func(client)
-            except RuntimeError as e:
+                token = await fetch()
+                self.tokens[key] = (token, time.time(), fetch)
+                METRICS.inc("token_fetches_total", kind=key[0])
+                return token
+            finally:
+                self.pending.pop(key).set()
+
+    async def get_nex_token(self, game):
+        async def fetch():
+            access_token = await self.get_access_token()
+            return await get_nnas_client(game).get_nex_token(access_token, game["id"])
+
+        return await self.get(("nnas", game["aid"]), fetch)
+
+    def fetch_nasc_token(self, game):
+        async def fetch():
+            return await get_nasc_client(game).login(game["aid"] & 0xFFFFFFFF)
+
+        return fetch
+
+    async def get_nasc_token(self, game):
+        return await self.get(("nasc", game["aid"]), self.fetch_nasc_token(game))
+
+    # The same AuthenticationInfo is returned every time and the refresher
+    # updates its token, so pooled sessions reconnect with a current one
+    async def get_auth_info(self, game):
+        token = await self.get_nasc_token(game)
+
+        key = ("nasc", game["aid"])
+        if key not in self.auth_infos:
+            auth_info = authentication.AuthenticationInfo()
+            auth_info.token = token.token
+            auth_info.ngs_version = 2
+            self.auth_infos[key] = auth_info
+        return self.auth_infos[key]
+
+    # Worker processes are handed the NASC login of their game and keep it
+    # refreshed under their own manager with get_worker_auth_info
+    async def get_worker_auth(self, game):
+        await self.get_nasc_token(game)
+        token, fetched, _ = self.tokens[("nasc", game["aid"])]
+        return (game, token, fetched)
+
+    async def get_worker_auth_info(self, worker_auth):
+        game, token, fetched = worker_auth
+        key = ("nasc", game["aid"])
+        if key not in self.tokens:
+            self.tokens[key] = (token, fetched, self.fetch_nasc_token(game))
+        return await self.get_auth_info(game)
+
+    # Drops the tokens of every game but these, so the refresher only logs in
+    # again for the game being scraped and the one prefetched after it
+    def retain(self, games):
+        aids = set(game["aid"] for game in games)
+        for key in list(self.tokens):
+            if key[1] not in aids:
+                del self.tokens[key]
+                self.auth_infos.pop(key, None)
+
+    def prefetch_nex_token(self, game):
+        self.group.start_soon(self.prefetch, self.get_nex_token, game)
+
+    def prefetch_nasc_token(self, game):
+        self.group.start_soon(self.prefetch, self.get_nasc_token, game)
+
+    async def prefetch(self, get, game):
+        try:
+            await get(game)
+        except Exception as e:
+            # The game fetches it again itself when it gets there
+            print(
+                "Could not prefetch token for %s: %s"
+                % (game["name"].replace("\n", " "), e)
+            )
+
+    async def refresh(self):
+        while True:
+            await anyio.sleep(TOKEN_REFRESH_INTERVAL)
+
+            try:
+                if self.access_token is not None:
+                    await self.get_access_token()
+            except Exception as e:
+                print("Could not refresh access token: %s" % e)
+
+            for key, (_, fetched, fetch) in list(self.tokens.items()):
+                if time.time() - fetched < TOKEN_MAX_AGE - TOKEN_REFRESH_MARGIN:
+                    continue
+
+                try:
+                    token = await fetch()
+                except Exception as e:
+                    print("Could not refresh token %s: %s" % (key, e))
+                    continue
+
+                if key not in self.tokens:
+                    # Dropped while it was being fetched
+                    continue
+
+                self.tokens[key] = (token, time.time(), fetch)
+                METRICS.inc("token_refreshes_total", kind=key[0])
+                if key in self.auth_infos:
+                    self.auth_infos[key].token = token.token
+
+
+async def run_with_token_manager(func):
+    async with TokenManager():
+        return await func()
+
+
+RMC_STATS = {"retries": 0, "breaker_trips": 0}
+
+
+# Raised by retry_if_rmc_error once RMC_MAX_ATTEMPTS connection attempts have
+# failed. It is an RMCError so every caller already handling RMC failures
+# handles it too, callers taking an RMCError to mean "not supported" or "does
+# not exist" have to check for it first
+class RMCRetriesExhausted(RMCError):
+    def __init__(self, error):
+        super().__init__("RendezVous::ConnectionFailure")
+        self.error = error
+
+    def __str__(self):
+        return "Gave up after %d attempts: %s" % (RMC_MAX_ATTEMPTS, self.error)
+
+
+class CircuitBreaker:
+    def __init__(self, host):
+        self.host = host
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0
+
+    async def wait(self):
+        # Every task using this host sleeps until the breaker closes again
+        delay = self.open_until - time.monotonic()
+        if delay > 0:
+            await anyio.sleep(delay)
+
+    def record_success(self):
+        self.failures = 0
+        self.trips = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if (
+            self.failures >= CIRCUIT_BREAKER_THRESHOLD
+            and self.open_until <= time.monotonic()
+        ):
+            cooldown = min(
+                CIRCUIT_BREAKER_COOLDOWN * pow(2, self.trips),
+                CIRCUIT_BREAKER_MAX_COOLDOWN,
+            )
+            self.open_until = time.monotonic() + cooldown
+            self.failures = 0
+            self.trips += 1
+            RMC_STATS["breaker_trips"] += 1
+            print(
+                "Circuit breaker for %s tripped, pausing for %d seconds (%d retries, %d trips)"
+                % (
+                    self.host,
+                    cooldown,
+                    RMC_STATS["retries"],
+                    RMC_STATS["breaker_trips"],
+                )
+            )
+
+
+CIRCUIT_BREAKERS = {}
+HOST_LIMITERS = {}
+
+
+def get_circuit_breaker(host):
+    if host not in CIRCUIT_BREAKERS:
+        CIRCUIT_BREAKERS[host] = CircuitBreaker(host)
+    return CIRCUIT_BREAKERS[host]
+
+
+def get_host_limiter(host):
+    if host not in HOST_LIMITERS:
+        HOST_LIMITERS[host] = anyio.CapacityLimiter(HOST_MAX_IN_FLIGHT)
+    return HOST_LIMITERS[host]
+
+
+def rmc_retry_delay(attempt):
+    # Full jitter so reconnecting workers spread out instead of stampeding
+    return random.uniform(
+        0, min(RMC_RETRY_MAX_DELAY, RMC_RETRY_BASE_DELAY * pow(2, attempt))
+    )
+
+
+async def retry_if_rmc_error(
+    func, s, host, port, pid, password, auth_info=None, slot=0
+):
+    if NEX_SESSION_POOL is None:
+        # Not running under a pool, only keep the session for this call
+        async with NEXSessionPool():
+            return await retry_if_rmc_error(
+                func, s, host, port, pid, password, auth_info, slot
+            )
+
+    breaker = get_circuit_breaker(host)
+    attempt = 0
+    while True:
+        await breaker.wait()
+
+        session = None
+        try:
+            session = await NEX_SESSION_POOL.get(
+                s, host, port, pid, password, auth_info, slot
+            )
+            try:
+                async with get_host_limiter(host):
+                    result = await func(session.client)
+            finally:
+                NEX_SESSION_POOL.release(session)
+        except RuntimeError as e:
+            if session is None:
                 print('"PRUDP connection failed" encountered: ', e)
-                # Reattempt until success recursively
-                return await retry_if_rmc_error(func, s, host, port, pid, password)
-    except RuntimeError as e:
-        print('"RMC connection is closed" encountered: ', e)
-        # Reattempt until success recursively
-        return await retry_if_rmc_error(func, s, host, port, pid, password)
+            else:
+                print('"RMC connection is closed" encountered: ', e)
+                # Session is dead, drop it so the next attempt reconnects
+                NEX_SESSION_POOL.discard(session)
 
+            breaker.record_failure()
 
-# Category testing thread
-def range_test_category(
-    access_key,
-    nex_version,
+            attempt += 1
+            if attempt >= RMC_MAX_ATTEMPTS:
+                raise RMCRetriesExhausted(e) from e
+
+            RMC_STATS["retries"] += 1
+            await anyio.sleep(rmc_retry_delay(attempt))
+        else:
+            breaker.record_success()
+            return result
+
+
+async def run_category_scrape(
+    category,
+    log_queue,
+    write_queue,
+    s,
     host,
     port,
     pid,
     password,
-    start,
-    end,
-    found_queue,
-    num_tested_queue,
+    game,
+    pretty_game_id,
+    has_datastore,
+    i,
+    nex_wiiu_games,
+    auth_info=None,
+    param_downloader=None,
 ):
-    async def run():
-        s = settings.default()
-        s.configure(access_key, nex_version)
+    # Whatever the writer queue could not take yet is still handed over if
+    # the scrape fails
+    write_con = QueuedConnection(write_queue)
+    try:
+        await scrape_category(
+            category,
+            log_queue,
+            write_con,
+            s,
+            host,
+            port,
+            pid,
+            password,
+            game,
+            pretty_game_id,
+            has_datastore,
+            i,
+            nex_wiiu_games,
+            auth_info=auth_info,
+            param_downloader=param_downloader,
+        )
+    finally:
+        write_con.close()
 
-        try:
-            async with backend.connect(s, host, port) as be:
-                async with be.login(pid, password) as client:
-                    ranking_client = ranking.RankingClient(client)
-
-                    num_tested = 0
-                    for category in range(start, end):
-                        try:
-                            order_param = ranking.RankingOrderParam()
-                            order_param.offset = 0
-                            order_param.count = 1
-
-                            _ = await ranking_client.get_ranking(
-                                ranking.RankingMode.GLOBAL,  # Get the global leaderboard
-                                category,  # Category, this is 3-A (Magrove Cove)
-                                order_param,
-                                0,
-                                0,
-                            )
 
-                            # No exception, this is a valid category
-                            found_queue.put(category)
-                        except Exception:
-                            None
+async def scrape_category(
+    category,
+    log_queue,
+    write_con,
+    s,
+    host,
+    port,
+    pid,
+    password,
+    game,
+    pretty_game_id,
+    has_datastore,
+    i,
+    nex_wiiu_games,
+    auth_info=None,
+    param_downloader=None,
+):
+    # Read from worker threads, see fetch_in_thread
+    con = sqlite3.connect(RANKING_DB, timeout=3600, check_same_thread=False)
+    configure_sqlite(con)
+    log_file = QueuedLog(log_queue)
+    METRICS_GAME.set(pretty_game_id)
+    print("Starting category %d" % category)
+
+    last_rank_seen = 0
+    num_ranks_seen = 0
+    last_pid_seen = None
+    last_id_seen = None
+    rankings = None
+
+    # One request to get first PID and number of rankings, just in case offset based fails on first request
+    try:
 
-                        num_tested += 1
+        async def get_start_data(client):
+            ranking_client = ranking.RankingClient(client)
 
-                        if num_tested % 100 == 0:
-                            num_tested_queue.put(100)
-        except Exception as e:
-            print(e)
+            order_param = ranking.RankingOrderParam()
+            order_param.offset = 0
+            order_param.count = 1
 
-        found_queue.put(-1)
+            rankings = await ranking_client.get_ranking(
+                ranking.RankingMode.GLOBAL,  # Get the global leaderboard
+                category,
+                order_param,
+                0,
+                0,
+            )
 
-    anyio.run(run)
+            return (rankings, rankings.data[0].pid, rankings.data[0].unique_id)
 
+        rankings, last_pid_seen, last_id_seen = await retry_if_rmc_error(
+            get_start_data, s, host, port, str(pid), password, auth_info=auth_info
+        )
+    except Exception as e:
+        # Protocol is likely incorrect
+        print_and_log(
+            "Have %d and issue with %s at category %d: %s"
+            % (
+                num_ranks_seen,
+                game["name"].replace("\n", " "),
+                category,
+                "".join(traceback.TracebackException.from_exception(e).format()),
+            ),
+            log_file,
+        )
+        return
 
-def print_categories(num_processes, found_queue, num_tested_queue):
-    begin = time.perf_counter()
-    num_tested = 0
-    num_sentinels = 0
-    while True:
-        time.sleep(0.1)
+    # Checkpoints of every cursor, written together with the rows they cover
+    progress = await fetch_in_thread(
+        con,
+        "SELECT cursor_rank, last_rank, last_id, last_pid, stop_rank, count FROM ranking_progress WHERE game = ? AND category = ? ORDER BY cursor_rank",
+        (pretty_game_id, category),
+    )
+    progress = [
+        (cursor_rank, last_rank, int(last_id), int(last_pid), stop_rank, count)
+        for cursor_rank, last_rank, last_id, last_pid, stop_rank, count in progress
+    ]
+
+    if (
+        len(progress) == 0
+        and len(
+            await fetch_in_thread(
+                con,
+                "SELECT 1 FROM ranking WHERE game = ? AND category = ? LIMIT 1",
+                (pretty_game_id, category),
+            )
+        )
+        > 0
+    ):
+        # Archived before checkpoints existed, scan once and record one
+        count = (
+            await fetch_in_thread(
+                con,
+                "SELECT COUNT(*) FROM ranking WHERE game = ? AND category = ?",
+                (pretty_game_id, category),
+            )
+        )[0][0]
+        result = (
+            await fetch_in_thread(
+                con,
+                "SELECT rank, id, pid FROM ranking WHERE game = ? AND category = ? ORDER BY rank DESC LIMIT 1",
+                (pretty_game_id, category),
+            )
+        )[0]
+        progress = [(0, int(result[0]), int(result[1]), int(result[2]), None, count)]
+        save_ranking_progress(write_con, pretty_game_id, category, *progress[0][:5])
+        write_con.commit()
+
+    num_ranks_seen = sum(row[5] for row in progress)
+
+    offset_interval = 255
+    total = rankings.total
+    around_self_pagers = []
+
+    async def walk_around_self(
+        cursor_rank,
+        last_rank_seen,
+        last_id_seen,
+        last_pid_seen,
+        stop_rank=None,
+        replace=False,
+    ):
+        nonlocal num_ranks_seen
+
+        around_self = AroundSelfPager(category, offset_interval)
+        around_self_pagers.append(around_self)
+
+        while True:
+            try:
+                rankings = await around_self.get(
+                    last_rank_seen,
+                    last_id_seen,
+                    last_pid_seen,
+                    s,
+                    host,
+                    port,
+                    pid,
+                    password,
+                    auth_info=auth_info,
+                )
 
-        try:
-            category = found_queue.get(block=False)
+                # Leave the ranks from stop_rank on to the cursor that started there
+                reached_stop = False
+                if stop_rank is not None:
+                    reached_stop = any(
+                        entry.rank >= stop_rank for entry in rankings.data
+                    )
+                    rankings.data = [
+                        entry for entry in rankings.data if entry.rank < stop_rank
+                    ]
 
-            # Use sentinels
-            if category == -1:
-                num_sentinels += 1
-                if num_sentinels == num_processes:
-                    print("Ending print process")
+                # If none of the players around this player are unique assume done for now
+                if len(rankings.data) == 0:
                     break
 
-            print("Found category %d" % category)
-        except queue.Empty:
-            None
+                await add_rankings(
+                    category,
+                    s,
+                    host,
+                    port,
+                    pid,
+                    password,
+                    log_queue,
+                    rankings,
+                    pretty_game_id,
+                    has_datastore,
+                    write_con,
+                    auth_info=auth_info,
+                    progress=None if replace else (cursor_rank, stop_rank),
+                    param_downloader=param_downloader,
+                    replace=replace,
+                )
 
-        try:
-            num_tested_add = num_tested_queue.get(block=False)
-            num_tested += num_tested_add
+                last_rank_seen = rankings.data[-1].rank
+                last_pid_seen = rankings.data[-1].pid
+                last_id_seen = rankings.data[-1].unique_id
+                num_ranks_seen += len(rankings.data)
 
-            cur = time.perf_counter()
-            print(
-                "Tested %d in %f seconds, would take %d seconds or %d days"
-                % (
-                    num_tested,
-                    cur - begin,
-                    (cur - begin) / num_tested * pow(2, 32),
-                    ((cur - begin) / num_tested * pow(2, 32)) / 86400,
+                print_and_log(
+                    "Have %d out of %d for category %d for %s (%d out of %d)"
+                    % (
+                        num_ranks_seen,
+                        total,
+                        category,
+                        game["name"].replace("\n", " "),
+                        i,
+                        len(nex_wiiu_games),
+                    ),
+                    log_file,
+                )
+
+                if reached_stop:
+                    break
+            except RMCError as e:
+                print_and_log(
+                    "Have %d and RMCError with %s at category %d: %s"
+                    % (
+                        num_ranks_seen,
+                        game["name"].replace("\n", " "),
+                        category,
+                        "".join(
+                            traceback.TracebackException.from_exception(e).format()
+                        ),
+                    ),
+                    log_file,
+                )
+                break
+            except Exception as e:
+                # Protocol is likely incorrect
+                print_and_log(
+                    "Have %d and issue with %s at category %d: %s"
+                    % (
+                        num_ranks_seen,
+                        game["name"].replace("\n", " "),
+                        category,
+                        "".join(
+                            traceback.TracebackException.from_exception(e).format()
+                        ),
+                    ),
+                    log_file,
                 )
+                break
+
+        return last_rank_seen
+
+    # Walks every cursor, each (cursor rank, last rank, last id, last pid, stop
+    # rank), at once. An open ended last cursor is first split between several
+    # new ones over the ranks it has left. Each cursor stops where the next began
+    async def walk_with_cursors(cursors):
+        if len(cursors) == 0:
+            return
+
+        last_rank_seen = cursors[-1][1]
+        stop_rank = cursors[-1][4]
+
+        num_cursors = 0
+        if stop_rank is None:
+            num_cursors = min(
+                RANKING_CURSORS, (total - last_rank_seen) // RANKING_CURSOR_MIN_SPAN
             )
-        except queue.Empty:
-            None
+        if num_cursors > 1:
+            span = (total - last_rank_seen) // num_cursors
+            seeds = await get_cursor_seeds(
+                con,
+                pretty_game_id,
+                category,
+                [last_rank_seen + span * k for k in range(1, num_cursors)],
+                s,
+                host,
+                port,
+                pid,
+                password,
+                auth_info=auth_info,
+            )
+            num_split = len(cursors)
+            for seed_rank, seed_id, seed_pid in seeds:
+                # Start just before the seed so it gets archived too
+                if seed_rank - 1 > cursors[-1][1]:
+                    cursors[-1] = cursors[-1][:4] + (seed_rank,)
+                    cursors.append(
+                        (seed_rank - 1, seed_rank - 1, seed_id, seed_pid, None)
+                    )
+            num_split = len(cursors) - num_split
+
+            # Seeds need an entry at that rank, from an offset page or the
+            # database. Offset limited categories not archived yet have neither
+            if num_split < num_cursors - 1:
+                METRICS.inc(
+                    "ranking_cursor_seeds_missing_total", num_cursors - 1 - num_split
+                )
+                print_and_log(
+                    "Only found %d of %d cursor seeds for category %d for %s, walking the last %d ranks with %d cursors"
+                    % (
+                        num_split,
+                        num_cursors - 1,
+                        category,
+                        game["name"].replace("\n", " "),
+                        total - last_rank_seen,
+                        num_split + 1,
+                    ),
+                    log_file,
+                )
 
+            # Checkpoint the split so a restart resumes every cursor
+            for cursor in cursors:
+                save_ranking_progress(write_con, pretty_game_id, category, *cursor)
+            write_con.commit()
 
-def run_category_scrape(
-    category,
-    log_lock,
+        last_ranks = [None] * len(cursors)
+
+        async def walk_cursor(k):
+            last_ranks[k] = await walk_around_self(
+                *cursors[k][:4], stop_rank=cursors[k][4]
+            )
+
+        async with anyio.create_task_group() as group:
+            for k in range(len(cursors)):
+                group.start_soon(walk_cursor, k)
+
+        # Every cursor with a stop rank has to have reached the rank before it
+        for k in range(len(cursors)):
+            if cursors[k][4] is not None and last_ranks[k] < cursors[k][4] - 1:
+                print_and_log(
+                    "Gap in category %d for %s from rank %d to %d, cursor %d stopped early"
+                    % (
+                        category,
+                        game["name"].replace("\n", " "),
+                        last_ranks[k] + 1,
+                        cursors[k][4] - 1,
+                        k,
+                    ),
+                    log_file,
+                )
+
+    # Compares the entry stored at every RANKING_DELTA_REGION-th rank with where
+    # that player is now. A region is walked again if either of its ends moved,
+    # or if it is the last one and the number of entries changed
+    async def delta_sync():
+        stored = {
+            rank: (int(unique_id), int(entry_pid), score, update_time)
+            for rank, unique_id, entry_pid, score, update_time in await fetch_in_thread(
+                con,
+                "SELECT rank, id, pid, score, update_time FROM ranking WHERE game = ? AND category = ? AND (rank - 1) % ? = 0",
+                (pretty_game_id, category, RANKING_DELTA_REGION),
+            )
+        }
+        stored_count, stored_max = (
+            await fetch_in_thread(
+                con,
+                "SELECT COUNT(*), MAX(rank) FROM ranking WHERE game = ? AND category = ?",
+                (pretty_game_id, category),
+            )
+        )[0]
+        boundaries = list(
+            range(1, max(total, stored_max or 0) + 1, RANKING_DELTA_REGION)
+        )
+
+        limiter = anyio.CapacityLimiter(RANKING_PIPELINE_DEPTH)
+        moved = set()
+
+        async def check_boundary(rank):
+            if rank not in stored or rank > total:
+                moved.add(rank)
+                return
+            unique_id, entry_pid, score, update_time = stored[rank]
+
+            async def get_entry(client):
+                ranking_client = ranking.RankingClient(client)
+
+                order_param = ranking.RankingOrderParam()
+                order_param.order_calc = ORDINAL_RANKING
+                order_param.offset = 0
+                order_param.count = 1
+
+                return await ranking_client.get_ranking(
+                    ranking.RankingMode.GLOBAL_AROUND_SELF,
+                    category,
+                    order_param,
+                    unique_id,
+                    entry_pid,
+                )
+
+            async with limiter:
+                try:
+                    entries = await retry_if_rmc_error(
+                        get_entry,
+                        s,
+                        host,
+                        port,
+                        str(pid),
+                        password,
+                        auth_info=auth_info,
+                    )
+                except RMCError:
+                    # Gone from the leaderboard or unreachable, walk it again
+                    moved.add(rank)
+                    return
+
+            if not any(
+                entry.rank == rank
+                and entry.pid == entry_pid
+                and entry.unique_id == unique_id
+                and entry.score == score
+                and timestamp_if_not_null(entry.update_time) == update_time
+                for entry in entries.data
+            ):
+                moved.add(rank)
+
+        async with anyio.create_task_group() as group:
+            for rank in boundaries:
+                group.start_soon(check_boundary, rank)
+
+        changed = [
+            k
+            for k in range(len(boundaries))
+            if boundaries[k] in moved
+            or (k + 1 < len(boundaries) and boundaries[k + 1] in moved)
+            or (
+                k + 1 == len(boundaries)
+                and (stored_count != total or stored_max != total)
+            )
+        ]
+
+        # Consecutive changed regions are walked as one
+        walks = []
+        for k in changed:
+            if len(walks) > 0 and walks[-1][1] == k:
+                walks[-1][1] = k + 1
+            else:
+                walks.append([k, k + 1])
+
+        async def walk_region(first, last):
+            start_rank = boundaries[first]
+            stop_rank = boundaries[last] if last < len(boundaries) else None
+
+            if start_rank in moved:
+                # Only the first region can start at a moved entry, take the
+                # one at the top of the leaderboard now instead
+                await add_rankings(
+                    category,
+                    s,
+                    host,
+                    port,
+                    pid,
+                    password,
+                    log_queue,
+                    rankings,
+                    pretty_game_id,
+                    has_datastore,
+                    write_con,
+                    auth_info=auth_info,
+                    param_downloader=param_downloader,
+                    replace=True,
+                )
+                seed = rankings.data[0]
+                start_rank, unique_id, entry_pid = seed.rank, seed.unique_id, seed.pid
+            else:
+                unique_id, entry_pid = stored[start_rank][:2]
+
+            await walk_around_self(
+                0, start_rank, unique_id, entry_pid, stop_rank=stop_rank, replace=True
+            )
+
+        async with anyio.create_task_group() as group:
+            for first, last in walks:
+                group.start_soon(walk_region, first, last)
+
+        # Entries that fell off the end of the leaderboard
+        if stored_max is not None and stored_max > total:
+            supersede_rankings(write_con, pretty_game_id, category, total + 1)
+
+        # Replacing walks leave the checkpoints alone, record where they ended
+        reset_ranking_progress(write_con, pretty_game_id, category)
+        write_con.commit()
+
+        print_and_log(
+            "Delta sync of category %d for %s walked %d of %d regions"
+            % (
+                category,
+                game["name"].replace("\n", " "),
+                len(changed),
+                len(boundaries),
+            ),
+            log_file,
+        )
+
+    if RANKING_DELTA_SYNC and len(progress) > 0:
+        await delta_sync()
+    elif num_ranks_seen >= total:
+        print_and_log("Stopping category %d, already finished" % category, log_file)
+    elif len(progress) == 0:
+        # Try offset, several pages in flight at once
+        cur_offset = 0
+        pages = []
+        while True:
+            try:
+                if len(pages) == 0:
+                    offsets = [
+                        offset
+                        for offset in range(
+                            cur_offset,
+                            cur_offset + offset_interval * RANKING_PIPELINE_DEPTH,
+                            offset_interval,
+                        )
+                        if offset < total
+                    ]
+                    if len(offsets) == 0:
+                        break
+
+                    pages = await get_ranking_pages(
+                        category,
+                        offsets,
+                        offset_interval,
+                        s,
+                        host,
+                        port,
+                        pid,
+                        password,
+                        auth_info=auth_info,
+                    )
+
+                rankings = pages.pop(0)
+                if isinstance(rankings, Exception):
+                    raise rankings
+
+                await add_rankings(
+                    category,
+                    s,
+                    host,
+                    port,
+                    pid,
+                    password,
+                    log_queue,
+                    rankings,
+                    pretty_game_id,
+                    has_datastore,
+                    write_con,
+                    auth_info=auth_info,
+                    progress=(0, None),
+                    param_downloader=param_downloader,
+                )
+
+                last_rank_seen = rankings.data[-1].rank
+                last_pid_seen = rankings.data[-1].pid
+                last_id_seen = rankings.data[-1].unique_id
+                num_ranks_seen += len(rankings.data)
+
+                print_and_log(
+                    "Have %d out of %d for category %d for %s (%d out of %d)"
+                    % (
+                        num_ranks_seen,
+                        rankings.total,
+                        category,
+                        game["name"].replace("\n", " "),
+                        i,
+                        len(nex_wiiu_games),
+                    ),
+                    log_file,
+                )
+
+                cur_offset += len(rankings.data)
+
+                # Pages were requested at fixed offsets, a short one means the
+                # rest are misaligned so fetch again from here
+                if len(rankings.data) < offset_interval:
+                    pages = []
+            except RMCError as e:
+                print_and_log(
+                    "Have %d and RMCError with %s at category %d: %s"
+                    % (
+                        num_ranks_seen,
+                        game["name"].replace("\n", " "),
+                        category,
+                        "".join(
+                            traceback.TracebackException.from_exception(e).format()
+                        ),
+                    ),
+                    log_file,
+                )
+                break
+            except Exception as e:
+                # Protocol is likely incorrect
+                print_and_log(
+                    "Have %d and issue with %s at category %d: %s"
+                    % (
+                        num_ranks_seen,
+                        game["name"].replace("\n", " "),
+                        category,
+                        "".join(
+                            traceback.TracebackException.from_exception(e).format()
+                        ),
+                    ),
+                    log_file,
+                )
+                break
+
+        # For games that limit to 1000 try mode = 1 approach (around specific player)
+        await walk_with_cursors(
+            [(0, last_rank_seen, last_id_seen, last_pid_seen, None)]
+        )
+    else:
+        # Resume every cursor that has not reached its stop rank yet
+        await walk_with_cursors(
+            [row[:5] for row in progress if row[4] is None or row[1] < row[4] - 1]
+        )
+
+    for k, around_self in enumerate(around_self_pagers):
+        print_and_log(
+            "Around self for category %d cursor %d for %s: %s"
+            % (category, k, game["name"].replace("\n", " "), around_self.stats()),
+            log_file,
+        )
+
+    con.close()
+
+
+# Walks GLOBAL_AROUND_SELF windows past the last entry seen. The server centres
+# the window on the seed, so about half of every unshifted response is already
+# archived. Each response measures where the seed landed and the next request
+# shifts the window by that much through order_param.offset, keeping the seed
+# as the first entry. If the seed goes missing from a shifted window it is
+# requested again unshifted and shifting is turned off for the category
+class AroundSelfPager:
+    def __init__(self, category, count):
+        self.category = category
+        self.count = count
+        self.offset = 0
+        self.shifting = True
+        self.unshifted_index = None
+        self.requests = 0
+        self.received = 0
+        self.duplicates = 0
+
+    async def get(
+        self,
+        last_rank_seen,
+        last_id_seen,
+        last_pid_seen,
+        s,
+        host,
+        port,
+        pid,
+        password,
+        auth_info=None,
+    ):
+        while True:
+            offset = self.offset if self.shifting else 0
+
+            async def get_rankings(client):
+                ranking_client = ranking.RankingClient(client)
+
+                order_param = ranking.RankingOrderParam()
+                order_param.order_calc = ORDINAL_RANKING
+                order_param.offset = offset
+                order_param.count = self.count
+
+                rankings = await ranking_client.get_ranking(
+                    ranking.RankingMode.GLOBAL_AROUND_SELF,  # Get the leaderboard around this player
+                    self.category,
+                    order_param,
+                    last_id_seen,
+                    last_pid_seen,
+                )
+
+                return rankings
+
+            try:
+                rankings = await retry_if_rmc_error(
+                    get_rankings,
+                    s,
+                    host,
+                    port,
+                    str(pid),
+                    password,
+                    auth_info=auth_info,
+                )
+            except RMCRetriesExhausted:
+                raise
+            except RMCError:
+                if offset == 0:
+                    raise
+                # Shifted past the end of the leaderboard
+                self.shifting = False
+                continue
+
+            self.requests += 1
+            self.received += len(rankings.data)
+
+            seed_index = None
+            for j, entry in enumerate(rankings.data):
+                if entry.pid == last_pid_seen and entry.unique_id == last_id_seen:
+                    seed_index = j
+                    break
+
+            if offset != 0 and seed_index is None:
+                # Cannot tell whether rows were skipped, the whole window is wasted
+                self.duplicates += len(rankings.data)
+                self.shifting = False
+                continue
+
+            if self.shifting and seed_index is not None:
+                if offset == 0:
+                    self.unshifted_index = seed_index
+                elif seed_index == self.unshifted_index:
+                    # Server ignores the offset in this mode
+                    self.shifting = False
+                self.offset = offset + seed_index
+
+            new_data = [entry for entry in rankings.data if entry.rank > last_rank_seen]
+            self.duplicates += len(rankings.data) - len(new_data)
+            rankings.data = new_data
+
+            return rankings
+
+    def stats(self):
+        return "%d requests, %d of %d entries duplicate (%.1f%%), offset %d" % (
+            self.requests,
+            self.duplicates,
+            self.received,
+            100 * self.duplicates / max(self.received, 1),
+            self.offset if self.shifting else 0,
+        )
+
+
+# Fetches GLOBAL pages at all offsets concurrently, returned in offset order.
+# A page that failed is returned as its exception
+async def get_ranking_pages(
+    category, offsets, count, s, host, port, pid, password, auth_info=None
+):
+    pages = [None] * len(offsets)
+
+    async def get_page(j, offset):
+        async def get_rankings(client):
+            ranking_client = ranking.RankingClient(client)
+
+            order_param = ranking.RankingOrderParam()
+            order_param.order_calc = ORDINAL_RANKING
+            order_param.offset = offset
+            order_param.count = count
+
+            rankings = await ranking_client.get_ranking(
+                ranking.RankingMode.GLOBAL,  # Get the global leaderboard
+                category,
+                order_param,
+                0,
+                0,
+            )
+
+            return rankings
+
+        try:
+            pages[j] = await retry_if_rmc_error(
+                get_rankings,
+                s,
+                host,
+                port,
+                str(pid),
+                password,
+                auth_info=auth_info,
+            )
+        except Exception as e:
+            pages[j] = e
+
+    async with anyio.create_task_group() as group:
+        for j, offset in enumerate(offsets):
+            group.start_soon(get_page, j, offset)
+
+    return pages
+
+
+# Finds an entry at or just after each rank to start a cursor from, as
+# (rank, unique id, pid). A GLOBAL page at that offset is tried first, then rows
+# already in the ranking table. Ranks with neither are left out
+async def get_cursor_seeds(
+    con, pretty_game_id, category, ranks, s, host, port, pid, password, auth_info=None
+):
+    pages = await get_ranking_pages(
+        category,
+        [rank - 1 for rank in ranks],
+        1,
+        s,
+        host,
+        port,
+        pid,
+        password,
+        auth_info=auth_info,
+    )
+
+    seeds = []
+    for rank, page in zip(ranks, pages):
+        if not isinstance(page, Exception) and len(page.data) > 0:
+            seeds.append((page.data[0].rank, page.data[0].unique_id, page.data[0].pid))
+            continue
+
+        result = await fetch_in_thread(
+            con,
+            "SELECT rank, id, pid FROM ranking WHERE game = ? AND category = ? AND rank >= ? ORDER BY rank LIMIT 1",
+            (pretty_game_id, category, rank),
+        )
+        if len(result) > 0:
+            seeds.append((int(result[0][0]), int(result[0][1]), int(result[0][2])))
+
+    return seeds
+
+
+# Runs every category of a game as a task in this process, at most
+# concurrency at once. A new category starts as soon as any other finishes
+async def run_category_scrapes(
+    categories,
+    concurrency,
+    log_queue,
+    write_queue,
     s,
     host,
     port,
@@ -192,432 +1510,687 @@ def run_category_scrape(
     i,
     nex_wiiu_games,
     auth_info=None,
+    param_downloader=None,
 ):
-    async def main():
-        con = sqlite3.connect(RANKING_DB, timeout=3600)
-        print("Starting category %d" % category)
+    limiter = anyio.CapacityLimiter(concurrency)
 
-        last_rank_seen = 0
-        num_ranks_seen = 0
-        last_pid_seen = None
-        last_id_seen = None
-        rankings = None
+    async def run(category):
+        async with limiter:
+            try:
+                await run_category_scrape(
+                    category,
+                    log_queue,
+                    write_queue,
+                    s,
+                    host,
+                    port,
+                    pid,
+                    password,
+                    game,
+                    pretty_game_id,
+                    has_datastore,
+                    i,
+                    nex_wiiu_games,
+                    auth_info=auth_info,
+                    param_downloader=param_downloader,
+                )
+            except Exception as e:
+                # Never let one category take down the rest
+                print(
+                    "Category %d failed: %s"
+                    % (
+                        category,
+                        "".join(
+                            traceback.TracebackException.from_exception(e).format()
+                        ),
+                    )
+                )
+
+    async with anyio.create_task_group() as group:
+        for category in categories:
+            group.start_soon(run, category)
+
+
+# Number of entries in a category, raises RMCError if the category is invalid
+async def get_ranking_total(client, category):
+    ranking_client = ranking.RankingClient(client)
+
+    order_param = ranking.RankingOrderParam()
+    order_param.offset = 0
+    order_param.count = 1
+
+    rankings = await ranking_client.get_ranking(
+        ranking.RankingMode.GLOBAL,  # Get the global leaderboard
+        category,
+        order_param,
+        0,
+        0,
+    )
+
+    return rankings.total
+
+
+# Tries every category at once, at most concurrency in flight. Returns the
+# total of every category with a leaderboard, and whether every probe got an
+# answer (an RMCError means there is no leaderboard)
+async def probe_ranking_categories(
+    categories, concurrency, s, host, port, pid, password, auth_info=None
+):
+    limiter = anyio.CapacityLimiter(concurrency)
+    found = {}
+    complete = True
+
+    async def probe(category):
+        nonlocal complete
+
+        async def get_total(client):
+            return await get_ranking_total(client, category)
+
+        async with limiter:
+            try:
+                found[category] = await retry_if_rmc_error(
+                    get_total,
+                    s,
+                    host,
+                    port,
+                    str(pid),
+                    password,
+                    auth_info=auth_info,
+                )
+            except RMCRetriesExhausted:
+                complete = False
+            except RMCError:
+                None
+            except Exception:
+                complete = False
+
+    async with anyio.create_task_group() as group:
+        for category in categories:
+            group.start_soon(probe, category)
+
+    return found, complete
+
+
+# Tests every category from start to end over several sessions with many
+# requests in flight on each. Found categories are written to ranking_category
+# as each chunk finishes and the ranking_category_sweep row for start only moves
+# past chunks where every request got an answer, so a later run picks up there
+async def sweep_ranking_categories(
+    con,
+    write_con,
+    log_file,
+    pretty_game_id,
+    s,
+    host,
+    port,
+    pid,
+    password,
+    start,
+    end,
+    auth_info=None,
+):
+    result = list(
+        con.execute(
+            "SELECT range_next FROM ranking_category_sweep WHERE game = ? AND range_start = ?",
+            (pretty_game_id, start),
+        )
+    )
+    range_next = result[0][0] if len(result) > 0 else start
+    if range_next >= end:
+        return
+
+    print_and_log(
+        "Sweeping categories %d to %d over %d sessions"
+        % (range_next, end, RANKING_CATEGORY_SWEEP_SESSIONS),
+        log_file,
+    )
+
+    chunk_size = RANKING_CATEGORY_SWEEP_CHUNK
+    # Chunk start -> [categories left, found categories, failed requests]
+    chunks = {}
+    checkpoint = range_next
+    next_category = range_next
+    num_tested = 0
+    num_found = 0
+    num_failed = 0
+
+    def finish_chunk(chunk_start):
+        nonlocal checkpoint
+
+        _, found, _ = chunks[chunk_start]
+        write_con.executemany(
+            "INSERT OR REPLACE INTO ranking_category (game, category, total, source) values (?, ?, ?, ?)",
+            [
+                (pretty_game_id, category, total, "sweep")
+                for category, total in found.items()
+            ],
+        )
+
+        # Only checkpoint contiguous chunks without failures
+        old_checkpoint = checkpoint
+        while (
+            checkpoint in chunks
+            and chunks[checkpoint][0] == 0
+            and chunks[checkpoint][2] == 0
+        ):
+            del chunks[checkpoint]
+            checkpoint = min(checkpoint + chunk_size, end)
+        if checkpoint != old_checkpoint:
+            write_con.execute(
+                "INSERT OR REPLACE INTO ranking_category_sweep (game, range_start, range_next, range_end) values (?, ?, ?, ?)",
+                (pretty_game_id, start, checkpoint, end),
+            )
+        write_con.commit()
+
+    async def test_categories(slot):
+        nonlocal next_category, num_tested, num_found, num_failed
+
+        while next_category < end:
+            category = next_category
+            next_category += 1
+
+            chunk_start = category - (category - range_next) % chunk_size
+            if chunk_start not in chunks:
+                chunks[chunk_start] = [
+                    min(chunk_size, end - chunk_start),
+                    {},
+                    0,
+                ]
+            chunk = chunks[chunk_start]
+
+            async def get_total(client):
+                return await get_ranking_total(client, category)
+
+            try:
+                chunk[1][category] = await retry_if_rmc_error(
+                    get_total,
+                    s,
+                    host,
+                    port,
+                    str(pid),
+                    password,
+                    auth_info=auth_info,
+                    slot=slot,
+                )
+                num_found += 1
+                METRICS.inc("category_sweep_found_total")
+            except RMCRetriesExhausted:
+                chunk[2] += 1
+                num_failed += 1
+                METRICS.inc("category_sweep_failed_total")
+            except RMCError:
+                None
+            except Exception:
+                chunk[2] += 1
+                num_failed += 1
+                METRICS.inc("category_sweep_failed_total")
+
+            num_tested += 1
+            METRICS.inc("category_sweep_tested_total")
+
+            chunk[0] -= 1
+            if chunk[0] == 0:
+                finish_chunk(chunk_start)
+
+    async def report():
+        begin = time.perf_counter()
+        while True:
+            await anyio.sleep(RANKING_CATEGORY_SWEEP_REPORT_SECONDS)
+
+            rate = num_tested / (time.perf_counter() - begin)
+            print_and_log(
+                "Tested %d categories, found %d, failed %d, %d/s, %d minutes left"
+                % (
+                    num_tested,
+                    num_found,
+                    num_failed,
+                    rate,
+                    (end - next_category) / max(rate, 1) / 60,
+                ),
+                log_file,
+            )
+
+    async with anyio.create_task_group() as report_group:
+        report_group.start_soon(report)
+
+        async with anyio.create_task_group() as group:
+            for i in range(
+                RANKING_CATEGORY_SWEEP_SESSIONS * RANKING_CATEGORY_SWEEP_WINDOW
+            ):
+                group.start_soon(test_categories, i % RANKING_CATEGORY_SWEEP_SESSIONS)
+
+        report_group.cancel_scope.cancel()
+
+    print_and_log(
+        "Swept categories to %d, found %d, %d requests failed"
+        % (checkpoint, num_found, num_failed),
+        log_file,
+    )
+
+
+# Categories of a game from ranking_category. The probe only runs for the
+# part of 0 to RANKING_CATEGORY_PROBE_END earlier runs have not finished
+async def get_ranking_categories(
+    con,
+    write_con,
+    log_file,
+    pretty_game_id,
+    s,
+    host,
+    port,
+    pid,
+    password,
+    auth_info=None,
+):
+    result = list(
+        con.execute(
+            "SELECT range_next FROM ranking_category_sweep WHERE game = ? AND range_start = 0",
+            (pretty_game_id,),
+        )
+    )
+    range_next = result[0][0] if len(result) > 0 else 0
+
+    found = {}
+    if range_next < RANKING_CATEGORY_PROBE_END:
+        print_and_log(
+            "Probing categories %d to %d" % (range_next, RANKING_CATEGORY_PROBE_END),
+            log_file,
+        )
+
+        found, complete = await probe_ranking_categories(
+            range(range_next, RANKING_CATEGORY_PROBE_END),
+            RANKING_CATEGORY_PROBE_CONCURRENCY,
+            s,
+            host,
+            port,
+            pid,
+            password,
+            auth_info=auth_info,
+        )
+
+        write_con.executemany(
+            "INSERT OR REPLACE INTO ranking_category (game, category, total, source) values (?, ?, ?, ?)",
+            [
+                (pretty_game_id, category, total, "probe")
+                for category, total in found.items()
+            ],
+        )
+        if complete:
+            write_con.execute(
+                "INSERT OR REPLACE INTO ranking_category_sweep (game, range_start, range_next, range_end) values (?, ?, ?, ?)",
+                (
+                    pretty_game_id,
+                    0,
+                    RANKING_CATEGORY_PROBE_END,
+                    RANKING_CATEGORY_PROBE_END,
+                ),
+            )
+        write_con.commit()
+
+        print_and_log(
+            "Found %d categories%s"
+            % (len(found), "" if complete else ", probe did not finish"),
+            log_file,
+        )
+
+    categories = set(found)
+    categories.update(
+        row[0]
+        for row in con.execute(
+            "SELECT category FROM ranking_category WHERE game = ?", (pretty_game_id,)
+        )
+    )
+    return sorted(categories)
+
+
+# Adds category lists for leaderboards the probe cannot find to
+# ranking_category. Same layout as the find-nex-servers game lists
+def import_ranking_categories(con, path):
+    if not os.path.exists(path):
+        return
+
+    f = open(path)
+    games = json.load(f)["games"]
+    f.close()
+
+    for game in games:
+        pretty_game_id = hex(game["aid"])[2:].upper().rjust(16, "0")
+        con.executemany(
+            "INSERT OR IGNORE INTO ranking_category (game, category, total, source) values (?, ?, ?, ?)",
+            [
+                (pretty_game_id, category, None, "import")
+                for category in game["categories"]
+            ],
+        )
+    con.commit()
 
-        # One request to get first PID and number of rankings, just in case offset based fails on first request
-        try:
 
-            async def get_start_data(client):
-                ranking_client = ranking.RankingClient(client)
+# Objects of a batch are downloaded up to DATASTORE_DOWNLOAD_CONCURRENCY at a
+# time in each worker, still within the per host limits of retry_if_rmc_error
+# and the HTTP client pool. Each one goes to the writer as soon as it is done
+DATASTORE_DOWNLOAD_CONCURRENCY = int(os.getenv("DATASTORE_DOWNLOAD_CONCURRENCY", "8"))
 
-                order_param = ranking.RankingOrderParam()
-                order_param.offset = 0
-                order_param.count = 1
 
-                rankings = await ranking_client.get_ranking(
-                    ranking.RankingMode.GLOBAL,  # Get the global leaderboard
-                    category,
-                    order_param,
-                    0,
-                    0,
-                )
+# How each game hands out download URLs in this process: "infos" when one
+# get_object_infos call resolves a whole batch, "prepare" when every object
+# needs its own prepare_get_object. Kept in datastore_url_method and loaded
+# back when a mode or worker starts, so a game is only probed once
+DATASTORE_URL_METHODS = {}
 
-                return (rankings, rankings.data[0].pid, rankings.data[0].unique_id)
 
-            rankings, last_pid_seen, last_id_seen = await retry_if_rmc_error(
-                get_start_data, s, host, port, str(pid), password
-            )
-        except Exception as e:
-            # Protocol is likely incorrect
-            log_lock.acquire()
-            log_file = open(RANKING_LOG, "a", encoding="utf-8")
-            print_and_log(
-                "Have %d and issue with %s at category %d: %s"
-                % (
-                    num_ranks_seen,
-                    game["name"].replace("\n", " "),
-                    category,
-                    "".join(traceback.TracebackException.from_exception(e).format()),
-                ),
-                log_file,
-            )
-            log_file.close()
-            log_lock.release()
-            return
+def create_datastore_url_method(con):
+    con.execute(
+        """
+    CREATE TABLE IF NOT EXISTS datastore_url_method (
+        game TEXT PRIMARY KEY,
+        method TEXT
+    )"""
+    )
+    load_datastore_url_methods(con)
 
-        # Get number of rankings with this category
-        num_ranks_seen = list(
-            con.execute(
-                "SELECT COUNT(*) FROM ranking WHERE game = ? AND category = ?",
-                (pretty_game_id, category),
-            )
-        )[0][0]
 
-        offset_interval = 255
-        if num_ranks_seen >= rankings.total:
-            log_lock.acquire()
-            log_file = open(RANKING_LOG, "a", encoding="utf-8")
-            print_and_log("Stopping category %d, already finished" % category, log_file)
-            log_file.close()
-            log_lock.release()
-        elif num_ranks_seen == 0:
-            # Try offset
-            cur_offset = 0
-            finish_after_this_one = False
-            while True:
-                try:
+def load_datastore_url_methods(con):
+    DATASTORE_URL_METHODS.update(
+        con.execute("SELECT game, method FROM datastore_url_method")
+    )
 
-                    async def get_rankings(client):
-                        ranking_client = ranking.RankingClient(client)
 
-                        order_param = ranking.RankingOrderParam()
-                        order_param.order_calc = ORDINAL_RANKING
-                        order_param.offset = cur_offset
-                        order_param.count = offset_interval
+# Resolves the download URL of every data ID in one call. Returns req_info by
+# data ID for the objects it could resolve, the rest need prepare_get_object
+async def get_object_infos(
+    con, s, host, port, pid, password, pretty_game_id, data_ids, auth_info=None
+):
+    method = DATASTORE_URL_METHODS.get(pretty_game_id)
+    if method == "prepare" or len(data_ids) == 0:
+        return {}
 
-                        rankings = await ranking_client.get_ranking(
-                            ranking.RankingMode.GLOBAL,  # Get the global leaderboard
-                            category,
-                            order_param,
-                            0,
-                            0,
-                        )
+    async def get_infos(client):
+        store = datastore.DataStoreClient(client)
+        return await store.get_object_infos(data_ids)
 
-                        return rankings
+    try:
+        res = await retry_if_rmc_error(
+            get_infos, s, host, port, str(pid), password, auth_info=auth_info
+        )
+    except RMCRetriesExhausted:
+        # Says nothing about get_object_infos, fall back for this batch only
+        return {}
+    except (RMCError, ValueError) as e:
+        if method == "infos":
+            # Worked before, only this batch is affected
+            return {}
+
+        print("get_object_infos does not work for %s: %s" % (pretty_game_id, e))
+        method = "prepare"
+    else:
+        method = "infos"
 
-                    rankings = await retry_if_rmc_error(
-                        get_rankings,
-                        s,
-                        host,
-                        port,
-                        str(pid),
-                        password,
-                        auth_info=auth_info,
-                    )
+    if DATASTORE_URL_METHODS.get(pretty_game_id) != method:
+        DATASTORE_URL_METHODS[pretty_game_id] = method
+        con.execute(
+            "INSERT OR REPLACE INTO datastore_url_method (game, method) values (?, ?)",
+            (pretty_game_id, method),
+        )
+        con.commit()
 
-                    await add_rankings(
-                        category,
-                        s,
-                        host,
-                        port,
-                        pid,
-                        password,
-                        log_lock,
-                        rankings,
-                        pretty_game_id,
-                        has_datastore,
-                        con,
-                        auth_info=auth_info,
-                    )
+    if method == "prepare":
+        return {}
 
-                    last_rank_seen = rankings.data[-1].rank
-                    last_pid_seen = rankings.data[-1].pid
-                    last_id_seen = rankings.data[-1].unique_id
-                    num_ranks_seen += len(rankings.data)
+    return {
+        data_id: info
+        for data_id, info, result in zip(data_ids, res.infos, res.results)
+        if result.is_success()
+    }
 
-                    log_lock.acquire()
-                    log_file = open(RANKING_LOG, "a", encoding="utf-8")
-                    print_and_log(
-                        "Have %d out of %d for category %d for %s (%d out of %d)"
-                        % (
-                            num_ranks_seen,
-                            rankings.total,
-                            category,
-                            game["name"].replace("\n", " "),
-                            i,
-                            len(nex_wiiu_games),
-                        ),
-                        log_file,
-                    )
-                    log_file.close()
-                    log_lock.release()
 
-                    if finish_after_this_one:
-                        break
+# Signed URLs are not used past this long before they expire. URLs that do not
+# say when they expire are taken to be good for DATASTORE_URL_MAX_AGE
+DATASTORE_URL_EXPIRY_MARGIN = 30
+DATASTORE_URL_MAX_AGE = int(os.getenv("DATASTORE_URL_MAX_AGE", "300"))
 
-                    cur_offset += len(rankings.data)
-                except RMCError as e:
-                    log_lock.acquire()
-                    log_file = open(RANKING_LOG, "a", encoding="utf-8")
-                    print_and_log(
-                        "Have %d and RMCError with %s at category %d: %s"
-                        % (
-                            num_ranks_seen,
-                            game["name"].replace("\n", " "),
-                            category,
-                            "".join(
-                                traceback.TracebackException.from_exception(e).format()
-                            ),
-                        ),
-                        log_file,
-                    )
-                    log_file.close()
-                    log_lock.release()
-                    break
-                except Exception as e:
-                    # Protocol is likely incorrect
-                    log_lock.acquire()
-                    log_file = open(RANKING_LOG, "a", encoding="utf-8")
-                    print_and_log(
-                        "Have %d and issue with %s at category %d: %s"
-                        % (
-                            num_ranks_seen,
-                            game["name"].replace("\n", " "),
-                            category,
-                            "".join(
-                                traceback.TracebackException.from_exception(e).format()
-                            ),
-                        ),
-                        log_file,
-                    )
-                    log_file.close()
-                    log_lock.release()
-                    break
 
-            # For games that limit to 1000 try mode = 1 approach (around specific player)
-            while True:
-                try:
+def get_url_expiry(url, resolved):
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit("https://%s" % url).query)
+    try:
+        if "Expires" in query:
+            return int(query["Expires"][0])
+        if "X-Amz-Date" in query and "X-Amz-Expires" in query:
+            signed = calendar.timegm(
+                time.strptime(query["X-Amz-Date"][0], "%Y%m%dT%H%M%SZ")
+            )
+            return signed + int(query["X-Amz-Expires"][0])
+    except ValueError:
+        pass
+    return resolved + DATASTORE_URL_MAX_AGE
+
+
+# Downloads batches of (data_id, owner_id) entries in two stages. put() resolves
+# the URLs of a batch while the previous one is still being transferred, and
+# only hands it over once that is done. Any error with an object is passed to
+# on_error(data_id, e), which returns True to drop the rest of the batch
+class DatastoreDownloader:
+    def __init__(
+        self,
+        con,
+        log_file,
+        s,
+        host,
+        port,
+        pid,
+        password,
+        pretty_game_id,
+        auth_info=None,
+    ):
+        self.con = con
+        self.log_file = log_file
+        self.s = s
+        self.host = host
+        self.port = port
+        self.pid = pid
+        self.password = password
+        self.pretty_game_id = pretty_game_id
+        self.auth_info = auth_info
+
+        self.send, self.receive = anyio.create_memory_object_stream(0)
+        self.group = None
+
+    async def __aenter__(self):
+        # Earlier workers may have found out since this process started
+        await anyio.to_thread.run_sync(self.load_url_methods)
+
+        self.group = anyio.create_task_group()
+        await self.group.__aenter__()
+        self.group.start_soon(self.run)
+        return self
+
+    def load_url_methods(self):
+        con = sqlite3.connect(DATASTORE_DB, timeout=3600)
+        try:
+            load_datastore_url_methods(con)
+        finally:
+            con.close()
+
+    # Batches already put are still transferred, unless something failed
+    async def __aexit__(self, typ, val, tb):
+        await self.send.aclose()
+        if typ is not None:
+            self.group.cancel_scope.cancel()
+        return await self.group.__aexit__(typ, val, tb)
+
+    async def put(self, entries, on_error):
+        urls = await self.resolve([data_id for data_id, owner_id in entries])
+        await self.send.send((entries, urls, on_error))
+
+    async def run(self):
+        async with self.receive:
+            async for entries, urls, on_error in self.receive:
+                await self.transfer(entries, urls, on_error)
+
+    # Returns (req_info, expiry) or the exception for every data ID, with one
+    # get_object_infos call where the game supports it
+    async def resolve(self, data_ids):
+        resolved = time.time()
+        req_infos = await get_object_infos(
+            self.con,
+            self.s,
+            self.host,
+            self.port,
+            self.pid,
+            self.password,
+            self.pretty_game_id,
+            data_ids,
+            auth_info=self.auth_info,
+        )
+        METRICS.inc("datastore_urls_total", len(req_infos), method="infos")
 
-                    async def get_rankings(client):
-                        ranking_client = ranking.RankingClient(client)
+        urls = {
+            data_id: (req_info, get_url_expiry(req_info.url, resolved))
+            for data_id, req_info in req_infos.items()
+        }
 
-                        order_param = ranking.RankingOrderParam()
-                        order_param.order_calc = ORDINAL_RANKING
-                        order_param.offset = 0
-                        order_param.count = offset_interval
+        limiter = anyio.CapacityLimiter(DATASTORE_DOWNLOAD_CONCURRENCY)
 
-                        rankings = await ranking_client.get_ranking(
-                            ranking.RankingMode.GLOBAL_AROUND_SELF,  # Get the leaderboard around this player
-                            category,
-                            order_param,
-                            last_id_seen,
-                            last_pid_seen,
-                        )
+        async def prepare(data_id):
+            async with limiter:
+                try:
+                    urls[data_id] = await self.prepare_url(data_id)
+                except Exception as e:
+                    urls[data_id] = e
 
-                        return rankings
+        async with anyio.create_task_group() as group:
+            for data_id in data_ids:
+                if data_id not in urls:
+                    group.start_soon(prepare, data_id)
 
-                    rankings = await retry_if_rmc_error(
-                        get_rankings,
-                        s,
-                        host,
-                        port,
-                        str(pid),
-                        password,
-                        auth_info=auth_info,
-                    )
+        return urls
 
-                    rankings.data = list(
-                        filter(lambda entry: entry.rank > last_rank_seen, rankings.data)
-                    )
+    async def prepare_url(self, data_id):
+        async def get_req_info(client):
+            store = datastore.DataStoreClient(client)
 
-                    # If none of the players around this player are unique assume done for now
-                    if len(rankings.data) == 0:
-                        break
+            get_param = datastore.DataStorePrepareGetParam()
+            get_param.data_id = data_id
 
-                    await add_rankings(
-                        category,
-                        s,
-                        host,
-                        port,
-                        pid,
-                        password,
-                        log_lock,
-                        rankings,
-                        pretty_game_id,
-                        has_datastore,
-                        con,
-                        auth_info=auth_info,
-                    )
+            return await store.prepare_get_object(get_param)
 
-                    last_rank_seen = rankings.data[-1].rank
-                    last_pid_seen = rankings.data[-1].pid
-                    last_id_seen = rankings.data[-1].unique_id
-                    num_ranks_seen += len(rankings.data)
+        resolved = time.time()
+        req_info = await retry_if_rmc_error(
+            get_req_info,
+            self.s,
+            self.host,
+            self.port,
+            str(self.pid),
+            self.password,
+            auth_info=self.auth_info,
+        )
+        METRICS.inc("datastore_urls_total", method="prepare")
 
-                    log_lock.acquire()
-                    log_file = open(RANKING_LOG, "a", encoding="utf-8")
-                    print_and_log(
-                        "Have %d out of %d for category %d for %s (%d out of %d)"
-                        % (
-                            num_ranks_seen,
-                            rankings.total,
-                            category,
-                            game["name"].replace("\n", " "),
-                            i,
-                            len(nex_wiiu_games),
-                        ),
-                        log_file,
-                    )
-                    log_file.close()
-                    log_lock.release()
-                except RMCError as e:
-                    log_lock.acquire()
-                    log_file = open(RANKING_LOG, "a", encoding="utf-8")
-                    print_and_log(
-                        "Have %d and RMCError with %s at category %d: %s"
-                        % (
-                            num_ranks_seen,
-                            game["name"].replace("\n", " "),
-                            category,
-                            "".join(
-                                traceback.TracebackException.from_exception(e).format()
-                            ),
-                        ),
-                        log_file,
-                    )
-                    log_file.close()
-                    log_lock.release()
-                    break
-                except Exception as e:
-                    # Protocol is likely incorrect
-                    log_lock.acquire()
-                    log_file = open(RANKING_LOG, "a", encoding="utf-8")
-                    print_and_log(
-                        "Have %d and issue with %s at category %d: %s"
-                        % (
-                            num_ranks_seen,
-                            game["name"].replace("\n", " "),
-                            category,
-                            "".join(
-                                traceback.TracebackException.from_exception(e).format()
-                            ),
-                        ),
-                        log_file,
-                    )
-                    log_file.close()
-                    log_lock.release()
-                    break
-        elif num_ranks_seen < rankings.total:
-            # Get last id and pid seen
-            result = list(
-                con.execute(
-                    "SELECT rank, id, pid FROM ranking WHERE game = ? AND category = ? ORDER BY rank DESC LIMIT 1",
-                    (pretty_game_id, category),
-                )
-            )[0]
-            last_rank_seen = int(result[0])
-            last_id_seen = int(result[1])
-            last_pid_seen = int(result[2])
+        return (req_info, get_url_expiry(req_info.url, resolved))
 
-            # Only use around_self for this
-            while True:
-                try:
+    async def transfer(self, entries, urls, on_error):
+        limiter = anyio.CapacityLimiter(DATASTORE_DOWNLOAD_CONCURRENCY)
 
-                    async def get_rankings(client):
-                        ranking_client = ranking.RankingClient(client)
+        async with anyio.create_task_group() as group:
 
-                        order_param = ranking.RankingOrderParam()
-                        order_param.order_calc = ORDINAL_RANKING
-                        order_param.offset = 0
-                        order_param.count = offset_interval
+            async def download(data_id):
+                async with limiter:
+                    try:
+                        if isinstance(urls[data_id], Exception):
+                            raise urls[data_id]
 
-                        rankings = await ranking_client.get_ranking(
-                            ranking.RankingMode.GLOBAL_AROUND_SELF,  # Get the leaderboard around this player
-                            category,
-                            order_param,
-                            last_id_seen,
-                            last_pid_seen,
-                        )
+                        await self.download(data_id, *urls[data_id])
+                    except Exception as e:
+                        # One broken object never takes down the rest
+                        if on_error(data_id, e):
+                            group.cancel_scope.cancel()
+
+            for data_id, owner_id in entries:
+                group.start_soon(download, data_id)
+
+    async def download(self, data_id, req_info, expiry):
+        print_and_log("Start %d" % data_id, self.log_file)
+
+        start = time.perf_counter()
+
+        refreshed = False
+        if time.time() >= expiry - DATASTORE_URL_EXPIRY_MARGIN:
+            METRICS.inc("datastore_url_refreshes_total", reason="expired")
+            req_info, expiry = await self.prepare_url(data_id)
+            refreshed = True
+
+        headers = {header.key: header.value for header in req_info.headers}
+        response = await get_object_data(req_info.url, headers)
+
+        if response.status_code == 403 and not refreshed:
+            # The signature expired sooner than the URL said, try a new one
+            METRICS.inc("datastore_url_refreshes_total", reason="forbidden")
+            req_info, expiry = await self.prepare_url(data_id)
+            headers = {header.key: header.value for header in req_info.headers}
+            response = await get_object_data(req_info.url, headers)
+
+        # Error pages are never stored as the object, only their status is kept
+        # and only when nothing was downloaded before
+        if not response.is_success:
+            self.con.execute(
+                "INSERT INTO datastore_data (game, data_id, url, error) values (?, ?, ?, ?) ON CONFLICT (game, data_id) DO UPDATE SET url = excluded.url, error = excluded.error WHERE data IS NULL",
+                (
+                    self.pretty_game_id,
+                    data_id,
+                    req_info.url,
+                    "HTTP %d" % response.status_code,
+                ),
+            )
+            self.con.commit()
+            response.raise_for_status()
 
-                        return rankings
+        # TODO store the headers too
+        self.con.execute(
+            "INSERT INTO datastore_data (game, data_id, url, data) values (?, ?, ?, ?) ON CONFLICT (game, data_id) DO UPDATE SET error = NULL, url = excluded.url, data = excluded.data",
+            (
+                self.pretty_game_id,
+                data_id,
+                req_info.url,
+                gzip.compress(response.content),
+            ),
+        )
+        self.con.commit()
 
-                    rankings = await retry_if_rmc_error(
-                        get_rankings,
-                        s,
-                        host,
-                        port,
-                        str(pid),
-                        password,
-                        auth_info=auth_info,
-                    )
+        print_and_log(
+            "Downloaded %d in %f seconds" % (data_id, time.perf_counter() - start),
+            self.log_file,
+        )
 
-                    rankings.data = list(
-                        filter(lambda entry: entry.rank > last_rank_seen, rankings.data)
-                    )
 
-                    # If none of the players around this player are unique assume done for now
-                    if len(rankings.data) == 0:
-                        break
+# Batches go to the worker processes over a multiprocessing queue ending in a
+# single None. Workers wait on it in a thread so their event loop keeps running,
+# and put the None back for the next worker when they get it. The wait is done
+# in short polls so a cancelled worker stops within WORK_QUEUE_POLL_INTERVAL
+# instead of sitting in Queue.get, and the None is never lost to a cancellation
+WORK_QUEUE_POLL_INTERVAL = 1
 
-                    await add_rankings(
-                        category,
-                        s,
-                        host,
-                        port,
-                        pid,
-                        password,
-                        log_lock,
-                        rankings,
-                        pretty_game_id,
-                        has_datastore,
-                        con,
-                    )
 
-                    last_rank_seen = rankings.data[-1].rank
-                    last_pid_seen = rankings.data[-1].pid
-                    last_id_seen = rankings.data[-1].unique_id
-                    num_ranks_seen += len(rankings.data)
+async def get_work(work_queue):
+    while True:
+        try:
+            work = await anyio.to_thread.run_sync(
+                work_queue.get, True, WORK_QUEUE_POLL_INTERVAL
+            )
+            break
+        except queue.Empty:
+            await anyio.sleep(0)
 
-                    log_lock.acquire()
-                    log_file = open(RANKING_LOG, "a", encoding="utf-8")
-                    print_and_log(
-                        "Have %d out of %d for category %d for %s (%d out of %d)"
-                        % (
-                            num_ranks_seen,
-                            rankings.total,
-                            category,
-                            game["name"].replace("\n", " "),
-                            i,
-                            len(nex_wiiu_games),
-                        ),
-                        log_file,
-                    )
-                    log_file.close()
-                    log_lock.release()
-                except RMCError as e:
-                    log_lock.acquire()
-                    log_file = open(RANKING_LOG, "a", encoding="utf-8")
-                    print_and_log(
-                        "Have %d and RMCError with %s at category %d: %s"
-                        % (
-                            num_ranks_seen,
-                            game["name"].replace("\n", " "),
-                            category,
-                            "".join(
-                                traceback.TracebackException.from_exception(e).format()
-                            ),
-                        ),
-                        log_file,
-                    )
-                    log_file.close()
-                    log_lock.release()
-                    break
-                except Exception as e:
-                    # Protocol is likely incorrect
-                    log_lock.acquire()
-                    log_file = open(RANKING_LOG, "a", encoding="utf-8")
-                    print_and_log(
-                        "Have %d and issue with %s at category %d: %s"
-                        % (
-                            num_ranks_seen,
-                            game["name"].replace("\n", " "),
-                            category,
-                            "".join(
-                                traceback.TracebackException.from_exception(e).format()
-                            ),
-                        ),
-                        log_file,
-                    )
-                    log_file.close()
-                    log_lock.release()
-                    break
+    if work is None:
+        work_queue.put(None)
+    return work
 
-        con.close()
 
-    anyio.run(main)
+def finish_work(work_queue):
+    work_queue.put(None)
 
 
 def get_datastore_data(
-    log_lock,
+    log_queue,
+    write_queue,
     access_key,
     nex_version,
     host,
@@ -626,122 +2199,66 @@ def get_datastore_data(
     password,
     pretty_game_id,
     metas_queue,
-    done_flag,
-    auth_info=None,
+    worker_auth=None,
 ):
+    log_file = QueuedLog(log_queue)
+    METRICS_GAME.set(pretty_game_id)
+
     async def run():
+        auth_info = None
+        if worker_auth is not None:
+            auth_info = await TOKEN_MANAGER.get_worker_auth_info(worker_auth)
+
         s = settings.default()
         s.configure(access_key, nex_version)
 
-        con = sqlite3.connect(DATASTORE_DB, timeout=3600)
+        con = QueuedConnection(write_queue)
 
         try:
+            async with DatastoreDownloader(
+                con,
+                log_file,
+                s,
+                host,
+                port,
+                pid,
+                password,
+                pretty_game_id,
+                auth_info=auth_info,
+            ) as downloader:
+                while True:
+                    entries = await get_work(metas_queue)
+                    if entries is None:
+                        break
 
-            while True:
-                time.sleep(0.5)
-
-                try:
-                    entries = metas_queue.get(block=False)
-
-                    log_lock.acquire()
-                    log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
                     print_and_log(
                         "Start download of %d entries" % len(entries), log_file
                     )
-                    log_file.close()
-                    log_lock.release()
-
-                    for entry in entries:
-                        try:
-                            data_id, owner_id = entry
-
-                            log_lock.acquire()
-                            log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
-                            print_and_log("Start %d" % data_id, log_file)
-                            log_file.close()
-                            log_lock.release()
-
-                            start = time.perf_counter()
-
-                            async def get_req_info(client):
-                                store = datastore.DataStoreClient(client)
-
-                                get_param = datastore.DataStorePrepareGetParam()
-                                get_param.data_id = data_id
-
-                                req_info = await store.prepare_get_object(get_param)
-                                headers = {
-                                    header.key: header.value
-                                    for header in req_info.headers
-                                }
-
-                                return (req_info.url, req_info, headers)
-
-                            url, req_info, headers = await retry_if_rmc_error(
-                                get_req_info,
-                                s,
-                                host,
-                                port,
-                                str(pid),
-                                password,
-                                auth_info=auth_info,
-                            )
 
-                            async with httpx.AsyncClient() as client:
-                                response = await client.get(
-                                    "https://%s" % req_info.url,
-                                    headers=headers,
-                                    timeout=(60 * 10),
-                                )
-
-                            # TODO store the headers too
-                            con.execute(
-                                "INSERT INTO datastore_data (game, data_id, url, data) values (?, ?, ?, ?)",
-                                (
-                                    pretty_game_id,
-                                    data_id,
-                                    url,
-                                    gzip.compress(response.content),
-                                ),
-                            )
-                            con.commit()
+                    def on_error(data_id, e):
+                        print(e)
+                        con.execute(
+                            "INSERT OR IGNORE INTO datastore_data (game, data_id, error) values (?, ?, ?)",
+                            (pretty_game_id, data_id, str(e)),
+                        )
+                        con.commit()
+                        return False
 
-                            log_lock.acquire()
-                            log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
-                            print_and_log(
-                                "Downloaded %d in %f seconds"
-                                % (data_id, time.perf_counter() - start),
-                                log_file,
-                            )
-                            log_file.close()
-                            log_lock.release()
-
-                        except RMCError as e:
-                            print(e)
-                            con.execute(
-                                "INSERT INTO datastore_data (game, data_id, error) values (?, ?, ?)",
-                                (pretty_game_id, data_id, str(e)),
-                            )
-                            con.commit()
-                        except httpx.TimeoutException as e:
-                            print(e)
-                            con.execute(
-                                "INSERT INTO datastore_data (game, data_id, error) values (?, ?, ?)",
-                                (pretty_game_id, data_id, str(e)),
-                            )
-                            con.commit()
-                except queue.Empty:
-                    if bool(done_flag.value):
-                        break
+                    await downloader.put(entries, on_error)
         except Exception as e:
             print(e)
 
         con.close()
 
-    anyio.run(run)
+    try:
+        anyio.run(run_with_session_pool, lambda: run_with_token_manager(run))
+    finally:
+        # The flush thread dies with the process, send what it has not
+        METRICS.send(log_queue, block=True)
 
 def get_datastore_data_and_metas(
-    log_lock,
+    log_queue,
+    write_queue,
     access_key,
     nex_version,
     host,
@@ -750,31 +2267,45 @@ def get_datastore_data_and_metas(
     password,
     pretty_game_id,
     metas_queue,
-    done_flag,
     s,
-    auth_info=None,
+    worker_auth=None,
 ):
-    async def run():
-        con = sqlite3.connect(DATASTORE_DB, timeout=3600)
+    log_file = QueuedLog(log_queue)
+    METRICS_GAME.set(pretty_game_id)
 
-        try:
+    async def run():
+        auth_info = None
+        if worker_auth is not None:
+            auth_info = await TOKEN_MANAGER.get_worker_auth_info(worker_auth)
 
-            while True:
-                time.sleep(0.5)
+        con = QueuedConnection(write_queue)
 
-                can_download_metas = True
+        try:
+            async with DatastoreDownloader(
+                con,
+                log_file,
+                s,
+                host,
+                port,
+                pid,
+                password,
+                pretty_game_id,
+                auth_info=auth_info,
+            ) as downloader:
+                # Set by on_error while an earlier batch is transferred, so it
+                # is kept for every batch after that one
                 can_download_objects = True
 
-                try:
-                    entries = metas_queue.get(block=False)
+                while True:
+                    entries = await get_work(metas_queue)
+                    if entries is None:
+                        break
+
+                    can_download_metas = True
 
-                    log_lock.acquire()
-                    log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
                     print_and_log(
                         "Start download of %d entries" % len(entries), log_file
                     )
-                    log_file.close()
-                    log_lock.release()
 
                     download_entries = None
                     try:
@@ -799,7 +2330,7 @@ def get_datastore_data_and_metas(
                         ]
 
                         con.executemany(
-                            "INSERT INTO datastore_meta (game, data_id, owner_id, size, name, data_type, meta_binary, permission, delete_permission, create_time, update_time, period, status, referred_count, refer_data_id, flag, referred_time, expire_time) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            "INSERT OR REPLACE INTO datastore_meta (game, data_id, owner_id, size, name, data_type, meta_binary, permission, delete_permission, create_time, update_time, period, status, referred_count, refer_data_id, flag, referred_time, expire_time) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
                             [
                                 (
                                     pretty_game_id,
@@ -825,7 +2356,7 @@ def get_datastore_data_and_metas(
                             ],
                         )
                         con.executemany(
-                            "INSERT INTO datastore_meta_tag (game, data_id, tag) values (?, ?, ?)",
+                            "INSERT OR IGNORE INTO datastore_meta_tag (game, data_id, tag) values (?, ?, ?)",
                             [
                                 (pretty_game_id, entry.data_id, tag)
                                 for entry in meta_entries
@@ -833,7 +2364,7 @@ def get_datastore_data_and_metas(
                             ],
                         )
                         con.executemany(
-                            "INSERT INTO datastore_meta_rating (game, data_id, slot, total_value, count, initial_value) values (?, ?, ?, ?, ?, ?)",
+                            "INSERT OR REPLACE INTO datastore_meta_rating (game, data_id, slot, total_value, count, initial_value) values (?, ?, ?, ?, ?, ?)",
                             [
                                 (
                                     pretty_game_id,
@@ -848,7 +2379,7 @@ def get_datastore_data_and_metas(
                             ],
                         )
                         con.executemany(
-                            "INSERT INTO datastore_permission_recipients (game, data_id, is_delete, recipient) values (?, ?, ?, ?)",
+                            "INSERT OR IGNORE INTO datastore_permission_recipients (game, data_id, is_delete, recipient) values (?, ?, ?, ?)",
                             [
                                 (pretty_game_id, entry.data_id, 0, str(recipient))
                                 for entry in meta_entries
@@ -856,7 +2387,7 @@ def get_datastore_data_and_metas(
                             ],
                         )
                         con.executemany(
-                            "INSERT INTO datastore_permission_recipients (game, data_id, is_delete, recipient) values (?, ?, ?, ?)",
+                            "INSERT OR IGNORE INTO datastore_permission_recipients (game, data_id, is_delete, recipient) values (?, ?, ?, ?)",
                             [
                                 (pretty_game_id, entry.data_id, 1, str(recipient))
                                 for entry in meta_entries
@@ -865,111 +2396,57 @@ def get_datastore_data_and_metas(
                         )
                         con.commit()
 
-                        download_entries = [(entry.data_id, 0) for entry in meta_entries if entry.size > 0]
-                    except RMCError as e:
-                        log_lock.acquire()
-                        log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
-                        print_and_log("This game doesn't seem to support get_metas: %s" % str(e), log_file)
-                        log_file.close()
-                        log_lock.release()
-
-                        download_entries = entries
-                        can_download_metas = False
-
-                    if len(download_entries) == 0:
-                        can_download_metas = False
-                        can_download_objects = False
-
-                    for entry in download_entries:
-                        try:
-                            data_id, owner_id = entry
-
-                            log_lock.acquire()
-                            log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
-                            print_and_log("Start %d" % data_id, log_file)
-                            log_file.close()
-                            log_lock.release()
-
-                            start = time.perf_counter()
-
-                            async def get_req_info(client):
-                                store = datastore.DataStoreClient(client)
-
-                                get_param = datastore.DataStorePrepareGetParam()
-                                get_param.data_id = data_id
-
-                                req_info = await store.prepare_get_object(get_param)
-                                headers = {
-                                    header.key: header.value
-                                    for header in req_info.headers
-                                }
-
-                                return (req_info.url, req_info, headers)
+                        download_entries = [(entry.data_id, 0) for entry in meta_entries if entry.size > 0]
+                    except RMCRetriesExhausted as e:
+                        print_and_log("Could not get metas: %s" % str(e), log_file)
+                        continue
+                    except RMCError as e:
+                        print_and_log("This game doesn't seem to support get_metas: %s" % str(e), log_file)
 
-                            url, req_info, headers = await retry_if_rmc_error(
-                                get_req_info,
-                                s,
-                                host,
-                                port,
-                                str(pid),
-                                password,
-                                auth_info=auth_info,
-                            )
+                        download_entries = entries
+                        can_download_metas = False
 
-                            async with httpx.AsyncClient() as client:
-                                response = await client.get(
-                                    "https://%s" % req_info.url,
-                                    headers=headers,
-                                    timeout=(60 * 10),
-                                )
+                    if len(download_entries) == 0:
+                        can_download_metas = False
+                        can_download_objects = False
 
-                            # TODO store the headers too
-                            con.execute(
-                                "INSERT INTO datastore_data (game, data_id, url, data) values (?, ?, ?, ?)",
-                                (
-                                    pretty_game_id,
-                                    data_id,
-                                    url,
-                                    gzip.compress(response.content),
-                                ),
-                            )
-                            con.commit()
+                    def on_error(data_id, e):
+                        nonlocal can_download_objects
 
-                            log_lock.acquire()
-                            log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
+                        if not isinstance(e, RMCError) or isinstance(
+                            e, RMCRetriesExhausted
+                        ):
                             print_and_log(
-                                "Downloaded %d in %f seconds"
-                                % (data_id, time.perf_counter() - start),
+                                "Could not download %d: %s" % (data_id, str(e)),
                                 log_file,
                             )
-                            log_file.close()
-                            log_lock.release()
+                            return False
 
-                        except RMCError as e:
-                            log_lock.acquire()
-                            log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
-                            print_and_log("This game doesn't seem to support prepare_get_object: %s" % str(e), log_file)
-                            log_file.close()
-                            log_lock.release()
+                        print_and_log("This game doesn't seem to support prepare_get_object: %s" % str(e), log_file)
 
-                            can_download_objects = False
-                            break
-                except queue.Empty:
-                    if bool(done_flag.value):
-                        break
+                        can_download_objects = False
+                        return True
 
-                if not can_download_metas and not can_download_objects:
-                    break
+                    if can_download_objects:
+                        await downloader.put(download_entries, on_error)
+
+                    if not can_download_metas and not can_download_objects:
+                        break
         except Exception as e:
             print(e)
 
         con.close()
 
-    anyio.run(run)
+    try:
+        anyio.run(run_with_session_pool, lambda: run_with_token_manager(run))
+    finally:
+        # The flush thread dies with the process, send what it has not
+        METRICS.send(log_queue, block=True)
 
 
 def get_datastore_metas(
-    log_lock,
+    log_queue,
+    write_queue,
     access_key,
     nex_version,
     host,
@@ -978,21 +2455,26 @@ def get_datastore_metas(
     password,
     pretty_game_id,
     metas_queue,
-    done_flag,
     process_index,
     total_num_processes,
     max_queryable,
     last_data_id,
     late_data_id,
-    num_metas_threads_done,
-    auth_info=None,
+    worker_auth=None,
 ):
+    log_file = QueuedLog(log_queue)
+    METRICS_GAME.set(pretty_game_id)
+
     async def run():
+        auth_info = None
+        if worker_auth is not None:
+            auth_info = await TOKEN_MANAGER.get_worker_auth_info(worker_auth)
+
         try:
             s = settings.default()
             s.configure(access_key, nex_version)
 
-            con = sqlite3.connect(DATASTORE_DB, timeout=3600)
+            con = QueuedConnection(write_queue)
 
             # Start at offset
             nonlocal last_data_id
@@ -1000,11 +2482,7 @@ def get_datastore_metas(
             have_seen_late_data_id = False
 
             while True:
-                log_lock.acquire()
-                log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
                 print_and_log("Starting at %d" % last_data_id, log_file)
-                log_file.close()
-                log_lock.release()
 
                 async def get_res(client):
                     store = datastore.DataStoreClient(client)
@@ -1035,24 +2513,16 @@ def get_datastore_metas(
                 if len(entries) == 0:
                     if have_seen_late_data_id:
                         # End here
-                        done_flag.value = True
-
-                        log_lock.acquire()
-                        log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
                         print_and_log(
                             "Finished with metas for process %d" % process_index,
                             log_file,
                         )
-                        log_file.close()
-                        log_lock.release()
                         break
                 else:
                     start_timestamp = common.DateTime.fromtimestamp(
                         entries[-1].create_time.timestamp() - 1
                     ).value()
 
-                    log_lock.acquire()
-                    log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
                     print_and_log(
                         "Num entries raw %d Num entries filtered %d Last time %s"
                         % (
@@ -1062,8 +2532,6 @@ def get_datastore_metas(
                         ),
                         log_file,
                     )
-                    log_file.close()
-                    log_lock.release()
 
                     # Send these metas off to a open process
                     metas_to_send = [
@@ -1074,7 +2542,7 @@ def get_datastore_metas(
                     metas_queue.put(metas_to_send)
 
                     con.executemany(
-                        "INSERT INTO datastore_meta (game, data_id, owner_id, size, name, data_type, meta_binary, permission, delete_permission, create_time, update_time, period, status, referred_count, refer_data_id, flag, referred_time, expire_time) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        "INSERT OR REPLACE INTO datastore_meta (game, data_id, owner_id, size, name, data_type, meta_binary, permission, delete_permission, create_time, update_time, period, status, referred_count, refer_data_id, flag, referred_time, expire_time) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
                         [
                             (
                                 pretty_game_id,
@@ -1100,7 +2568,7 @@ def get_datastore_metas(
                         ],
                     )
                     con.executemany(
-                        "INSERT INTO datastore_meta_tag (game, data_id, tag) values (?, ?, ?)",
+                        "INSERT OR IGNORE INTO datastore_meta_tag (game, data_id, tag) values (?, ?, ?)",
                         [
                             (pretty_game_id, entry.data_id, tag)
                             for entry in entries
@@ -1108,7 +2576,7 @@ def get_datastore_metas(
                         ],
                     )
                     con.executemany(
-                        "INSERT INTO datastore_meta_rating (game, data_id, slot, total_value, count, initial_value) values (?, ?, ?, ?, ?, ?)",
+                        "INSERT OR REPLACE INTO datastore_meta_rating (game, data_id, slot, total_value, count, initial_value) values (?, ?, ?, ?, ?, ?)",
                         [
                             (
                                 pretty_game_id,
@@ -1123,7 +2591,7 @@ def get_datastore_metas(
                         ],
                     )
                     con.executemany(
-                        "INSERT INTO datastore_permission_recipients (game, data_id, is_delete, recipient) values (?, ?, ?, ?)",
+                        "INSERT OR IGNORE INTO datastore_permission_recipients (game, data_id, is_delete, recipient) values (?, ?, ?, ?)",
                         [
                             (pretty_game_id, entry.data_id, 0, str(recipient))
                             for entry in entries
@@ -1131,7 +2599,7 @@ def get_datastore_metas(
                         ],
                     )
                     con.executemany(
-                        "INSERT INTO datastore_permission_recipients (game, data_id, is_delete, recipient) values (?, ?, ?, ?)",
+                        "INSERT OR IGNORE INTO datastore_permission_recipients (game, data_id, is_delete, recipient) values (?, ?, ?, ?)",
                         [
                             (pretty_game_id, entry.data_id, 1, str(recipient))
                             for entry in entries
@@ -1141,19 +2609,20 @@ def get_datastore_metas(
                     con.commit()
 
                 last_data_id += max_queryable * total_num_processes
-
-            num_metas_threads_done.value += 1
-            if num_metas_threads_done.value == total_num_processes:
-                done_flag.value = True
         except Exception as e:
             print("".join(traceback.TracebackException.from_exception(e).format()))
 
         con.close()
 
-    anyio.run(run)
+    try:
+        anyio.run(run_with_session_pool, lambda: run_with_token_manager(run))
+    finally:
+        # The flush thread dies with the process, send what it has not
+        METRICS.send(log_queue, block=True)
 
 def get_datastore_metas_pids(
-    log_lock,
+    log_queue,
+    write_queue,
     access_key,
     nex_version,
     host,
@@ -1163,26 +2632,36 @@ def get_datastore_metas_pids(
     pretty_game_id,
     pids_queue,
     s,
-    auth_info=None,
+    worker_auth=None,
 ):
-    async def run():
-        con = sqlite3.connect(DATASTORE_DB, timeout=3600)
+    log_file = QueuedLog(log_queue)
+    METRICS_GAME.set(pretty_game_id)
 
-        try:
+    async def run():
+        auth_info = None
+        if worker_auth is not None:
+            auth_info = await TOKEN_MANAGER.get_worker_auth_info(worker_auth)
 
-            while True:
-                time.sleep(0.5)
+        con = QueuedConnection(write_queue)
 
-                try:
-                    pids = pids_queue.get(block=False)
+        try:
+            async with DatastoreDownloader(
+                con,
+                log_file,
+                s,
+                host,
+                port,
+                pid,
+                password,
+                pretty_game_id,
+                auth_info=auth_info,
+            ) as downloader:
+                while True:
+                    pids = await get_work(pids_queue)
+                    if pids is None:
+                        break
 
-                    log_lock.acquire()
-                    log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
-                    print_and_log(
-                        "Start download of %d pids" % len(pids), log_file
-                    )
-                    log_file.close()
-                    log_lock.release()
+                    print_and_log("Start download of %d pids" % len(pids), log_file)
 
                     download_entries = None
                     try:
@@ -1213,7 +2692,7 @@ def get_datastore_metas_pids(
                         ]
 
                         con.executemany(
-                            "INSERT INTO datastore_persistent (game, owner_id, persistence_id, data_id) values (?, ?, ?, ?)",
+                            "INSERT OR REPLACE INTO datastore_persistent (game, owner_id, persistence_id, data_id) values (?, ?, ?, ?)",
                             [
                                 (
                                     pretty_game_id,
@@ -1225,7 +2704,7 @@ def get_datastore_metas_pids(
                             ],
                         )
                         con.executemany(
-                            "INSERT INTO datastore_meta (game, data_id, owner_id, size, name, data_type, meta_binary, permission, delete_permission, create_time, update_time, period, status, referred_count, refer_data_id, flag, referred_time, expire_time) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            "INSERT OR REPLACE INTO datastore_meta (game, data_id, owner_id, size, name, data_type, meta_binary, permission, delete_permission, create_time, update_time, period, status, referred_count, refer_data_id, flag, referred_time, expire_time) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
                             [
                                 (
                                     pretty_game_id,
@@ -1251,7 +2730,7 @@ def get_datastore_metas_pids(
                             ],
                         )
                         con.executemany(
-                            "INSERT INTO datastore_meta_tag (game, data_id, tag) values (?, ?, ?)",
+                            "INSERT OR IGNORE INTO datastore_meta_tag (game, data_id, tag) values (?, ?, ?)",
                             [
                                 (pretty_game_id, entry[0].data_id, tag)
                                 for entry in meta_entries
@@ -1259,7 +2738,7 @@ def get_datastore_metas_pids(
                             ],
                         )
                         con.executemany(
-                            "INSERT INTO datastore_meta_rating (game, data_id, slot, total_value, count, initial_value) values (?, ?, ?, ?, ?, ?)",
+                            "INSERT OR REPLACE INTO datastore_meta_rating (game, data_id, slot, total_value, count, initial_value) values (?, ?, ?, ?, ?, ?)",
                             [
                                 (
                                     pretty_game_id,
@@ -1274,7 +2753,7 @@ def get_datastore_metas_pids(
                             ],
                         )
                         con.executemany(
-                            "INSERT INTO datastore_permission_recipients (game, data_id, is_delete, recipient) values (?, ?, ?, ?)",
+                            "INSERT OR IGNORE INTO datastore_permission_recipients (game, data_id, is_delete, recipient) values (?, ?, ?, ?)",
                             [
                                 (pretty_game_id, entry[0].data_id, 0, str(recipient))
                                 for entry in meta_entries
@@ -1282,7 +2761,7 @@ def get_datastore_metas_pids(
                             ],
                         )
                         con.executemany(
-                            "INSERT INTO datastore_permission_recipients (game, data_id, is_delete, recipient) values (?, ?, ?, ?)",
+                            "INSERT OR IGNORE INTO datastore_permission_recipients (game, data_id, is_delete, recipient) values (?, ?, ?, ?)",
                             [
                                 (pretty_game_id, entry[0].data_id, 1, str(recipient))
                                 for entry in meta_entries
@@ -1291,106 +2770,1174 @@ def get_datastore_metas_pids(
                         )
                         con.commit()
 
-                        download_entries = [(entry[0].data_id, 0) for entry in meta_entries if entry[0].size > 0]
-                    except RMCError as e:
-                        log_lock.acquire()
-                        log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
-                        print_and_log("Small issue: %s" % str(e), log_file)
-                        log_file.close()
-                        log_lock.release()
+                        download_entries = [(entry[0].data_id, 0) for entry in meta_entries if entry[0].size > 0]
+                    except RMCError as e:
+                        print_and_log("Small issue: %s" % str(e), log_file)
+                        continue
+
+                    def on_error(data_id, e):
+                        print_and_log("Small issue: %s" % str(e), log_file)
+                        return False
+
+                    await downloader.put(download_entries, on_error)
+        except Exception as e:
+            print("".join(traceback.TracebackException.from_exception(e).format()))
+
+        con.close()
+
+    try:
+        anyio.run(run_with_session_pool, lambda: run_with_token_manager(run))
+    finally:
+        # The flush thread dies with the process, send what it has not
+        METRICS.send(log_queue, block=True)
+
+
+# Counters and latency histograms labelled by game, mode and RMC method. Every
+# process keeps its own and sends what changed to the main process alongside
+# its log events, where they are summed and served in Prometheus text format
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_FILE = os.getenv("METRICS_FILE")
+METRICS_FLUSH_SECONDS = 5
+METRICS_LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Game the current task is working on, used as the game label
+METRICS_GAME = contextvars.ContextVar("metrics_game", default="")
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.flushing = False
+        self.send_lock = threading.Lock()
+
+    def labels(self, labels):
+        labels = dict(labels)
+        labels.setdefault("game", METRICS_GAME.get())
+        labels.setdefault("mode", sys.argv[1])
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, self.labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, self.labels(labels))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [0] * (len(METRICS_LATENCY_BUCKETS) + 2)
+            histogram = self.histograms[key]
+
+            for j, bound in enumerate(METRICS_LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram[j] += 1
+                    break
+            else:
+                histogram[len(METRICS_LATENCY_BUCKETS)] += 1
+            histogram[-1] += seconds
+
+    # Everything recorded since the last call
+    def take(self):
+        with self.lock:
+            delta = (self.counters, self.histograms)
+            self.counters = {}
+            self.histograms = {}
+        return delta
+
+    def merge(self, delta):
+        counters, histograms = delta
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, values in histograms.items():
+                if key not in self.histograms:
+                    self.histograms[key] = [0] * len(values)
+                for j, value in enumerate(values):
+                    self.histograms[key][j] += value
+
+    # Sends everything recorded since the last send to the log sink. A full
+    # queue keeps the delta for next time unless block is set
+    def send(self, log_queue, block=False):
+        with self.send_lock:
+            delta = self.take()
+            if not delta[0] and not delta[1]:
+                return
+
+            try:
+                log_queue.put({"metrics": delta}, block)
+            except queue.Full:
+                self.merge(delta)
+
+    # Sends the deltas to the log sink every METRICS_FLUSH_SECONDS, once per process.
+    # Worker processes send the rest themselves before exiting
+    def start_flushing(self, log_queue):
+        with self.lock:
+            if self.flushing:
+                return
+            self.flushing = True
+
+        def run():
+            while True:
+                time.sleep(METRICS_FLUSH_SECONDS)
+                self.send(log_queue)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def prometheus(self):
+        def format_labels(labels, extra=()):
+            return ",".join(
+                '%s="%s"' % (label, str(value).replace('"', '\\"'))
+                for label, value in labels + extra
+            )
+
+        lines = []
+        with self.lock:
+            for name in sorted(set(name for name, _ in self.counters)):
+                lines.append("# TYPE scraper_%s counter" % name)
+                for (other, labels), value in sorted(self.counters.items()):
+                    if other == name:
+                        lines.append(
+                            "scraper_%s{%s} %s" % (name, format_labels(labels), value)
+                        )
+
+            for name in sorted(set(name for name, _ in self.histograms)):
+                lines.append("# TYPE scraper_%s histogram" % name)
+                for (other, labels), histogram in sorted(self.histograms.items()):
+                    if other != name:
+                        continue
+
+                    total = 0
+                    for bound, count in zip(
+                        METRICS_LATENCY_BUCKETS + ("+Inf",), histogram
+                    ):
+                        total += count
+                        lines.append(
+                            "scraper_%s_bucket{%s} %d"
+                            % (name, format_labels(labels, (("le", bound),)), total)
+                        )
+                    lines.append(
+                        "scraper_%s_sum{%s} %f"
+                        % (name, format_labels(labels), histogram[-1])
+                    )
+                    lines.append(
+                        "scraper_%s_count{%s} %d" % (name, format_labels(labels), total)
+                    )
+
+        return "\n".join(lines) + "\n"
+
+
+# What this process records
+METRICS = Metrics()
+# Sum over every process, only filled in the main process
+METRICS_TOTALS = Metrics()
+METRICS_SERVER = None
+
+
+def serve_metrics():
+    global METRICS_SERVER
+    if METRICS_PORT == 0 or METRICS_SERVER is not None:
+        return
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = METRICS_TOTALS.prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            None
+
+    METRICS_SERVER = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", METRICS_PORT), Handler
+    )
+    threading.Thread(target=METRICS_SERVER.serve_forever, daemon=True).start()
+
+
+def write_metrics_file():
+    with open(METRICS_FILE + ".tmp", "w", encoding="utf-8") as f:
+        f.write(METRICS_TOTALS.prometheus())
+    os.replace(METRICS_FILE + ".tmp", METRICS_FILE)
+
+
+# Every RMC request is timed, named after the METHOD_ constant of its protocol
+RMC_METHOD_NAMES = {}
+for protocol_client in (
+    ranking.RankingClient,
+    datastore.DataStoreClient,
+    authentication.AuthenticationClient,
+    secure.SecureConnectionClient,
+):
+    for attr in dir(protocol_client):
+        if attr.startswith("METHOD_"):
+            RMC_METHOD_NAMES[
+                (protocol_client.PROTOCOL_ID, getattr(protocol_client, attr))
+            ] = attr[len("METHOD_") :].lower()
+
+original_RMCClient_request = rmc.RMCClient.request
+
+
+async def new_RMCClient_request(self, protocol, method, body, noresponse=False):
+    name = RMC_METHOD_NAMES.get((protocol, method), "%d_%d" % (protocol, method))
+    start = time.perf_counter()
+    try:
+        return await original_RMCClient_request(
+            self, protocol, method, body, noresponse
+        )
+    except Exception:
+        METRICS.inc("rmc_errors_total", method=name)
+        raise
+    finally:
+        METRICS.observe("rmc_request_seconds", time.perf_counter() - start, method=name)
+
+
+rmc.RMCClient.request = new_RMCClient_request
+
+
+# Downloads an object from the URL prepare_get_object handed out
+async def get_object_data(url, headers):
+    start = time.perf_counter()
+    try:
+        if HTTP_CLIENT_POOL is None:
+            async with httpx.AsyncClient() as client:
+                response = await client.get(
+                    "https://%s" % url,
+                    headers=headers,
+                    timeout=HTTP_TIMEOUT,
+                )
+        else:
+            response = await HTTP_CLIENT_POOL.get("https://%s" % url, headers)
+    except Exception:
+        METRICS.inc("s3_get_errors_total")
+        raise
+    finally:
+        METRICS.observe("s3_get_seconds", time.perf_counter() - start)
+
+    METRICS.inc("s3_get_total", status=response.status_code)
+    METRICS.inc("s3_get_bytes_total", len(response.content))
+    return response
+
+
+# Workers never touch the log file either, lines are sent as events to a
+# thread that appends them as NDJSON in batches and rotates the file
+LOG_BATCH_EVENTS = 1000
+LOG_BATCH_SECONDS = 1
+LOG_ROTATE_BYTES = 256 * 1024 * 1024
+LOG_ROTATE_KEEP = 10
+
+
+class LogSink:
+    def __init__(self, path):
+        self.path = path
+        self.queue = Queue(100000)
+        self.thread = None
+
+    def start(self):
+        serve_metrics()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        log_file = open(self.path, "a", encoding="utf-8")
+
+        batch = []
+        batch_start = None
+        last_metrics_write = time.perf_counter()
+
+        while True:
+            if batch:
+                timeout = max(0, batch_start + LOG_BATCH_SECONDS - time.perf_counter())
+            elif METRICS_FILE:
+                timeout = METRICS_FLUSH_SECONDS
+            else:
+                timeout = None
+
+            try:
+                event = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                event = {}
+
+            if event and "metrics" in event:
+                METRICS_TOTALS.merge(event["metrics"])
+                event = {}
+
+            if METRICS_FILE and time.perf_counter() - last_metrics_write >= (
+                METRICS_FLUSH_SECONDS
+            ):
+                write_metrics_file()
+                last_metrics_write = time.perf_counter()
+
+            if event:
+                if not batch:
+                    batch_start = time.perf_counter()
+                batch.append(json.dumps(event))
+
+            if batch and (
+                event is None
+                or len(batch) >= LOG_BATCH_EVENTS
+                or time.perf_counter() - batch_start >= LOG_BATCH_SECONDS
+            ):
+                log_file.write("\n".join(batch) + "\n")
+                log_file.flush()
+                batch = []
+
+                if log_file.tell() >= LOG_ROTATE_BYTES:
+                    log_file.close()
+                    self.rotate()
+                    log_file = open(self.path, "a", encoding="utf-8")
+
+            if event is None:
+                break
+
+        if METRICS_FILE:
+            METRICS_TOTALS.merge(METRICS.take())
+            write_metrics_file()
+        log_file.close()
+
+    # path becomes path.1, path.1 becomes path.2 and so on
+    def rotate(self):
+        for j in range(LOG_ROTATE_KEEP - 1, 0, -1):
+            if os.path.exists("%s.%d" % (self.path, j)):
+                os.replace("%s.%d" % (self.path, j), "%s.%d" % (self.path, j + 1))
+        os.replace(self.path, "%s.1" % self.path)
+
+
+# Stands in for a log file inside workers, every line written becomes an
+# event on the sink's queue. A full queue drops the line rather than block
+class QueuedLog:
+    def __init__(self, log_queue):
+        self.log_queue = log_queue
+        METRICS.start_flushing(log_queue)
+
+    def write(self, text):
+        try:
+            self.log_queue.put_nowait(
+                {
+                    "time": time.time(),
+                    "process": os.getpid(),
+                    "message": text.rstrip("\n"),
+                }
+            )
+        except queue.Full:
+            None
+
+    def flush(self):
+        None
+
+    def close(self):
+        None
+
+
+# Scrapers never write to SQLite themselves, instead a single writer thread
+# groups their rows into large transactions
+WRITER_BATCH_ROWS = 5000
+WRITER_BATCH_SECONDS = 2
+WRITER_REPORT_SECONDS = 60
+# Units a QueuedConnection holds on to while the writer queue is full before
+# commit() starts waiting for room
+QUEUED_CONNECTION_MAX_PENDING = 1000
+
+
+class SQLiteWriter:
+    def __init__(self, path, log_queue):
+        self.path = path
+        self.log_queue = log_queue
+        self.queue = Queue(10000)
+        self.thread = None
+        self.condition = threading.Condition()
+        self.flush_requested = 0
+        self.flushed = 0
+        self.error = None
+
+        self.rows_written = 0
+        self.transactions = 0
+        self.lock_wait = 0
+        self.start_time = None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.put(None)
+        self.thread.join()
+        self.raise_if_failed()
+
+    # Blocks until everything queued before this call is committed
+    def flush(self):
+        with self.condition:
+            self.flush_requested += 1
+            token = self.flush_requested
+
+        self.put(token)
+
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.flushed >= token or self.error is not None
+            )
+        self.raise_if_failed()
+
+    # Never waits on a queue nobody is reading anymore
+    def put(self, item):
+        while True:
+            self.raise_if_failed()
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def raise_if_failed(self):
+        if self.error is not None:
+            raise RuntimeError("SQLite writer failed: %s" % self.error)
+
+    def run(self):
+        try:
+            self.write_all()
+        except Exception as e:
+            print(
+                "SQLite writer failed: %s"
+                % "".join(traceback.TracebackException.from_exception(e).format())
+            )
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+
+    def write_all(self):
+        con = sqlite3.connect(self.path, timeout=3600, isolation_level=None)
+        configure_sqlite(con, writer=True)
+        log_file = QueuedLog(self.log_queue)
+
+        batch = []
+        batch_rows = 0
+        batch_start = None
+        last_report = time.perf_counter()
+
+        while True:
+            if batch:
+                timeout = max(
+                    0, batch_start + WRITER_BATCH_SECONDS - time.perf_counter()
+                )
+            else:
+                timeout = WRITER_REPORT_SECONDS
+
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = []
+
+            if isinstance(item, list) and len(item) > 0:
+                if not batch:
+                    batch_start = time.perf_counter()
+                batch.append(item)
+                batch_rows += sum(len(rows) for _, rows in item)
+
+            if batch and (
+                not isinstance(item, list)
+                or batch_rows >= WRITER_BATCH_ROWS
+                or time.perf_counter() - batch_start >= WRITER_BATCH_SECONDS
+            ):
+                self.write_batch(con, batch, log_file)
+                batch = []
+                batch_rows = 0
+
+            if isinstance(item, int):
+                with self.condition:
+                    self.flushed = item
+                    self.condition.notify_all()
+
+            if item is None:
+                self.report(log_file)
+                break
+
+            if time.perf_counter() - last_report >= WRITER_REPORT_SECONDS:
+                self.report(log_file)
+                last_report = time.perf_counter()
+
+        con.close()
+
+    def write_batch(self, con, batch, log_file):
+        try:
+            self.write_transaction(con, batch)
+        except Exception as e:
+            # BEGIN itself can fail, then there is nothing to roll back
+            if con.in_transaction:
+                con.execute("ROLLBACK")
+            print_and_log(
+                "Writer batch failed, retrying one unit at a time: %s" % str(e),
+                log_file,
+            )
+
+            # Only lose the units that actually fail
+            for statements in batch:
+                try:
+                    self.write_transaction(con, [statements])
+                except Exception as e:
+                    if con.in_transaction:
+                        con.execute("ROLLBACK")
+                    print_and_log(
+                        "Writer dropped unit: %s"
+                        % "".join(
+                            traceback.TracebackException.from_exception(e).format()
+                        ),
+                        log_file,
+                    )
+
+    def write_transaction(self, con, batch):
+        # Time spent here is time spent waiting on other database users
+        start = time.perf_counter()
+        con.execute("BEGIN IMMEDIATE")
+        self.lock_wait += time.perf_counter() - start
+
+        num_rows = 0
+        for statements in batch:
+            for sql, rows in statements:
+                con.executemany(sql, rows)
+                num_rows += len(rows)
+        con.execute("COMMIT")
+
+        self.rows_written += num_rows
+        self.transactions += 1
+        METRICS.inc("sqlite_rows_written_total", num_rows)
+        METRICS.inc("sqlite_transactions_total")
+        METRICS.observe("sqlite_transaction_seconds", time.perf_counter() - start)
+
+    def report(self, log_file):
+        elapsed = time.perf_counter() - self.start_time
+        print_and_log(
+            "Writer committed %d rows in %d transactions (%f rows per second), waited %f seconds on the database lock"
+            % (
+                self.rows_written,
+                self.transactions,
+                self.rows_written / elapsed if elapsed > 0 else 0,
+                self.lock_wait,
+            ),
+            log_file,
+        )
+
+
+# Stands in for a sqlite3 connection inside scrapers, commit() hands everything
+# executed since the last commit to the writer as a single unit
+class QueuedConnection:
+    def __init__(self, write_queue):
+        self.write_queue = write_queue
+        self.statements = []
+        # Units waiting for room in the writer queue, kept in order
+        self.pending = []
+
+    def execute(self, sql, params=()):
+        self.statements.append((sql, [params]))
+
+    def executemany(self, sql, rows):
+        rows = list(rows)
+        if len(rows) > 0:
+            self.statements.append((sql, rows))
+
+    # Called from event loops, so only waits for the writer once
+    # QUEUED_CONNECTION_MAX_PENDING units are held back
+    def commit(self):
+        if len(self.statements) > 0:
+            self.pending.append(self.statements)
+            self.statements = []
+
+        while len(self.pending) > 0:
+            try:
+                if len(self.pending) > QUEUED_CONNECTION_MAX_PENDING:
+                    self.write_queue.put(self.pending[0])
+                else:
+                    self.write_queue.put_nowait(self.pending[0])
+            except queue.Full:
+                break
+            self.pending.pop(0)
+
+    # Hands over everything held back, waiting for room if it has to
+    def flush(self):
+        self.commit()
+        for statements in self.pending:
+            self.write_queue.put(statements)
+        self.pending = []
+
+    def close(self):
+        self.flush()
+
+
+def configure_sqlite(con, writer=False):
+    # Page size only applies to databases that don't exist yet
+    con.execute("PRAGMA page_size = %d" % SQLITE_PAGE_SIZE)
+    # WAL lets progress queries read while the writer is committing
+    con.execute("PRAGMA journal_mode = WAL")
+    if INGEST_PROFILE == "bulk":
+        con.execute("PRAGMA synchronous = OFF")
+    else:
+        con.execute("PRAGMA synchronous = NORMAL")
+    con.execute("PRAGMA mmap_size = %d" % SQLITE_MMAP_SIZE)
+    con.execute("PRAGMA temp_store = MEMORY")
+    if writer:
+        con.execute("PRAGMA cache_size = %d" % -SQLITE_CACHE_SIZE_KIB)
+
+
+# Runs a read in a worker thread so every other task on the event loop keeps
+# going meanwhile. The connection has to be opened with check_same_thread=False
+async def fetch_in_thread(con, sql, parameters=()):
+    def fetch():
+        return con.execute(sql, parameters).fetchall()
+
+    return await anyio.to_thread.run_sync(fetch)
+
+
+def create_ranking_indexes(con):
+    if get_ranking_schema(con) == "compact":
+        # The primary key of ranking_compact already orders by game and category
+        return
+
+    con.execute(
+        """CREATE INDEX IF NOT EXISTS idx_ranking_game_category ON ranking (game, category)"""
+    )
+    con.execute("""CREATE INDEX IF NOT EXISTS idx_ranking_rank ON ranking (rank)""")
+    con.commit()
+
+
+def build_deferred_ranking_indexes(writer):
+    # Everything from the run has to be in the table first
+    writer.flush()
+
+    con = sqlite3.connect(RANKING_DB, timeout=3600)
+    configure_sqlite(con, writer=True)
+    create_ranking_indexes(con)
+    con.close()
+
+
+# Natural key of every table, a row with the same key is the same row seen again
+RANKING_UNIQUE_KEYS = {
+    "ranking": ("game", "category", "rank"),
+    "ranking_group": ("game", "category", "rank", "ranking_index"),
+    "ranking_meta": ("game", "category", "rank"),
+    "ranking_param_data": ("game", "category", "rank"),
+}
+DATASTORE_UNIQUE_KEYS = {
+    "datastore_meta": ("game", "data_id"),
+    "datastore_meta_tag": ("game", "data_id", "tag"),
+    "datastore_meta_rating": ("game", "data_id", "slot"),
+    "datastore_data": ("game", "data_id"),
+    "datastore_permission_recipients": ("game", "data_id", "is_delete", "recipient"),
+    "datastore_persistent": ("game", "owner_id", "persistence_id"),
+}
+
+
+# Puts a unique index on the natural key of every table that exists. Archives
+# written before these indexes hold duplicates, those are removed once first
+def create_unique_indexes(con, unique_keys):
+    tables = set(
+        row[0]
+        for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    )
+
+    for table, key in unique_keys.items():
+        if table not in tables:
+            continue
+
+        statement = "CREATE UNIQUE INDEX IF NOT EXISTS idx_%s_unique ON %s (%s)" % (
+            table,
+            table,
+            ", ".join(key),
+        )
+        try:
+            con.execute(statement)
+        except sqlite3.IntegrityError:
+            print("Removing duplicate rows from %s" % table)
+            dedupe_table(con, table, key)
+            con.execute(statement)
+        con.commit()
+
+
+# Keeps the newest row for every key. Downloaded data wins over an error
+# recorded for the same object
+def dedupe_table(con, table, key):
+    columns = ", ".join(key)
+    if table == "datastore_data":
+        con.execute(
+            "DELETE FROM datastore_data WHERE data IS NULL AND EXISTS (SELECT 1 FROM datastore_data AS other WHERE other.game = datastore_data.game AND other.data_id = datastore_data.data_id AND other.data IS NOT NULL)"
+        )
+    con.execute(
+        "DELETE FROM %s WHERE rowid NOT IN (SELECT MAX(rowid) FROM %s GROUP BY %s)"
+        % (table, table, columns)
+    )
+    con.commit()
+
+
+def get_ranking_schema(con):
+    tables = set(
+        row[0]
+        for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    )
+
+    if "ranking_compact" in tables:
+        return "compact"
+    if "ranking" in tables:
+        return "legacy"
+    return RANKING_SCHEMA
+
+
+# Integer keyed ranking entries clustered by (game, category, rank), with the
+# groups of an entry packed one byte each
+def create_compact_ranking_tables(con):
+    con.execute(
+        """
+    CREATE TABLE IF NOT EXISTS games (
+        id INTEGER PRIMARY KEY,
+        game TEXT NOT NULL UNIQUE
+    )"""
+    )
+    con.execute(
+        """
+    CREATE TABLE IF NOT EXISTS ranking_compact (
+        game INTEGER NOT NULL,
+        category INTEGER NOT NULL,
+        rank INTEGER NOT NULL,
+        unique_id INTEGER NOT NULL,
+        pid INTEGER NOT NULL,
+        score INTEGER NOT NULL,
+        param INTEGER NOT NULL,
+        groups BLOB NOT NULL,
+        data BLOB,
+        update_time INTEGER,
+        data_hash BLOB,
+        PRIMARY KEY (game, category, rank)
+    ) WITHOUT ROWID"""
+    )
+    con.commit()
+
+
+# Same columns as the old tables. Unique IDs and params are stored as signed 64
+# bit integers and printed back unsigned
+def create_compact_ranking_views(con):
+    con.execute("DROP VIEW IF EXISTS ranking")
+    con.execute(
+        """
+    CREATE VIEW ranking AS
+    SELECT
+        games.game AS game,
+        printf('%llu', ranking_compact.unique_id) AS id,
+        CAST(ranking_compact.pid AS TEXT) AS pid,
+        ranking_compact.rank AS rank,
+        ranking_compact.category AS category,
+        ranking_compact.score AS score,
+        printf('%llu', ranking_compact.param) AS param,
+        COALESCE(ranking_compact.data, ranking_common_data.data) AS data,
+        ranking_compact.update_time AS update_time
+    FROM ranking_compact
+    JOIN games ON games.id = ranking_compact.game
+    LEFT JOIN ranking_common_data ON ranking_common_data.hash = ranking_compact.data_hash"""
+    )
+    con.execute(
+        """
+    CREATE VIEW IF NOT EXISTS ranking_group AS
+    WITH RECURSIVE ranking_group_index (i) AS (
+        SELECT 0 UNION ALL SELECT i + 1 FROM ranking_group_index WHERE i < 255
+    )
+    SELECT
+        games.game AS game,
+        CAST(ranking_compact.pid AS TEXT) AS pid,
+        ranking_compact.rank AS rank,
+        ranking_compact.category AS category,
+        (instr('0123456789ABCDEF', substr(hex(ranking_compact.groups), i * 2 + 1, 1)) - 1) * 16
+            + instr('0123456789ABCDEF', substr(hex(ranking_compact.groups), i * 2 + 2, 1)) - 1
+            AS ranking_group,
+        i AS ranking_index
+    FROM ranking_compact
+    JOIN games ON games.id = ranking_compact.game
+    JOIN ranking_group_index ON i < length(ranking_compact.groups)"""
+    )
+    con.commit()
+
+
+# common_data is mostly Mii and profile data repeated in every category a
+# player is in, so it is stored once in ranking_common_data and ranking only
+# keeps its hash. Rows written before this keep their data inline
+def create_ranking_common_data(con):
+    con.execute(
+        """
+    CREATE TABLE IF NOT EXISTS ranking_common_data (
+        hash BLOB PRIMARY KEY,
+        data BLOB NOT NULL
+    )"""
+    )
+
+    if get_ranking_schema(con) == "compact":
+        table = "ranking_compact"
+    else:
+        table = "ranking"
+    columns = [row[1] for row in con.execute("PRAGMA table_info(%s)" % table)]
+    if len(columns) > 0 and "data_hash" not in columns:
+        con.execute("ALTER TABLE %s ADD COLUMN data_hash BLOB" % table)
+
+    if table == "ranking":
+        # The compact ranking view already does this
+        con.execute(
+            """
+    CREATE VIEW IF NOT EXISTS ranking_with_data AS
+    SELECT
+        ranking.game AS game,
+        ranking.id AS id,
+        ranking.pid AS pid,
+        ranking.rank AS rank,
+        ranking.category AS category,
+        ranking.score AS score,
+        ranking.param AS param,
+        COALESCE(ranking.data, ranking_common_data.data) AS data,
+        ranking.update_time AS update_time
+    FROM ranking
+    LEFT JOIN ranking_common_data ON ranking_common_data.hash = ranking.data_hash"""
+        )
+    con.commit()
+
+
+def common_data_hash(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+# Splits common_data into what goes in the ranking row and the hash it is
+# stored under. Blobs already sent by this process are not sent again
+def store_common_data(data, new_common_data):
+    if data is None or len(data) < RANKING_COMMON_DATA_MIN_SIZE:
+        return (data, None)
+
+    data_hash = common_data_hash(data)
+    if data_hash not in ranking_common_data_written:
+        if len(ranking_common_data_written) >= RANKING_COMMON_DATA_CACHE:
+            ranking_common_data_written.clear()
+        ranking_common_data_written.add(data_hash)
+        new_common_data.append((data_hash, data))
+
+    return (None, data_hash)
+
+
+def to_signed_64(value):
+    if value >= 1 << 63:
+        return value - (1 << 64)
+    return value
+
+
+# Copies ranking and ranking_group into ranking_compact, then swaps the tables
+# for views so everything reading them keeps working
+def migrate_ranking_compact(con):
+    if get_ranking_schema(con) == "compact":
+        print("%s already uses the compact ranking schema" % RANKING_DB)
+        return
+
+    has_ranking = any(
+        con.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ranking'"
+        )
+    )
+    create_ranking_common_data(con)
+    create_compact_ranking_tables(con)
+    if not has_ranking:
+        create_compact_ranking_views(con)
+        return
+
+    # Both walks below go in key order over the unique indexes
+    create_unique_indexes(con, RANKING_UNIQUE_KEYS)
+
+    con.execute("INSERT OR IGNORE INTO games (game) SELECT DISTINCT game FROM ranking")
+    game_ids = dict(con.execute("SELECT game, id FROM games"))
+
+    groups = con.cursor()
+    groups.execute(
+        "SELECT game, category, rank, ranking_group FROM ranking_group ORDER BY game, category, rank, ranking_index"
+    )
+    next_group = groups.fetchone()
+
+    entries = con.cursor()
+    entries.execute(
+        "SELECT game, category, rank, id, pid, score, param, COALESCE(ranking.data, ranking_common_data.data), update_time FROM ranking LEFT JOIN ranking_common_data ON ranking_common_data.hash = ranking.data_hash ORDER BY game, category, rank"
+    )
+
+    num_migrated = 0
+    while True:
+        batch = entries.fetchmany(100000)
+        if len(batch) == 0:
+            break
+
+        rows = []
+        new_common_data = []
+        for game, category, rank, id, pid, score, param, data, update_time in batch:
+            packed = bytearray()
+            while next_group is not None and next_group[:3] <= (game, category, rank):
+                if next_group[:3] == (game, category, rank):
+                    packed.append(next_group[3])
+                next_group = groups.fetchone()
+
+            data, data_hash = store_common_data(data, new_common_data)
+            rows.append(
+                (
+                    game_ids[game],
+                    category,
+                    rank,
+                    to_signed_64(int(id)),
+                    int(pid),
+                    score,
+                    to_signed_64(int(param)),
+                    bytes(packed),
+                    data,
+                    update_time,
+                    data_hash,
+                )
+            )
+
+        con.executemany(
+            "INSERT OR IGNORE INTO ranking_common_data (hash, data) values (?, ?)",
+            new_common_data,
+        )
+        con.executemany(
+            "INSERT OR IGNORE INTO ranking_compact (game, category, rank, unique_id, pid, score, param, groups, data, update_time, data_hash) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        num_migrated += len(rows)
+        print("Migrated %d ranking entries" % num_migrated)
+
+    con.execute("DROP VIEW ranking_with_data")
+    con.execute("DROP TABLE ranking")
+    con.execute("DROP TABLE ranking_group")
+    con.commit()
+    create_compact_ranking_views(con)
+
+    print("Vacuuming %s" % RANKING_DB)
+    con.execute("VACUUM")
+
+
+def print_and_log(text, f):
+    print(text)
+    f.write("%s\n" % text)
+    f.flush()
+
 
-                    for entry in download_entries:
-                        try:
-                            data_id, owner_id = entry
+def timestamp_if_not_null(t):
+    if t:
+        return t.timestamp()
+    else:
+        return t
 
-                            log_lock.acquire()
-                            log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
-                            print_and_log("Start %d" % data_id, log_file)
-                            log_file.close()
-                            log_lock.release()
 
-                            start = time.perf_counter()
+# Fetches the DataStore meta and object behind ranking params for one game.
+# add_rankings queues entries with put, a fixed number of tasks download them
+# over the session pool into ranking_meta and ranking_param_data. Params an
+# earlier run never got to are queued again when run starts, params the server
+# does not have are kept in ranking_param_error so they are only asked for once
+class RankingParamDownloader:
+    def __init__(
+        self,
+        log_queue,
+        write_queue,
+        s,
+        host,
+        port,
+        pid,
+        password,
+        pretty_game_id,
+        auth_info=None,
+    ):
+        self.log_file = QueuedLog(log_queue)
+        self.con = QueuedConnection(write_queue)
+        self.s = s
+        self.host = host
+        self.port = port
+        self.pid = pid
+        self.password = password
+        self.pretty_game_id = pretty_game_id
+        self.auth_info = auth_info
+
+        self.send, self.receive = anyio.create_memory_object_stream(
+            RANKING_PARAM_QUEUE_SIZE
+        )
 
-                            async def get_req_info(client):
-                                store = datastore.DataStoreClient(client)
+        # (category, rank, param) of everything queued and not done yet
+        self.in_flight = set()
 
-                                get_param = datastore.DataStorePrepareGetParam()
-                                get_param.data_id = data_id
+        self.downloaded = 0
+        self.not_found = 0
+        self.objects_failed = 0
+        self.failed = 0
 
-                                req_info = await store.prepare_get_object(get_param)
-                                headers = {
-                                    header.key: header.value
-                                    for header in req_info.headers
-                                }
+    async def put(self, category, entry):
+        await self.queue(self.send, category, entry.rank, entry.pid, entry.param)
 
-                                return (req_info.url, req_info, headers)
+    async def queue(self, send, category, rank, owner_id, param):
+        key = (category, rank, param)
+        if key in self.in_flight:
+            return
 
-                            url, req_info, headers = await retry_if_rmc_error(
-                                get_req_info,
-                                s,
-                                host,
-                                port,
-                                str(pid),
-                                password,
-                                auth_info=auth_info,
-                            )
+        self.in_flight.add(key)
+        await send.send((category, rank, owner_id, param))
 
-                            async with httpx.AsyncClient() as client:
-                                response = await client.get(
-                                    "https://%s" % req_info.url,
-                                    headers=headers,
-                                    timeout=(60 * 10),
-                                )
+    # Everything queued so far is still downloaded before run returns
+    async def close(self):
+        await self.send.aclose()
 
-                            # TODO store the headers too
-                            con.execute(
-                                "INSERT INTO datastore_data (game, data_id, url, data) values (?, ?, ?, ?)",
-                                (
-                                    pretty_game_id,
-                                    data_id,
-                                    url,
-                                    gzip.compress(response.content),
-                                ),
-                            )
-                            con.commit()
+    async def run(self):
+        try:
+            async with anyio.create_task_group() as group:
+                group.start_soon(self.queue_missing, self.send.clone())
+                for _ in range(RANKING_PARAM_CONCURRENCY):
+                    group.start_soon(self.download_params)
+        finally:
+            self.con.close()
+
+        print_and_log(
+            "Downloaded %d ranking params, %d not found, %d without their object, %d failed"
+            % (self.downloaded, self.not_found, self.objects_failed, self.failed),
+            self.log_file,
+        )
 
-                            log_lock.acquire()
-                            log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
-                            print_and_log(
-                                "Downloaded %d in %f seconds"
-                                % (data_id, time.perf_counter() - start),
-                                log_file,
-                            )
-                            log_file.close()
-                            log_lock.release()
-
-                        except RMCError as e:
-                            log_lock.acquire()
-                            log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
-                            print_and_log("Small issue: %s" % str(e), log_file)
-                            log_file.close()
-                            log_lock.release()
-                except queue.Empty:
+    # Read RANKING_PARAM_MISSING_BATCH rows at a time in (category, rank) order
+    async def queue_missing(self, send):
+        def get_missing(after):
+            con = sqlite3.connect(RANKING_DB, timeout=3600)
+            rows = con.execute(
+                "SELECT category, rank, pid, param FROM ranking WHERE game = ? AND (category, rank) > (?, ?) AND param != '0' AND NOT EXISTS (SELECT 1 FROM ranking_meta WHERE ranking_meta.game = ranking.game AND ranking_meta.category = ranking.category AND ranking_meta.rank = ranking.rank) AND NOT EXISTS (SELECT 1 FROM ranking_param_error WHERE ranking_param_error.game = ranking.game AND ranking_param_error.category = ranking.category AND ranking_param_error.rank = ranking.rank AND ranking_param_error.param = ranking.param) ORDER BY category, rank LIMIT ?",
+                (self.pretty_game_id, *after, RANKING_PARAM_MISSING_BATCH),
+            ).fetchall()
+            con.close()
+            return rows
+
+        async with send:
+            after = (-1, 0)
+            while True:
+                rows = await anyio.to_thread.run_sync(get_missing, after)
+                if len(rows) == 0:
                     break
-        except Exception as e:
-            print("".join(traceback.TracebackException.from_exception(e).format()))
 
-        con.close()
+                for category, rank, owner_id, param in rows:
+                    await self.queue(send, category, rank, int(owner_id), int(param))
+                after = rows[-1][:2]
+
+    async def download_params(self):
+        async for category, rank, owner_id, param in self.receive:
+            try:
+                await self.download_param(category, rank, owner_id, param)
+            except Exception as e:
+                self.failed += 1
+                METRICS.inc("ranking_params_total", result="failed")
+                print_and_log(
+                    "Could not download param for %d: %s"
+                    % (
+                        rank,
+                        "".join(
+                            traceback.TracebackException.from_exception(e).format()
+                        ),
+                    ),
+                    self.log_file,
+                )
+            finally:
+                self.in_flight.discard((category, rank, param))
 
-    anyio.run(run)
+    async def download_param(self, category, rank, owner_id, param):
+        async def get_meta(client):
+            store = datastore.DataStoreClient(client)
 
+            get_meta_param = datastore.DataStoreGetMetaParam()
+            get_meta_param.result_option = 4
+            get_meta_param.data_id = param
+            get_meta_param.persistence_target.owner_id = owner_id
 
-def print_and_log(text, f):
-    print(text)
-    f.write("%s\n" % text)
-    f.flush()
+            return await store.get_meta(get_meta_param)
 
+        async def get_req_info(client):
+            store = datastore.DataStoreClient(client)
 
-def timestamp_if_not_null(t):
-    if t:
-        return t.timestamp()
-    else:
-        return t
+            get_param = datastore.DataStorePrepareGetParam()
+            get_param.data_id = param
+            get_param.persistence_target.owner_id = owner_id
+
+            return await store.prepare_get_object(get_param)
+
+        try:
+            result = await retry_if_rmc_error(
+                get_meta,
+                self.s,
+                self.host,
+                self.port,
+                str(self.pid),
+                self.password,
+                auth_info=self.auth_info,
+            )
+        except RMCRetriesExhausted:
+            raise
+        except RMCError as e:
+            # Usually nintendo.nex.common.RMCError: DataStore::NotFound
+            self.not_found += 1
+            METRICS.inc("ranking_params_total", result="not_found")
+            self.con.execute(
+                "INSERT OR REPLACE INTO ranking_param_error (game, category, rank, param, error) values (?, ?, ?, ?, ?)",
+                (self.pretty_game_id, category, rank, str(param), str(e)),
+            )
+            self.con.commit()
+            return
+
+        response = None
+        if result.size > 0:
+            try:
+                req_info = await retry_if_rmc_error(
+                    get_req_info,
+                    self.s,
+                    self.host,
+                    self.port,
+                    str(self.pid),
+                    self.password,
+                    auth_info=self.auth_info,
+                )
+                headers = {header.key: header.value for header in req_info.headers}
+                response = await get_object_data(req_info.url, headers)
+                response.raise_for_status()
+            except RMCRetriesExhausted:
+                raise
+            except (RMCError, httpx.HTTPError) as e:
+                # The meta is still worth keeping
+                response = None
+                self.objects_failed += 1
+                METRICS.inc("ranking_params_total", result="object_failed")
+                print_and_log(
+                    "Could not download object of param %d for rank %d: %s"
+                    % (param, rank, str(e)),
+                    self.log_file,
+                )
+
+        # TODO store more!
+        self.con.execute(
+            "INSERT OR IGNORE INTO ranking_meta (game, pid, rank, category, data_id, size, name, data_type, meta_binary, create_time, update_time) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                self.pretty_game_id,
+                str(owner_id),
+                rank,
+                category,
+                result.data_id,
+                result.size,
+                result.name,
+                result.data_type,
+                result.meta_binary,
+                timestamp_if_not_null(result.create_time),
+                timestamp_if_not_null(result.update_time),
+            ),
+        )
+        if response is not None:
+            self.con.execute(
+                "INSERT OR IGNORE INTO ranking_param_data (game, pid, rank, category, data) values (?, ?, ?, ?, ?)",
+                (self.pretty_game_id, str(owner_id), rank, category, response.content),
+            )
+        self.con.commit()
+
+        if response is not None or result.size == 0:
+            self.downloaded += 1
+            METRICS.inc("ranking_params_total", result="downloaded")
 
 
 async def add_rankings(
@@ -1400,156 +3947,203 @@ async def add_rankings(
     port,
     pid,
     password,
-    log_lock,
+    log_queue,
     rankings,
     pretty_game_id,
     has_datastore,
     con,
     auth_info=None,
+    progress=None,
+    param_downloader=None,
+    replace=False,
 ):
-    # Since this is part of the datastore scrape instead simply ignore
-    if has_datastore and False:
+    # Downloaded in the background so pagination never waits on DataStore
+    if has_datastore and param_downloader is not None:
         for entry in rankings.data:
             if entry.param:
-                result = None
-                try:
-
-                    async def get_res():
-                        async with backend.connect(s, host, port) as be:
-                            async with be.login(str(pid), password) as client:
-                                store = datastore.DataStoreClient(client)
+                await param_downloader.put(category, entry)
 
-                                get_meta_param = datastore.DataStoreGetMetaParam()
-                                get_meta_param.result_option = 4
-                                get_meta_param.data_id = entry.param
-                                get_meta_param.persistence_target.owner_id = entry.pid
-
-                                result = await store.get_meta(get_meta_param)
+    new_common_data = []
+    if RANKING_SCHEMA == "compact":
+        common_data = [
+            store_common_data(entry.common_data, new_common_data)
+            for entry in rankings.data
+        ]
+    else:
+        common_data = [(entry.common_data, None) for entry in rankings.data]
+    con.executemany(
+        "INSERT OR IGNORE INTO ranking_common_data (hash, data) values (?, ?)",
+        new_common_data,
+    )
 
-                                return result
+    # Entries already stored at these ranks are overwritten, anything that was
+    # not the same entry is kept in ranking_history first
+    if replace:
+        insert = "INSERT OR REPLACE"
+        con.executemany(
+            "INSERT INTO ranking_history (game, id, pid, rank, category, score, param, data, update_time, superseded_time) SELECT game, id, pid, rank, category, score, param, data, update_time, ? FROM %s WHERE game = ? AND category = ? AND rank = ? AND (id != ? OR pid != ? OR score != ? OR update_time IS NOT ?)"
+            % get_ranking_data_view(),
+            [
+                (
+                    time.time(),
+                    pretty_game_id,
+                    entry.category,
+                    entry.rank,
+                    str(entry.unique_id),
+                    str(entry.pid),
+                    entry.score,
+                    timestamp_if_not_null(entry.update_time),
+                )
+                for entry in rankings.data
+            ],
+        )
+        if RANKING_SCHEMA != "compact":
+            con.executemany(
+                "DELETE FROM ranking_group WHERE game = ? AND category = ? AND rank = ?",
+                [(pretty_game_id, category, entry.rank) for entry in rankings.data],
+            )
+    else:
+        insert = "INSERT OR IGNORE"
+
+    if RANKING_SCHEMA == "compact":
+        con.execute("INSERT OR IGNORE INTO games (game) values (?)", (pretty_game_id,))
+        con.executemany(
+            insert
+            + " INTO ranking_compact (game, category, rank, unique_id, pid, score, param, groups, data, update_time, data_hash) values ((SELECT id FROM games WHERE game = ?), ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    pretty_game_id,
+                    entry.category,
+                    entry.rank,
+                    to_signed_64(entry.unique_id),
+                    entry.pid,
+                    entry.score,
+                    to_signed_64(entry.param),
+                    bytes(entry.groups),
+                    data,
+                    timestamp_if_not_null(entry.update_time),
+                    data_hash,
+                )
+                for entry, (data, data_hash) in zip(rankings.data, common_data)
+            ],
+        )
+    else:
+        con.executemany(
+            insert
+            + " INTO ranking (game, id, pid, rank, category, score, param, data, update_time, data_hash) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    pretty_game_id,
+                    str(entry.unique_id),
+                    str(entry.pid),
+                    entry.rank,
+                    entry.category,
+                    entry.score,
+                    str(entry.param),
+                    data,
+                    timestamp_if_not_null(entry.update_time),
+                    data_hash,
+                )
+                for entry, (data, data_hash) in zip(rankings.data, common_data)
+            ],
+        )
+        con.executemany(
+            insert
+            + " INTO ranking_group (game, pid, rank, category, ranking_group, ranking_index) values (?, ?, ?, ?, ?, ?)",
+            [
+                (pretty_game_id, str(entry.pid), entry.rank, category, group, i)
+                for entry in rankings.data
+                for i, group in enumerate(entry.groups)
+            ],
+        )
+    METRICS.inc("ranking_entries_total", len(rankings.data))
+
+    if progress is not None and len(rankings.data) > 0:
+        cursor_rank, stop_rank = progress
+        save_ranking_progress(
+            con,
+            pretty_game_id,
+            category,
+            cursor_rank,
+            rankings.data[-1].rank,
+            rankings.data[-1].unique_id,
+            rankings.data[-1].pid,
+            stop_rank,
+        )
+    con.commit()
 
-                    result = await retry_if_rmc_error(get_res)
-                except RMCError as e:
-                    # Usually nintendo.nex.common.RMCError: Ranking::NotFound, ignore
-                    None
-                except Exception as e:
-                    log_lock.acquire()
-                    log_file = open(RANKING_LOG, "a", encoding="utf-8")
-                    print_and_log(
-                        "Could not download meta param for %d: %s"
-                        % (
-                            entry.rank,
-                            "".join(
-                                traceback.TracebackException.from_exception(e).format()
-                            ),
-                        ),
-                        log_file,
-                    )
-                    log_file.close()
-                    log_lock.release()
 
-                response = None
-                if result and result.size > 0:
-                    try:
+# Moves a cursor's checkpoint forward. count is the number of stored rows it
+# covers, only the ones between the old and the new last rank are counted so
+# pages added again never count twice. Runs after the rows in the same commit
+def save_ranking_progress(
+    con,
+    pretty_game_id,
+    category,
+    cursor_rank,
+    last_rank,
+    last_id,
+    last_pid,
+    stop_rank,
+):
+    con.execute(
+        "INSERT INTO ranking_progress (game, category, cursor_rank, last_rank, last_id, last_pid, stop_rank, count) values (?, ?, ?, ?, ?, ?, ?, (SELECT COUNT(*) FROM ranking WHERE game = ? AND category = ? AND rank > ? AND rank <= ?)) ON CONFLICT (game, category, cursor_rank) DO UPDATE SET last_rank = excluded.last_rank, last_id = excluded.last_id, last_pid = excluded.last_pid, stop_rank = excluded.stop_rank, count = count + (SELECT COUNT(*) FROM ranking WHERE game = excluded.game AND category = excluded.category AND rank > ranking_progress.last_rank AND rank <= excluded.last_rank) WHERE excluded.last_rank >= ranking_progress.last_rank",
+        (
+            pretty_game_id,
+            category,
+            cursor_rank,
+            last_rank,
+            str(last_id),
+            str(last_pid),
+            stop_rank,
+            pretty_game_id,
+            category,
+            cursor_rank,
+            last_rank,
+        ),
+    )
 
-                        async def get_res():
-                            async with backend.connect(s, host, port) as be:
-                                async with be.login(str(pid), password) as client:
-                                    store = datastore.DataStoreClient(client)
 
-                                    get_param = datastore.DataStorePrepareGetParam()
-                                    get_param.data_id = entry.param
-                                    get_param.persistence_target.owner_id = entry.pid
+# Replaces every checkpoint of a category with one at the last stored rank
+def reset_ranking_progress(con, pretty_game_id, category):
+    con.execute(
+        "DELETE FROM ranking_progress WHERE game = ? AND category = ?",
+        (pretty_game_id, category),
+    )
+    con.execute(
+        "INSERT INTO ranking_progress (game, category, cursor_rank, last_rank, last_id, last_pid, stop_rank, count) SELECT game, category, 0, rank, id, pid, NULL, (SELECT COUNT(*) FROM ranking WHERE game = ? AND category = ?) FROM ranking WHERE game = ? AND category = ? ORDER BY rank DESC LIMIT 1",
+        (pretty_game_id, category, pretty_game_id, category),
+    )
 
-                                    req_info = await store.prepare_get_object(get_param)
-                                    headers = {
-                                        header.key: header.value
-                                        for header in req_info.headers
-                                    }
 
-                                    return (req_info, headers)
+# Rows of ranking with common_data filled back in
+def get_ranking_data_view():
+    if RANKING_SCHEMA == "compact":
+        return "ranking"
+    return "ranking_with_data"
 
-                        req_info, headers = await retry_if_rmc_error(get_res)
-                        response = await http.get(req_info.url, headers=headers)
-                        response.raise_if_error()
-                    except RMCError as e:
-                        # Usually nintendo.nex.common.RMCError: Ranking::NotFound, ignore
-                        None
-                    except Exception as e:
-                        log_lock.acquire()
-                        log_file = open(RANKING_LOG, "a", encoding="utf-8")
-                        print_and_log(
-                            "Could not download param for %d: %s"
-                            % (
-                                entry.rank,
-                                "".join(
-                                    traceback.TracebackException.from_exception(
-                                        e
-                                    ).format()
-                                ),
-                            ),
-                            log_file,
-                        )
-                        log_file.close()
-                        log_lock.release()
-
-                if result:
-                    # TODO store more!
-                    con.execute(
-                        "INSERT INTO ranking_meta (game, pid, rank, category, data_id, size, name, data_type, meta_binary, create_time, update_time) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                        (
-                            pretty_game_id,
-                            str(entry.pid),
-                            entry.rank,
-                            category,
-                            result.data_id,
-                            result.size,
-                            result.name,
-                            result.data_type,
-                            result.meta_binary,
-                            timestamp_if_not_null(result.create_time),
-                            timestamp_if_not_null(result.update_time),
-                        ),
-                    )
-                    if result.size > 0:
-                        con.execute(
-                            "INSERT INTO ranking_param_data (game, pid, rank, category, data) values (?, ?, ?, ?, ?)",
-                            (
-                                pretty_game_id,
-                                str(entry.pid),
-                                entry.rank,
-                                category,
-                                response.body,
-                            ),
-                        )
-                    con.commit()
 
-    con.executemany(
-        "INSERT INTO ranking (game, id, pid, rank, category, score, param, data, update_time) values (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-        [
-            (
-                pretty_game_id,
-                str(entry.unique_id),
-                str(entry.pid),
-                entry.rank,
-                entry.category,
-                entry.score,
-                str(entry.param),
-                entry.common_data,
-                timestamp_if_not_null(entry.update_time),
-            )
-            for entry in rankings.data
-        ],
-    )
-    con.executemany(
-        "INSERT INTO ranking_group (game, pid, rank, category, ranking_group, ranking_index) values (?, ?, ?, ?, ?, ?)",
-        [
-            (pretty_game_id, str(entry.pid), entry.rank, category, group, i)
-            for entry in rankings.data
-            for i, group in enumerate(entry.groups)
-        ],
+# Moves every entry of a category from min_rank on to ranking_history
+def supersede_rankings(con, pretty_game_id, category, min_rank):
+    con.execute(
+        "INSERT INTO ranking_history (game, id, pid, rank, category, score, param, data, update_time, superseded_time) SELECT game, id, pid, rank, category, score, param, data, update_time, ? FROM %s WHERE game = ? AND category = ? AND rank >= ?"
+        % get_ranking_data_view(),
+        (time.time(), pretty_game_id, category, min_rank),
     )
-    con.commit()
+    if RANKING_SCHEMA == "compact":
+        con.execute(
+            "DELETE FROM ranking_compact WHERE game = (SELECT id FROM games WHERE game = ?) AND category = ? AND rank >= ?",
+            (pretty_game_id, category, min_rank),
+        )
+    else:
+        con.execute(
+            "DELETE FROM ranking WHERE game = ? AND category = ? AND rank >= ?",
+            (pretty_game_id, category, min_rank),
+        )
+        con.execute(
+            "DELETE FROM ranking_group WHERE game = ? AND category = ? AND rank >= ?",
+            (pretty_game_id, category, min_rank),
+        )
 
 
 # NintendoClients does not implement this properly
@@ -2065,12 +4659,242 @@ ranking.RankingRankData.load = new_RankingRankData_load
 ranking.RankingRankData.max_version = new_RankingRankData_max_version
 
 
+# Same fields as RankingRankData, filled in straight from a response buffer
+class FastRankingRankData:
+    __slots__ = (
+        "pid",
+        "unique_id",
+        "rank",
+        "category",
+        "score",
+        "groups",
+        "param",
+        "common_data",
+        "update_time",
+    )
+
+    def __init__(
+        self,
+        pid,
+        unique_id,
+        rank,
+        category,
+        score,
+        groups,
+        param,
+        common_data,
+        update_time,
+    ):
+        self.pid = pid
+        self.unique_id = unique_id
+        self.rank = rank
+        self.category = category
+        self.score = score
+        self.groups = groups
+        self.param = param
+        self.common_data = common_data
+        self.update_time = update_time
+
+
+RANKING_STRUCT_HEADER = struct.Struct("<BI")
+# pid, unique id, rank, category, score for each pid size
+RANKING_ENTRY_HEADS = {
+    4: struct.Struct("<IQIII"),
+    8: struct.Struct("<QQIII"),
+}
+RANKING_U32 = struct.Struct("<I")
+RANKING_U64 = struct.Struct("<Q")
+RANKING_PARAM_AND_SIZE = struct.Struct("<QI")
+RANKING_RESULT_TAIL = struct.Struct("<IQ")
+
+
+# Parses a whole get_ranking response with fixed struct layouts instead of a
+# StreamIn call per field. Returns None for anything it does not expect, the
+# caller decodes those the generic way
+def decode_ranking_result(data, settings):
+    struct_header = settings["nex.struct_header"]
+    head = RANKING_ENTRY_HEADS.get(settings["nex.pid_size"])
+    if head is None:
+        return None
+
+    view = memoryview(data)
+    pos = 0
+    try:
+        if struct_header:
+            version, size = RANKING_STRUCT_HEADER.unpack_from(view, pos)
+            pos += RANKING_STRUCT_HEADER.size
+            if version != 0:
+                return None
+            result_end = pos + size
+
+        (count,) = RANKING_U32.unpack_from(view, pos)
+        pos += 4
+
+        entries = []
+        for _ in range(count):
+            version = 0
+            if struct_header:
+                version, size = RANKING_STRUCT_HEADER.unpack_from(view, pos)
+                pos += RANKING_STRUCT_HEADER.size
+                if version > 1:
+                    return None
+                entry_end = pos + size
+
+            pid, unique_id, rank, category, score = head.unpack_from(view, pos)
+            pos += head.size
+
+            (num_groups,) = RANKING_U32.unpack_from(view, pos)
+            pos += 4
+            groups = list(view[pos : pos + num_groups])
+            pos += num_groups
+
+            param, common_data_size = RANKING_PARAM_AND_SIZE.unpack_from(view, pos)
+            pos += RANKING_PARAM_AND_SIZE.size
+            common_data = bytes(view[pos : pos + common_data_size])
+            pos += common_data_size
+
+            update_time = None
+            if version >= 1:
+                update_time = common.DateTime(RANKING_U64.unpack_from(view, pos)[0])
+                pos += 8
+
+            if struct_header and pos != entry_end:
+                return None
+
+            entries.append(
+                FastRankingRankData(
+                    pid,
+                    unique_id,
+                    rank,
+                    category,
+                    score,
+                    groups,
+                    param,
+                    common_data,
+                    update_time,
+                )
+            )
+
+        total, since_time = RANKING_RESULT_TAIL.unpack_from(view, pos)
+        pos += RANKING_RESULT_TAIL.size
+    except struct.error:
+        return None
+
+    if struct_header and pos != result_end:
+        return None
+    if pos != len(data):
+        return None
+
+    result = ranking.RankingResult()
+    result.data = entries
+    result.total = total
+    result.since_time = common.DateTime(since_time)
+    return result
+
+
+async def new_RankingClient_get_ranking(self, mode, category, order, unique_id, pid):
+    stream = streams.StreamOut(self.settings)
+    stream.u8(mode)
+    stream.u32(category)
+    stream.add(order)
+    stream.u64(unique_id)
+    stream.pid(pid)
+    data = await self.client.request(
+        self.PROTOCOL_ID, self.METHOD_GET_RANKING, stream.get()
+    )
+
+    result = decode_ranking_result(data, self.settings)
+    if result is None:
+        METRICS.inc("ranking_decode_fallback_total")
+
+        stream = streams.StreamIn(data, self.settings)
+        result = stream.extract(ranking.RankingResult)
+        if not stream.eof():
+            raise ValueError(
+                "Response is bigger than expected (got %i bytes, but only %i were read)"
+                % (stream.size(), stream.tell())
+            )
+    return result
+
+
+ranking.RankingClient.get_ranking = new_RankingClient_get_ranking
+
+
+# Builds a page of ranking entries and decodes it with both decoders
+def benchmark_ranking_decode(nex_version, struct_header, num_entries=255, rounds=200):
+    s = settings.default()
+    s.configure("00000000", nex_version)
+    s["nex.struct_header"] = struct_header
+
+    result = ranking.RankingResult()
+    result.data = []
+    for rank in range(1, num_entries + 1):
+        entry = ranking.RankingRankData()
+        entry.pid = 1000000000 + rank
+        entry.unique_id = rank
+        entry.rank = rank
+        entry.category = 1
+        entry.score = 1000000 - rank
+        entry.groups = [1, 2]
+        entry.param = 1000 + rank
+        entry.common_data = bytes(range(96))
+        entry.update_time = common.DateTime.now()
+        result.data.append(entry)
+    result.total = num_entries
+    result.since_time = common.DateTime.now()
+
+    stream = streams.StreamOut(s)
+    stream.add(result)
+    data = stream.get()
+
+    begin = time.perf_counter()
+    for _ in range(rounds):
+        generic = streams.StreamIn(data, s).extract(ranking.RankingResult)
+    generic_rate = num_entries * rounds / (time.perf_counter() - begin)
+
+    begin = time.perf_counter()
+    for _ in range(rounds):
+        fast = decode_ranking_result(data, s)
+    fast_rate = num_entries * rounds / (time.perf_counter() - begin)
+
+    for a, b in zip(generic.data, fast.data):
+        for field in FastRankingRankData.__slots__:
+            if field == "update_time":
+                same = timestamp_if_not_null(a.update_time) == timestamp_if_not_null(
+                    b.update_time
+                )
+            else:
+                same = getattr(a, field) == getattr(b, field)
+            if not same:
+                raise ValueError("Decoders disagree on %s of rank %d" % (field, a.rank))
+
+    print(
+        "NEX %d, struct header %d: generic %d entries/s, fast %d entries/s (%.1fx)"
+        % (
+            nex_version,
+            struct_header,
+            generic_rate,
+            fast_rate,
+            fast_rate / generic_rate,
+        )
+    )
+
+
 async def main():
+    global RANKING_SCHEMA
+
     if sys.argv[1] == "create":
         con = sqlite3.connect(RANKING_DB, timeout=3600)
+        configure_sqlite(con)
         cur = con.cursor()
-        cur.execute(
-            """
+        RANKING_SCHEMA = get_ranking_schema(con)
+        if RANKING_SCHEMA == "compact":
+            create_compact_ranking_tables(con)
+            create_ranking_common_data(con)
+            create_compact_ranking_views(con)
+        else:
+            cur.execute(
+                """
     CREATE TABLE IF NOT EXISTS ranking (
         game TEXT NOT NULL,
         id TEXT NOT NULL,
@@ -2080,11 +4904,12 @@ async def main():
         score INTEGER NOT NULL,
         param TEXT NOT NULL,
         data BLOB,
-        update_time INTEGER
+        update_time INTEGER,
+        data_hash BLOB
     )"""
-        )
-        cur.execute(
-            """
+            )
+            cur.execute(
+                """
     CREATE TABLE IF NOT EXISTS ranking_group (
         game TEXT NOT NULL,
         pid TEXT NOT NULL,
@@ -2093,7 +4918,8 @@ async def main():
         ranking_group INTEGER NOT NULL,
         ranking_index INTEGER NOT NULL
     )"""
-        )
+            )
+            create_ranking_common_data(con)
         cur.execute(
             """
     CREATE TABLE IF NOT EXISTS ranking_param_data (
@@ -2124,9 +4950,72 @@ async def main():
     )"""
         )
         cur.execute(
-            """CREATE INDEX IF NOT EXISTS idx_ranking_game_category ON ranking (game, category)"""
+            """
+    CREATE TABLE IF NOT EXISTS ranking_param_error (
+        game TEXT NOT NULL,
+        category INTEGER NOT NULL,
+        rank INTEGER NOT NULL,
+        param TEXT NOT NULL,
+        error TEXT,
+        PRIMARY KEY (game, category, rank)
+    )"""
+        )
+        cur.execute(
+            """
+    CREATE TABLE IF NOT EXISTS ranking_progress (
+        game TEXT NOT NULL,
+        category INTEGER NOT NULL,
+        cursor_rank INTEGER NOT NULL,
+        last_rank INTEGER NOT NULL,
+        last_id TEXT NOT NULL,
+        last_pid TEXT NOT NULL,
+        stop_rank INTEGER,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (game, category, cursor_rank)
+    )"""
+        )
+        cur.execute(
+            """
+    CREATE TABLE IF NOT EXISTS ranking_category (
+        game TEXT NOT NULL,
+        category INTEGER NOT NULL,
+        total INTEGER,
+        source TEXT NOT NULL,
+        PRIMARY KEY (game, category)
+    )"""
+        )
+        cur.execute(
+            """
+    CREATE TABLE IF NOT EXISTS ranking_category_sweep (
+        game TEXT NOT NULL,
+        range_start INTEGER NOT NULL,
+        range_next INTEGER NOT NULL,
+        range_end INTEGER NOT NULL,
+        PRIMARY KEY (game, range_start)
+    )"""
+        )
+        cur.execute(
+            """
+    CREATE TABLE IF NOT EXISTS ranking_history (
+        game TEXT NOT NULL,
+        id TEXT NOT NULL,
+        pid TEXT NOT NULL,
+        rank INTEGER NOT NULL,
+        category INTEGER NOT NULL,
+        score INTEGER NOT NULL,
+        param TEXT NOT NULL,
+        data BLOB,
+        update_time INTEGER,
+        superseded_time INTEGER NOT NULL
+    )"""
+        )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_ranking_history ON ranking_history (game, category, rank)"
         )
-        cur.execute("""CREATE INDEX IF NOT EXISTS idx_ranking_rank ON ranking (rank)""")
+        create_unique_indexes(con, RANKING_UNIQUE_KEYS)
+        import_ranking_categories(con, RANKING_CATEGORIES_FILE)
+        if not DEFER_RANKING_INDEXES:
+            create_ranking_indexes(con)
 
         f = open("../find-nex-servers/nexwiiu.json")
         nex_wiiu_games = json.load(f)["games"]
@@ -2136,7 +5025,13 @@ async def main():
             "games"
         ]
 
-        log_file = open(RANKING_LOG, "a", encoding="utf-8")
+        log_sink = LogSink(RANKING_LOG)
+        log_sink.start()
+        log_file = QueuedLog(log_sink.queue)
+
+        writer = SQLiteWriter(RANKING_DB, log_sink.queue)
+        writer.start()
+        write_con = QueuedConnection(writer.queue)
 
         for i, game in enumerate(nex_wiiu_games):
             print_and_log(
@@ -2151,14 +5046,10 @@ async def main():
             # if len(cur.execute("SELECT rank FROM ranking WHERE game = ? LIMIT 1", (pretty_game_id,)).fetchall()) > 0:
             # 	continue
 
-            nas = nnas.NNASClient()
-            nas.set_device(DEVICE_ID, SERIAL_NUMBER, SYSTEM_VERSION)
-            nas.set_title(game["aid"], game["av"])
-            nas.set_locale(REGION_ID, COUNTRY_NAME, LANGUAGE)
-
-            access_token = await nas.login(USERNAME, PASSWORD)
-
-            nex_token = await nas.get_nex_token(access_token.token, game["id"])
+            nex_token = await TOKEN_MANAGER.get_nex_token(game)
+            TOKEN_MANAGER.retain(nex_wiiu_games[i : i + 2])
+            if i + 1 < len(nex_wiiu_games):
+                TOKEN_MANAGER.prefetch_nex_token(nex_wiiu_games[i + 1])
 
             nex_version = (
                 game["nex"][0][0] * 10000 + game["nex"][0][1] * 100 + game["nex"][0][2]
@@ -2172,171 +5063,95 @@ async def main():
                     [g for g in wiiu_games if g["aid"] == game["aid"]][0]["nexds"]
                 )
 
-            """
-            # Run everything in processes
-            num_processes = 8
-            range_size = int(pow(2, 32) / num_processes)
-
-            found_queue = Queue()
-            num_tested_queue = Queue()
-
-            processes = [Process(target=range_test_category,
-                args=(game["key"], nex_version, nex_token.host, nex_token.port, str(nex_token.pid), nex_token.password, i * range_size, i * range_size + 1000, found_queue, num_tested_queue)) for i in range(num_processes)]
-            # Queue for printing number tested and found categories
-            processes.append(Process(target=print_categories, args=(num_processes, found_queue, num_tested_queue)))
-            for p in processes:
-                p.start()
-            for p in processes:
-                p.join()
+            s = settings.default()
+            s.configure(game["key"], nex_version)
 
-            continue
-            """
+            if RANKING_CATEGORY_SWEEP:
+                await sweep_ranking_categories(
+                    con,
+                    write_con,
+                    log_file,
+                    pretty_game_id,
+                    s,
+                    nex_token.host,
+                    nex_token.port,
+                    nex_token.pid,
+                    nex_token.password,
+                    0,
+                    pow(2, 32),
+                )
+
+            valid_categories = await get_ranking_categories(
+                con,
+                write_con,
+                log_file,
+                pretty_game_id,
+                s,
+                nex_token.host,
+                nex_token.port,
+                nex_token.pid,
+                nex_token.password,
+            )
 
-            valid_categories = []
-            num_tested = 0
+            param_downloader = None
+            if has_datastore and RANKING_PARAM_DOWNLOAD:
+                param_downloader = RankingParamDownloader(
+                    log_sink.queue,
+                    writer.queue,
+                    s,
+                    nex_token.host,
+                    nex_token.port,
+                    nex_token.pid,
+                    nex_token.password,
+                    pretty_game_id,
+                )
 
-            s = settings.default()
-            s.configure(game["key"], nex_version)
-            async with backend.connect(s, nex_token.host, nex_token.port) as be:
-                async with be.login(str(nex_token.pid), nex_token.password) as client:
-                    ranking_client = ranking.RankingClient(client)
-
-                    for category in range(1000):
-                        try:
-                            order_param = ranking.RankingOrderParam()
-                            order_param.offset = 0
-                            order_param.count = 1
-
-                            _ = await ranking_client.get_ranking(
-                                ranking.RankingMode.GLOBAL,  # Get the global leaderboard
-                                category,  # Category, this is 3-A (Magrove Cove)
-                                order_param,
-                                0,
-                                0,
-                            )
+            async with anyio.create_task_group() as group:
+                if param_downloader is not None:
+                    group.start_soon(param_downloader.run)
 
-                            # No exception, this is a valid category
-                            valid_categories.append(category)
-                            print_and_log("Found category %d" % category, log_file)
-                        except Exception:
-                            None
-
-                        num_tested += 1
-
-                        if num_tested % 10 == 0:
-                            print_and_log("Tested %d categories" % num_tested, log_file)
-
-            if game["aid"] == 1407375153317888:
-                valid_categories.extend(
-                    [
-                        0x5DD7E214,
-                        0x13759B11,
-                        0xE3123FD0,
-                        0x912DF205,
-                        0x9E391E6D,
-                        0x5B41DCD6,
-                        0x403CF15E,
-                        0x9A479BC2,
-                        0x5A8C9203,
-                        0x27E351EC,
-                        0xB2F30301,
-                        0xC3701F2C,
-                        0xC44FE9B2,
-                        0x169BCB49,
-                        0x893EB726,
-                        0x1D46C990,
-                        0x428E1F5B,
-                        0x421F85DE,
-                        0x980638CD,
-                        0x9A9E4578,
-                        0x529F713C,
-                        0x229D4B34,
-                        0xDEB25266,
-                        0x9F206066,
-                        0xAD56AF59,
-                        0xDADEB14A,
-                        0xA1137287,
-                        0xC5BE4809,
-                        0xFE7E5473,
-                        0x7FE2A8DC,
-                        0x80469829,
-                        0xD26D5AAA,
-                        0xDC9C0EED,
-                        0x997FB4A2,
-                        0x12C3F595,
-                        0xC484D676,
-                        0xA002D295,
-                        0xECC83B64,
-                        0x8A33A8A9,
-                        0xF0E2800E,
-                        0x431B4770,
-                        0x6DBE41C2,
-                        0x5CC03A6F,
-                        0x13AE214C,
-                        0x773204C6,
-                        0xC4262903,
-                        0xFE5FD35F,
-                        0xE4CB3C45,
-                        0xADBE9415,
-                        0xC0D23671,
-                        0xCBDC7006,
-                        0x4EEB52FF,
-                        0xF03B8ADE,
-                        0x6A46C6B5,
-                        0x3603775F,
-                        0x954ABE27,
-                        0xCBB12D65,
-                        0x4BEAF6F6,
-                        0x37082275,
-                        0xD94FD2F6,
-                        0xB1C43F16,
-                        0xDE28ED26,
-                        0xBC0CD164,
-                    ]
+                # Run categories concurrently over the pooled sessions
+                await run_category_scrapes(
+                    valid_categories,
+                    RANKING_CATEGORY_CONCURRENCY,
+                    log_sink.queue,
+                    writer.queue,
+                    s,
+                    nex_token.host,
+                    nex_token.port,
+                    nex_token.pid,
+                    nex_token.password,
+                    game,
+                    pretty_game_id,
+                    has_datastore,
+                    i,
+                    nex_wiiu_games,
+                    param_downloader=param_downloader,
                 )
 
-            subgroup_size = 32
-            subgroup_size_groups = [
-                valid_categories[i : i + subgroup_size]
-                for i in range(0, len(valid_categories), subgroup_size)
-            ]
-
-            log_lock = Lock()
-
-            for group in subgroup_size_groups:
-                # Run categories in parallel
-                processes = [
-                    Process(
-                        target=run_category_scrape,
-                        args=(
-                            category,
-                            log_lock,
-                            s,
-                            nex_token.host,
-                            nex_token.port,
-                            nex_token.pid,
-                            nex_token.password,
-                            game,
-                            pretty_game_id,
-                            has_datastore,
-                            i,
-                            nex_wiiu_games,
-                        ),
-                    )
-                    for category in group
-                ]
-                for p in processes:
-                    p.start()
-                for p in processes:
-                    p.join()
+                if param_downloader is not None:
+                    await param_downloader.close()
 
-        log_file.close()
+        if DEFER_RANKING_INDEXES:
+            write_con.flush()
+            await anyio.to_thread.run_sync(build_deferred_ranking_indexes, writer)
+
+        write_con.close()
+        writer.stop()
+        log_sink.stop()
 
     if sys.argv[1] == "create_3ds":
         con = sqlite3.connect(RANKING_DB, timeout=3600)
-        cur = con.cursor()
-        cur.execute(
-            """
+        configure_sqlite(con)
+        cur = con.cursor()
+        RANKING_SCHEMA = get_ranking_schema(con)
+        if RANKING_SCHEMA == "compact":
+            create_compact_ranking_tables(con)
+            create_ranking_common_data(con)
+            create_compact_ranking_views(con)
+        else:
+            cur.execute(
+                """
     CREATE TABLE IF NOT EXISTS ranking (
         game TEXT NOT NULL,
         id TEXT NOT NULL,
@@ -2346,11 +5161,12 @@ async def main():
         score INTEGER NOT NULL,
         param TEXT NOT NULL,
         data BLOB,
-        update_time INTEGER
+        update_time INTEGER,
+        data_hash BLOB
     )"""
-        )
-        cur.execute(
-            """
+            )
+            cur.execute(
+                """
     CREATE TABLE IF NOT EXISTS ranking_group (
         game TEXT NOT NULL,
         pid TEXT NOT NULL,
@@ -2359,7 +5175,8 @@ async def main():
         ranking_group INTEGER NOT NULL,
         ranking_index INTEGER NOT NULL
     )"""
-        )
+            )
+            create_ranking_common_data(con)
         cur.execute(
             """
     CREATE TABLE IF NOT EXISTS ranking_param_data (
@@ -2390,15 +5207,84 @@ async def main():
     )"""
         )
         cur.execute(
-            """CREATE INDEX IF NOT EXISTS idx_ranking_game_category ON ranking (game, category)"""
+            """
+    CREATE TABLE IF NOT EXISTS ranking_param_error (
+        game TEXT NOT NULL,
+        category INTEGER NOT NULL,
+        rank INTEGER NOT NULL,
+        param TEXT NOT NULL,
+        error TEXT,
+        PRIMARY KEY (game, category, rank)
+    )"""
+        )
+        cur.execute(
+            """
+    CREATE TABLE IF NOT EXISTS ranking_progress (
+        game TEXT NOT NULL,
+        category INTEGER NOT NULL,
+        cursor_rank INTEGER NOT NULL,
+        last_rank INTEGER NOT NULL,
+        last_id TEXT NOT NULL,
+        last_pid TEXT NOT NULL,
+        stop_rank INTEGER,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (game, category, cursor_rank)
+    )"""
+        )
+        cur.execute(
+            """
+    CREATE TABLE IF NOT EXISTS ranking_category (
+        game TEXT NOT NULL,
+        category INTEGER NOT NULL,
+        total INTEGER,
+        source TEXT NOT NULL,
+        PRIMARY KEY (game, category)
+    )"""
+        )
+        cur.execute(
+            """
+    CREATE TABLE IF NOT EXISTS ranking_category_sweep (
+        game TEXT NOT NULL,
+        range_start INTEGER NOT NULL,
+        range_next INTEGER NOT NULL,
+        range_end INTEGER NOT NULL,
+        PRIMARY KEY (game, range_start)
+    )"""
+        )
+        cur.execute(
+            """
+    CREATE TABLE IF NOT EXISTS ranking_history (
+        game TEXT NOT NULL,
+        id TEXT NOT NULL,
+        pid TEXT NOT NULL,
+        rank INTEGER NOT NULL,
+        category INTEGER NOT NULL,
+        score INTEGER NOT NULL,
+        param TEXT NOT NULL,
+        data BLOB,
+        update_time INTEGER,
+        superseded_time INTEGER NOT NULL
+    )"""
+        )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_ranking_history ON ranking_history (game, category, rank)"
         )
-        cur.execute("""CREATE INDEX IF NOT EXISTS idx_ranking_rank ON ranking (rank)""")
+        create_unique_indexes(con, RANKING_UNIQUE_KEYS)
+        import_ranking_categories(con, RANKING_CATEGORIES_FILE)
+        if not DEFER_RANKING_INDEXES:
+            create_ranking_indexes(con)
 
         f = open("../../find-nex-servers/nex3ds.json")
         nex_3ds_games = json.load(f)["games"]
         f.close()
 
-        log_file = open(RANKING_LOG, "a", encoding="utf-8")
+        log_sink = LogSink(RANKING_LOG)
+        log_sink.start()
+        log_file = QueuedLog(log_sink.queue)
+
+        writer = SQLiteWriter(RANKING_DB, log_sink.queue)
+        writer.start()
+        write_con = QueuedConnection(writer.queue)
 
         for i, game in enumerate(nex_3ds_games):
             print_and_log(
@@ -2408,18 +5294,11 @@ async def main():
             )
 
             pretty_game_id = hex(game["aid"])[2:].upper().rjust(16, "0")
-            title_version = (
-                game["nex"][0][0] * 10000 + game["nex"][0][1] * 100 + game["nex"][0][2]
-            )
-
-            nas = nasc.NASCClient()
-            nas.set_title(game["aid"], title_version)
-            nas.set_device(SERIAL_NUMBER_3DS, MAC_ADDRESS_3DS, FCD_CERT_3DS, "")
-            nas.set_locale(REGION_3DS, LANGUAGE_3DS)
-            nas.set_user(USERNAME_3DS, USERNAME_HMAC_3DS)
-
             try:
-                response_token = await nas.login(game["aid"] & 0xFFFFFFFF)
+                response_token = await TOKEN_MANAGER.get_nasc_token(game)
+                TOKEN_MANAGER.retain(nex_3ds_games[i : i + 2])
+                if i + 1 < len(nex_3ds_games):
+                    TOKEN_MANAGER.prefetch_nasc_token(nex_3ds_games[i + 1])
             except Exception as e:
                 print_and_log(
                     "".join(traceback.TracebackException.from_exception(e).format()),
@@ -2441,9 +5320,7 @@ async def main():
             nex_token.password = PASSWORD_3DS
 
             if game["aid"] == 1125899907040768:
-                auth_info = authentication.AuthenticationInfo()
-                auth_info.token = nex_token_old.token
-                auth_info.ngs_version = 2
+                auth_info = await TOKEN_MANAGER.get_auth_info(game)
             else:
                 auth_info = None
 
@@ -2454,173 +5331,91 @@ async def main():
             # Check if nexds is loaded
             has_datastore = game["has_datastore"]
 
-            """
-            # Run everything in processes
-            num_processes = 8
-            range_size = int(pow(2, 32) / num_processes)
-
-            found_queue = Queue()
-            num_tested_queue = Queue()
-
-            processes = [Process(target=range_test_category,
-                args=(game["key"], nex_version, nex_token.host, nex_token.port, str(nex_token.pid), nex_token.password, i * range_size, i * range_size + 1000, found_queue, num_tested_queue)) for i in range(num_processes)]
-            # Queue for printing number tested and found categories
-            processes.append(Process(target=print_categories, args=(num_processes, found_queue, num_tested_queue)))
-            for p in processes:
-                p.start()
-            for p in processes:
-                p.join()
-
-            continue
-            """
-
-            valid_categories = []
-            num_tested = 0
-
             s = settings.load("3ds")
             s.configure(game["key"], nex_version)
             s["prudp.version"] = 1
 
-            async with backend.connect(s, nex_token.host, nex_token.port) as be:
-                async with be.login(
-                    str(nex_token.pid), nex_token.password, auth_info=auth_info
-                ) as client:
-                    ranking_client = ranking.RankingClient(client)
-
-                    for category in range(1000):
-                        try:
-                            order_param = ranking.RankingOrderParam()
-                            order_param.offset = 0
-                            order_param.count = 1
-
-                            _ = await ranking_client.get_ranking(
-                                ranking.RankingMode.GLOBAL,  # Get the global leaderboard
-                                category,  # Category, this is 3-A (Magrove Cove)
-                                order_param,
-                                0,
-                                0,
-                            )
+            if RANKING_CATEGORY_SWEEP:
+                await sweep_ranking_categories(
+                    con,
+                    write_con,
+                    log_file,
+                    pretty_game_id,
+                    s,
+                    nex_token.host,
+                    nex_token.port,
+                    nex_token.pid,
+                    nex_token.password,
+                    0,
+                    pow(2, 32),
+                    auth_info=auth_info,
+                )
 
-                            # No exception, this is a valid category
-                            valid_categories.append(category)
-                            print_and_log("Found category %d" % category, log_file)
-                        except Exception:
-                            None
-
-                        num_tested += 1
-
-                        if num_tested % 10 == 0:
-                            print_and_log("Tested %d categories" % num_tested, log_file)
-
-            if game["aid"] == 1407375153317888:
-                valid_categories.extend(
-                    [
-                        0x5DD7E214,
-                        0x13759B11,
-                        0xE3123FD0,
-                        0x912DF205,
-                        0x9E391E6D,
-                        0x5B41DCD6,
-                        0x403CF15E,
-                        0x9A479BC2,
-                        0x5A8C9203,
-                        0x27E351EC,
-                        0xB2F30301,
-                        0xC3701F2C,
-                        0xC44FE9B2,
-                        0x169BCB49,
-                        0x893EB726,
-                        0x1D46C990,
-                        0x428E1F5B,
-                        0x421F85DE,
-                        0x980638CD,
-                        0x9A9E4578,
-                        0x529F713C,
-                        0x229D4B34,
-                        0xDEB25266,
-                        0x9F206066,
-                        0xAD56AF59,
-                        0xDADEB14A,
-                        0xA1137287,
-                        0xC5BE4809,
-                        0xFE7E5473,
-                        0x7FE2A8DC,
-                        0x80469829,
-                        0xD26D5AAA,
-                        0xDC9C0EED,
-                        0x997FB4A2,
-                        0x12C3F595,
-                        0xC484D676,
-                        0xA002D295,
-                        0xECC83B64,
-                        0x8A33A8A9,
-                        0xF0E2800E,
-                        0x431B4770,
-                        0x6DBE41C2,
-                        0x5CC03A6F,
-                        0x13AE214C,
-                        0x773204C6,
-                        0xC4262903,
-                        0xFE5FD35F,
-                        0xE4CB3C45,
-                        0xADBE9415,
-                        0xC0D23671,
-                        0xCBDC7006,
-                        0x4EEB52FF,
-                        0xF03B8ADE,
-                        0x6A46C6B5,
-                        0x3603775F,
-                        0x954ABE27,
-                        0xCBB12D65,
-                        0x4BEAF6F6,
-                        0x37082275,
-                        0xD94FD2F6,
-                        0xB1C43F16,
-                        0xDE28ED26,
-                        0xBC0CD164,
-                    ]
+            valid_categories = await get_ranking_categories(
+                con,
+                write_con,
+                log_file,
+                pretty_game_id,
+                s,
+                nex_token.host,
+                nex_token.port,
+                nex_token.pid,
+                nex_token.password,
+                auth_info=auth_info,
+            )
+
+            param_downloader = None
+            if has_datastore and RANKING_PARAM_DOWNLOAD:
+                param_downloader = RankingParamDownloader(
+                    log_sink.queue,
+                    writer.queue,
+                    s,
+                    nex_token.host,
+                    nex_token.port,
+                    nex_token.pid,
+                    nex_token.password,
+                    pretty_game_id,
+                    auth_info=auth_info,
                 )
 
-            subgroup_size = 32
-            subgroup_size_groups = [
-                valid_categories[i : i + subgroup_size]
-                for i in range(0, len(valid_categories), subgroup_size)
-            ]
-
-            log_lock = Lock()
-
-            for group in subgroup_size_groups:
-                # Run categories in parallel
-                processes = [
-                    Process(
-                        target=run_category_scrape,
-                        args=(
-                            category,
-                            log_lock,
-                            s,
-                            nex_token.host,
-                            nex_token.port,
-                            nex_token.pid,
-                            nex_token.password,
-                            game,
-                            pretty_game_id,
-                            has_datastore,
-                            i,
-                            nex_3ds_games,
-                            auth_info,
-                        ),
-                    )
-                    for category in group
-                ]
-                for p in processes:
-                    p.start()
-                for p in processes:
-                    p.join()
+            async with anyio.create_task_group() as group:
+                if param_downloader is not None:
+                    group.start_soon(param_downloader.run)
 
-        log_file.close()
+                # Run categories concurrently over the pooled sessions
+                await run_category_scrapes(
+                    valid_categories,
+                    RANKING_CATEGORY_CONCURRENCY,
+                    log_sink.queue,
+                    writer.queue,
+                    s,
+                    nex_token.host,
+                    nex_token.port,
+                    nex_token.pid,
+                    nex_token.password,
+                    game,
+                    pretty_game_id,
+                    has_datastore,
+                    i,
+                    nex_3ds_games,
+                    auth_info=auth_info,
+                    param_downloader=param_downloader,
+                )
+
+                if param_downloader is not None:
+                    await param_downloader.close()
+
+        if DEFER_RANKING_INDEXES:
+            write_con.flush()
+            await anyio.to_thread.run_sync(build_deferred_ranking_indexes, writer)
+
+        write_con.close()
+        writer.stop()
+        log_sink.stop()
 
     if sys.argv[1] == "datastore_from_ranking_3ds":
         ranking_con = sqlite3.connect(RANKING_DB, timeout=3600)
+        configure_sqlite(ranking_con)
         con = sqlite3.connect(DATASTORE_DB, timeout=3600)
         con.execute(
             """
@@ -2683,13 +5478,20 @@ async def main():
         recipient TEXT
     )"""
         )
+        create_datastore_url_method(con)
+        create_unique_indexes(con, DATASTORE_UNIQUE_KEYS)
         con.commit()
 
         f = open("../../find-nex-servers/nex3ds.json")
         nex_3ds_games = json.load(f)["games"]
         f.close()
 
-        log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
+        log_sink = LogSink(DATASTORE_LOG)
+        log_sink.start()
+        log_file = QueuedLog(log_sink.queue)
+
+        writer = SQLiteWriter(DATASTORE_DB, log_sink.queue)
+        writer.start()
 
         for i, game in enumerate(nex_3ds_games):
             # Check if nexds is loaded
@@ -2697,19 +5499,10 @@ async def main():
 
             if has_datastore:
                 pretty_game_id = hex(game["aid"])[2:].upper().rjust(16, "0")
-                title_version = (
-                    game["nex"][0][0] * 10000
-                    + game["nex"][0][1] * 100
-                    + game["nex"][0][2]
-                )
-
-                nas = nasc.NASCClient()
-                nas.set_title(game["aid"], title_version)
-                nas.set_device(SERIAL_NUMBER_3DS, MAC_ADDRESS_3DS, FCD_CERT_3DS, "")
-                nas.set_locale(REGION_3DS, LANGUAGE_3DS)
-                nas.set_user(USERNAME_3DS, USERNAME_HMAC_3DS)
-
-                nex_token_old = await nas.login(game["aid"] & 0xFFFFFFFF)
+                nex_token_old = await TOKEN_MANAGER.get_nasc_token(game)
+                TOKEN_MANAGER.retain(nex_3ds_games[i : i + 2])
+                if i + 1 < len(nex_3ds_games):
+                    TOKEN_MANAGER.prefetch_nasc_token(nex_3ds_games[i + 1])
 
                 class NexToken3DS:
                     def __init__(self):
@@ -2725,11 +5518,11 @@ async def main():
                 nex_token.password = PASSWORD_3DS
 
                 if game["aid"] == 1125899907040768:
-                    auth_info = authentication.AuthenticationInfo()
-                    auth_info.token = nex_token_old.token
-                    auth_info.ngs_version = 2
+                    auth_info = await TOKEN_MANAGER.get_auth_info(game)
+                    worker_auth = await TOKEN_MANAGER.get_worker_auth(game)
                 else:
                     auth_info = None
+                    worker_auth = None
 
                 nex_version = (
                     game["nex"][0][0] * 10000
@@ -2757,9 +5550,7 @@ async def main():
 
                 num_download_threads = 16
 
-                log_lock = Lock()
                 metas_queue = Queue()
-                done_flag = Value("i", True)
 
                 while True:
                     metas_queue.put(
@@ -2772,13 +5563,16 @@ async def main():
                     if len(download_entries) == 0:
                         break
 
+                finish_work(metas_queue)
+
                 processes = []
                 for i in range(num_download_threads):
                     processes.append(
                         Process(
                             target=get_datastore_data_and_metas,
                             args=(
-                                log_lock,
+                                log_sink.queue,
+                                writer.queue,
                                 game["key"],
                                 nex_version,
                                 nex_token.host,
@@ -2787,9 +5581,8 @@ async def main():
                                 nex_token.password,
                                 pretty_game_id,
                                 metas_queue,
-                                done_flag,
                                 s,
-                                auth_info
+                                worker_auth,
                             ),
                         )
                     )
@@ -2799,7 +5592,18 @@ async def main():
                 for p in processes:
                     p.join()
 
-        log_file.close()
+        writer.stop()
+        log_sink.stop()
+
+    if sys.argv[1] == "benchmark_ranking_decode":
+        for nex_version, struct_header in ((30400, 0), (40000, 1)):
+            benchmark_ranking_decode(nex_version, struct_header)
+
+    if sys.argv[1] == "migrate_compact":
+        con = sqlite3.connect(RANKING_DB, timeout=3600)
+        configure_sqlite(con, writer=True)
+        migrate_ranking_compact(con)
+        con.close()
 
     if sys.argv[1] == "fix_meta_binary":
         None
@@ -2813,7 +5617,9 @@ async def main():
             "games"
         ]
 
-        log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
+        log_sink = LogSink(DATASTORE_LOG)
+        log_sink.start()
+        log_file = QueuedLog(log_sink.queue)
 
         for i, game in enumerate(nex_wiiu_games):
             # Check if nexds is loaded
@@ -2826,14 +5632,10 @@ async def main():
 
                 print(pretty_game_id)
 
-                nas = nnas.NNASClient()
-                nas.set_device(DEVICE_ID, SERIAL_NUMBER, SYSTEM_VERSION)
-                nas.set_title(game["aid"], game["av"])
-                nas.set_locale(REGION_ID, COUNTRY_NAME, LANGUAGE)
-
-                access_token = await nas.login(USERNAME, PASSWORD)
-
-                nex_token = await nas.get_nex_token(access_token.token, game["id"])
+                nex_token = await TOKEN_MANAGER.get_nex_token(game)
+                TOKEN_MANAGER.retain(nex_wiiu_games[i : i + 2])
+                if i + 1 < len(nex_wiiu_games):
+                    TOKEN_MANAGER.prefetch_nex_token(nex_wiiu_games[i + 1])
 
                 nex_version = (
                     game["nex"][0][0] * 10000
@@ -2923,14 +5725,16 @@ async def main():
                             log_file,
                         )
 
-        log_file.close()
+        log_sink.stop()
 
     if sys.argv[1] == "datastore_get_info_3ds":
         f = open("../../find-nex-servers/nex3ds.json")
         nex_3ds_games = json.load(f)["games"]
         f.close()
 
-        log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
+        log_sink = LogSink(DATASTORE_LOG)
+        log_sink.start()
+        log_file = QueuedLog(log_sink.queue)
 
         for i, game in enumerate(nex_3ds_games):
             # Check if nexds is loaded
@@ -2938,21 +5742,12 @@ async def main():
 
             if has_datastore:
                 pretty_game_id = hex(game["aid"])[2:].upper().rjust(16, "0")
-                title_version = (
-                    game["nex"][0][0] * 10000
-                    + game["nex"][0][1] * 100
-                    + game["nex"][0][2]
-                )
-
-                print(pretty_game_id, title_version)
-
-                nas = nasc.NASCClient()
-                nas.set_title(game["aid"], title_version)
-                nas.set_device(SERIAL_NUMBER_3DS, MAC_ADDRESS_3DS, FCD_CERT_3DS, "")
-                nas.set_locale(REGION_3DS, LANGUAGE_3DS)
-                nas.set_user(USERNAME_3DS, USERNAME_HMAC_3DS)
+                print(pretty_game_id)
 
-                nex_token_old = await nas.login(game["aid"] & 0xFFFFFFFF)
+                nex_token_old = await TOKEN_MANAGER.get_nasc_token(game)
+                TOKEN_MANAGER.retain(nex_3ds_games[i : i + 2])
+                if i + 1 < len(nex_3ds_games):
+                    TOKEN_MANAGER.prefetch_nasc_token(nex_3ds_games[i + 1])
 
                 class NexToken3DS:
                     def __init__(self):
@@ -2968,9 +5763,7 @@ async def main():
                 nex_token.password = PASSWORD_3DS
 
                 if game["aid"] == 1125899907040768:
-                    auth_info = authentication.AuthenticationInfo()
-                    auth_info.token = nex_token_old.token
-                    auth_info.ngs_version = 2
+                    auth_info = await TOKEN_MANAGER.get_auth_info(game)
                 else:
                     auth_info = None
 
@@ -3065,10 +5858,11 @@ async def main():
                             log_file,
                         )
 
-        log_file.close()
+        log_sink.stop()
 
     if sys.argv[1] == "datastore_just_metas":
         con = sqlite3.connect(DATASTORE_DB, timeout=3600)
+        configure_sqlite(con)
         con.execute(
             """
     CREATE TABLE IF NOT EXISTS datastore_meta (
@@ -3130,6 +5924,8 @@ async def main():
         recipient TEXT
     )"""
         )
+        create_datastore_url_method(con)
+        create_unique_indexes(con, DATASTORE_UNIQUE_KEYS)
         con.commit()
 
         f = open("../find-nex-servers/nexwiiu.json")
@@ -3140,7 +5936,9 @@ async def main():
             "games"
         ]
 
-        log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
+        log_sink = LogSink(DATASTORE_LOG)
+        log_sink.start()
+        log_file = QueuedLog(log_sink.queue)
 
         for i, game in enumerate(nex_wiiu_games):
             # Check if nexds is loaded
@@ -3151,14 +5949,10 @@ async def main():
             if has_datastore:
                 pretty_game_id = hex(game["aid"])[2:].upper().rjust(16, "0")
 
-                nas = nnas.NNASClient()
-                nas.set_device(DEVICE_ID, SERIAL_NUMBER, SYSTEM_VERSION)
-                nas.set_title(game["aid"], game["av"])
-                nas.set_locale(REGION_ID, COUNTRY_NAME, LANGUAGE)
-
-                access_token = await nas.login(USERNAME, PASSWORD)
-
-                nex_token = await nas.get_nex_token(access_token.token, game["id"])
+                nex_token = await TOKEN_MANAGER.get_nex_token(game)
+                TOKEN_MANAGER.retain(nex_wiiu_games[i : i + 2])
+                if i + 1 < len(nex_wiiu_games):
+                    TOKEN_MANAGER.prefetch_nex_token(nex_wiiu_games[i + 1])
 
                 nex_version = (
                     game["nex"][0][0] * 10000
@@ -3238,10 +6032,11 @@ async def main():
                     ):
                         None
 
-        log_file.close()
+        log_sink.stop()
 
     if sys.argv[1] == "datastore_just_metas_3ds":
         con = sqlite3.connect(DATASTORE_DB, timeout=3600)
+        configure_sqlite(con)
         con.execute(
             """
     CREATE TABLE IF NOT EXISTS datastore_meta (
@@ -3303,13 +6098,17 @@ async def main():
         recipient TEXT
     )"""
         )
+        create_datastore_url_method(con)
+        create_unique_indexes(con, DATASTORE_UNIQUE_KEYS)
         con.commit()
 
         f = open("../../find-nex-servers/nex3ds.json")
         nex_3ds_games = json.load(f)["games"]
         f.close()
 
-        log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
+        log_sink = LogSink(DATASTORE_LOG)
+        log_sink.start()
+        log_file = QueuedLog(log_sink.queue)
 
         for i, game in enumerate(nex_3ds_games):
             # Check if nexds is loaded
@@ -3317,19 +6116,10 @@ async def main():
 
             if has_datastore:
                 pretty_game_id = hex(game["aid"])[2:].upper().rjust(16, "0")
-                title_version = (
-                    game["nex"][0][0] * 10000
-                    + game["nex"][0][1] * 100
-                    + game["nex"][0][2]
-                )
-
-                nas = nasc.NASCClient()
-                nas.set_title(game["aid"], title_version)
-                nas.set_device(SERIAL_NUMBER_3DS, MAC_ADDRESS_3DS, FCD_CERT_3DS, "")
-                nas.set_locale(REGION_3DS, LANGUAGE_3DS)
-                nas.set_user(USERNAME_3DS, USERNAME_HMAC_3DS)
-
-                nex_token_old = await nas.login(game["aid"] & 0xFFFFFFFF)
+                nex_token_old = await TOKEN_MANAGER.get_nasc_token(game)
+                TOKEN_MANAGER.retain(nex_3ds_games[i : i + 2])
+                if i + 1 < len(nex_3ds_games):
+                    TOKEN_MANAGER.prefetch_nasc_token(nex_3ds_games[i + 1])
 
                 class NexToken3DS:
                     def __init__(self):
@@ -3422,10 +6212,11 @@ async def main():
                     ):
                         None
 
-        log_file.close()
+        log_sink.stop()
 
     if sys.argv[1] == "datastore":
         con = sqlite3.connect(DATASTORE_DB, timeout=3600)
+        configure_sqlite(con)
         con.execute(
             """
     CREATE TABLE IF NOT EXISTS datastore_meta (
@@ -3487,6 +6278,8 @@ async def main():
         recipient TEXT
     )"""
         )
+        create_datastore_url_method(con)
+        create_unique_indexes(con, DATASTORE_UNIQUE_KEYS)
         con.commit()
 
         f = open("../find-nex-servers/nexwiiu.json")
@@ -3497,7 +6290,12 @@ async def main():
             "games"
         ]
 
-        log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
+        log_sink = LogSink(DATASTORE_LOG)
+        log_sink.start()
+        log_file = QueuedLog(log_sink.queue)
+
+        writer = SQLiteWriter(DATASTORE_DB, log_sink.queue)
+        writer.start()
 
         for i, game in enumerate(nex_wiiu_games):
             if i == int(sys.argv[4]):
@@ -3525,14 +6323,10 @@ async def main():
 
                 pretty_game_id = hex(game["aid"])[2:].upper().rjust(16, "0")
 
-                nas = nnas.NNASClient()
-                nas.set_device(DEVICE_ID, SERIAL_NUMBER, SYSTEM_VERSION)
-                nas.set_title(game["aid"], game["av"])
-                nas.set_locale(REGION_ID, COUNTRY_NAME, LANGUAGE)
-
-                access_token = await nas.login(USERNAME, PASSWORD)
-
-                nex_token = await nas.get_nex_token(access_token.token, game["id"])
+                nex_token = await TOKEN_MANAGER.get_nex_token(game)
+                TOKEN_MANAGER.retain(nex_wiiu_games[i : i + 2])
+                if i + 1 < len(nex_wiiu_games):
+                    TOKEN_MANAGER.prefetch_nex_token(nex_wiiu_games[i + 1])
 
                 nex_version = (
                     game["nex"][0][0] * 10000
@@ -3540,26 +6334,6 @@ async def main():
                     + game["nex"][0][2]
                 )
 
-                """
-                # Run everything in processes
-                num_processes = 8
-                range_size = int(pow(2, 32) / num_processes)
-
-                found_queue = Queue()
-                num_tested_queue = Queue()
-
-                processes = [Process(target=range_test_category,
-                    args=(game["key"], nex_version, nex_token.host, nex_token.port, str(nex_token.pid), nex_token.password, i * range_size, i * range_size + 1000, found_queue, num_tested_queue)) for i in range(num_processes)]
-                # Queue for printing number tested and found categories
-                processes.append(Process(target=print_categories, args=(num_processes, found_queue, num_tested_queue)))
-                for p in processes:
-                    p.start()
-                for p in processes:
-                    p.join()
-
-                continue
-                """
-
                 async def does_search_work(client):
                     store = datastore.DataStoreClient(client)
                     return await search_works(store)
@@ -3691,10 +6465,7 @@ async def main():
                         num_metas_threads = 8
                         num_download_threads = 8
 
-                        log_lock = Lock()
                         metas_queue = Queue()
-                        done_flag = Value("i", False)
-                        num_metas_threads_done = Value("i", 0)
 
                         while True:
                             metas_queue.put(
@@ -3713,7 +6484,8 @@ async def main():
                                 Process(
                                     target=get_datastore_metas,
                                     args=(
-                                        log_lock,
+                                        log_sink.queue,
+                                        writer.queue,
                                         game["key"],
                                         nex_version,
                                         nex_token.host,
@@ -3722,13 +6494,11 @@ async def main():
                                         nex_token.password,
                                         pretty_game_id,
                                         metas_queue,
-                                        done_flag,
                                         i,
                                         num_metas_threads,
                                         max_queryable,
                                         last_data_id,
                                         late_data_id,
-                                        num_metas_threads_done,
                                     ),
                                 )
                             )
@@ -3737,7 +6507,8 @@ async def main():
                                 Process(
                                     target=get_datastore_data,
                                     args=(
-                                        log_lock,
+                                        log_sink.queue,
+                                        writer.queue,
                                         game["key"],
                                         nex_version,
                                         nex_token.host,
@@ -3746,13 +6517,18 @@ async def main():
                                         nex_token.password,
                                         pretty_game_id,
                                         metas_queue,
-                                        done_flag,
                                     ),
                                 )
                             )
 
                         for p in processes:
                             p.start()
+
+                        # Every batch is queued once the metas processes have exited
+                        for p in processes[:num_metas_threads]:
+                            p.join()
+                        finish_work(metas_queue)
+
                         for p in processes:
                             p.join()
 
@@ -3762,10 +6538,12 @@ async def main():
                         log_file,
                     )
 
-        log_file.close()
+        writer.stop()
+        log_sink.stop()
 
     if sys.argv[1] == "datastore_sampling":
         con = sqlite3.connect(DATASTORE_DB, timeout=3600)
+        configure_sqlite(con)
         con.execute(
             """
     CREATE TABLE IF NOT EXISTS datastore_meta (
@@ -3827,6 +6605,8 @@ async def main():
         recipient TEXT
     )"""
         )
+        create_datastore_url_method(con)
+        create_unique_indexes(con, DATASTORE_UNIQUE_KEYS)
         con.commit()
 
         f = open("../find-nex-servers/nexwiiu.json")
@@ -3837,7 +6617,12 @@ async def main():
             "games"
         ]
 
-        log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
+        log_sink = LogSink(DATASTORE_LOG)
+        log_sink.start()
+        log_file = QueuedLog(log_sink.queue)
+
+        writer = SQLiteWriter(DATASTORE_DB, log_sink.queue)
+        writer.start()
 
         for i, game in enumerate(nex_wiiu_games):
             if i == int(sys.argv[4]):
@@ -3862,14 +6647,10 @@ async def main():
 
                 pretty_game_id = hex(game["aid"])[2:].upper().rjust(16, "0")
 
-                nas = nnas.NNASClient()
-                nas.set_device(DEVICE_ID, SERIAL_NUMBER, SYSTEM_VERSION)
-                nas.set_title(game["aid"], game["av"])
-                nas.set_locale(REGION_ID, COUNTRY_NAME, LANGUAGE)
-
-                access_token = await nas.login(USERNAME, PASSWORD)
-
-                nex_token = await nas.get_nex_token(access_token.token, game["id"])
+                nex_token = await TOKEN_MANAGER.get_nex_token(game)
+                TOKEN_MANAGER.retain(nex_wiiu_games[i : i + 2])
+                if i + 1 < len(nex_wiiu_games):
+                    TOKEN_MANAGER.prefetch_nex_token(nex_wiiu_games[i + 1])
 
                 nex_version = (
                     game["nex"][0][0] * 10000
@@ -3877,26 +6658,6 @@ async def main():
                     + game["nex"][0][2]
                 )
 
-                """
-                # Run everything in processes
-                num_processes = 8
-                range_size = int(pow(2, 32) / num_processes)
-
-                found_queue = Queue()
-                num_tested_queue = Queue()
-
-                processes = [Process(target=range_test_category,
-                    args=(game["key"], nex_version, nex_token.host, nex_token.port, str(nex_token.pid), nex_token.password, i * range_size, i * range_size + 1000, found_queue, num_tested_queue)) for i in range(num_processes)]
-                # Queue for printing number tested and found categories
-                processes.append(Process(target=print_categories, args=(num_processes, found_queue, num_tested_queue)))
-                for p in processes:
-                    p.start()
-                for p in processes:
-                    p.join()
-
-                continue
-                """
-
                 async def does_search_work(client):
                     store = datastore.DataStoreClient(client)
                     return await search_works(store)
@@ -4034,10 +6795,7 @@ async def main():
                         num_metas_threads = 8
                         num_download_threads = 8
 
-                        log_lock = Lock()
                         metas_queue = Queue()
-                        done_flag = Value("i", False)
-                        num_metas_threads_done = Value("i", 0)
 
                         while True:
                             metas_queue.put(
@@ -4056,7 +6814,8 @@ async def main():
                                 Process(
                                     target=get_datastore_metas,
                                     args=(
-                                        log_lock,
+                                        log_sink.queue,
+                                        writer.queue,
                                         game["key"],
                                         nex_version,
                                         nex_token.host,
@@ -4065,13 +6824,11 @@ async def main():
                                         nex_token.password,
                                         pretty_game_id,
                                         metas_queue,
-                                        done_flag,
                                         i,
                                         num_metas_threads,
                                         max_queryable,
                                         last_data_id,
                                         late_data_id,
-                                        num_metas_threads_done,
                                     ),
                                 )
                             )
@@ -4080,7 +6837,8 @@ async def main():
                                 Process(
                                     target=get_datastore_data,
                                     args=(
-                                        log_lock,
+                                        log_sink.queue,
+                                        writer.queue,
                                         game["key"],
                                         nex_version,
                                         nex_token.host,
@@ -4089,13 +6847,18 @@ async def main():
                                         nex_token.password,
                                         pretty_game_id,
                                         metas_queue,
-                                        done_flag,
                                     ),
                                 )
                             )
 
                         for p in processes:
                             p.start()
+
+                        # Every batch is queued once the metas processes have exited
+                        for p in processes[:num_metas_threads]:
+                            p.join()
+                        finish_work(metas_queue)
+
                         for p in processes:
                             p.join()
 
@@ -4105,10 +6868,12 @@ async def main():
                         log_file,
                     )
 
-        log_file.close()
+        writer.stop()
+        log_sink.stop()
 
     if sys.argv[1] == "datastore_use_db":
         con = sqlite3.connect(DATASTORE_DB, timeout=3600)
+        configure_sqlite(con)
         con.execute(
             """
     CREATE TABLE IF NOT EXISTS datastore_meta (
@@ -4170,6 +6935,8 @@ async def main():
         recipient TEXT
     )"""
         )
+        create_datastore_url_method(con)
+        create_unique_indexes(con, DATASTORE_UNIQUE_KEYS)
         con.commit()
 
         f = open("../find-nex-servers/nexwiiu.json")
@@ -4180,7 +6947,12 @@ async def main():
             "games"
         ]
 
-        log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
+        log_sink = LogSink(DATASTORE_LOG)
+        log_sink.start()
+        log_file = QueuedLog(log_sink.queue)
+
+        writer = SQLiteWriter(DATASTORE_DB, log_sink.queue)
+        writer.start()
 
         for i, game in enumerate(nex_wiiu_games):
             if i == int(sys.argv[4]):
@@ -4205,14 +6977,10 @@ async def main():
 
                 pretty_game_id = hex(game["aid"])[2:].upper().rjust(16, "0")
 
-                nas = nnas.NNASClient()
-                nas.set_device(DEVICE_ID, SERIAL_NUMBER, SYSTEM_VERSION)
-                nas.set_title(game["aid"], game["av"])
-                nas.set_locale(REGION_ID, COUNTRY_NAME, LANGUAGE)
-
-                access_token = await nas.login(USERNAME, PASSWORD)
-
-                nex_token = await nas.get_nex_token(access_token.token, game["id"])
+                nex_token = await TOKEN_MANAGER.get_nex_token(game)
+                TOKEN_MANAGER.retain(nex_wiiu_games[i : i + 2])
+                if i + 1 < len(nex_wiiu_games):
+                    TOKEN_MANAGER.prefetch_nex_token(nex_wiiu_games[i + 1])
 
                 nex_version = (
                     game["nex"][0][0] * 10000
@@ -4220,26 +6988,6 @@ async def main():
                     + game["nex"][0][2]
                 )
 
-                """
-                # Run everything in processes
-                num_processes = 8
-                range_size = int(pow(2, 32) / num_processes)
-
-                found_queue = Queue()
-                num_tested_queue = Queue()
-
-                processes = [Process(target=range_test_category,
-                    args=(game["key"], nex_version, nex_token.host, nex_token.port, str(nex_token.pid), nex_token.password, i * range_size, i * range_size + 1000, found_queue, num_tested_queue)) for i in range(num_processes)]
-                # Queue for printing number tested and found categories
-                processes.append(Process(target=print_categories, args=(num_processes, found_queue, num_tested_queue)))
-                for p in processes:
-                    p.start()
-                for p in processes:
-                    p.join()
-
-                continue
-                """
-
                 async def does_search_work(client):
                     store = datastore.DataStoreClient(client)
                     return await search_works(store)
@@ -4334,10 +7082,7 @@ async def main():
 
                         num_download_threads = 16
 
-                        log_lock = Lock()
                         metas_queue = Queue()
-                        done_flag = Value("i", True)
-                        num_metas_threads_done = Value("i", 0)
 
                         # Get all data IDs to download
                         entries = (
@@ -4360,7 +7105,8 @@ async def main():
                                 Process(
                                     target=get_datastore_data,
                                     args=(
-                                        log_lock,
+                                        log_sink.queue,
+                                        writer.queue,
                                         game["key"],
                                         nex_version,
                                         nex_token.host,
@@ -4369,7 +7115,6 @@ async def main():
                                         nex_token.password,
                                         pretty_game_id,
                                         metas_queue,
-                                        done_flag,
                                     ),
                                 )
                             )
@@ -4389,6 +7134,8 @@ async def main():
                             if len(entries) == 0:
                                 break
 
+                        finish_work(metas_queue)
+
                         for p in processes:
                             p.join()
 
@@ -4398,10 +7145,12 @@ async def main():
                         log_file,
                     )
 
-        log_file.close()
+        writer.stop()
+        log_sink.stop()
 
     if sys.argv[1] == "datastore_3ds":
         con = sqlite3.connect(DATASTORE_DB, timeout=3600)
+        configure_sqlite(con)
         con.execute(
             """
     CREATE TABLE IF NOT EXISTS datastore_meta (
@@ -4463,12 +7212,19 @@ async def main():
         recipient TEXT
     )"""
         )
+        create_datastore_url_method(con)
+        create_unique_indexes(con, DATASTORE_UNIQUE_KEYS)
 
         f = open("../../find-nex-servers/nex3ds.json")
         nex_3ds_games = json.load(f)["games"][int(sys.argv[3]) :]
         f.close()
 
-        log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
+        log_sink = LogSink(DATASTORE_LOG)
+        log_sink.start()
+        log_file = QueuedLog(log_sink.queue)
+
+        writer = SQLiteWriter(DATASTORE_DB, log_sink.queue)
+        writer.start()
 
         for i, game in enumerate(nex_3ds_games):
             if i == int(sys.argv[4]):
@@ -4490,19 +7246,10 @@ async def main():
                 )
 
                 pretty_game_id = hex(game["aid"])[2:].upper().rjust(16, "0")
-                title_version = (
-                    game["nex"][0][0] * 10000
-                    + game["nex"][0][1] * 100
-                    + game["nex"][0][2]
-                )
-
-                nas = nasc.NASCClient()
-                nas.set_title(game["aid"], title_version)
-                nas.set_device(SERIAL_NUMBER_3DS, MAC_ADDRESS_3DS, FCD_CERT_3DS, "")
-                nas.set_locale(REGION_3DS, LANGUAGE_3DS)
-                nas.set_user(USERNAME_3DS, USERNAME_HMAC_3DS)
-
-                nex_token_old = await nas.login(game["aid"] & 0xFFFFFFFF)
+                nex_token_old = await TOKEN_MANAGER.get_nasc_token(game)
+                TOKEN_MANAGER.retain(nex_3ds_games[i : i + 2])
+                if i + 1 < len(nex_3ds_games):
+                    TOKEN_MANAGER.prefetch_nasc_token(nex_3ds_games[i + 1])
 
                 class NexToken3DS:
                     def __init__(self):
@@ -4518,11 +7265,11 @@ async def main():
                 nex_token.password = PASSWORD_3DS
 
                 if game["aid"] == 1125899907040768:
-                    auth_info = authentication.AuthenticationInfo()
-                    auth_info.token = nex_token_old.token
-                    auth_info.ngs_version = 2
+                    auth_info = await TOKEN_MANAGER.get_auth_info(game)
+                    worker_auth = await TOKEN_MANAGER.get_worker_auth(game)
                 else:
                     auth_info = None
+                    worker_auth = None
 
                 nex_version = (
                     game["nex"][0][0] * 10000
@@ -4530,26 +7277,6 @@ async def main():
                     + game["nex"][0][2]
                 )
 
-                """
-                # Run everything in processes
-                num_processes = 8
-                range_size = int(pow(2, 32) / num_processes)
-
-                found_queue = Queue()
-                num_tested_queue = Queue()
-
-                processes = [Process(target=range_test_category,
-                    args=(game["key"], nex_version, nex_token.host, nex_token.port, str(nex_token.pid), nex_token.password, i * range_size, i * range_size + 1000, found_queue, num_tested_queue)) for i in range(num_processes)]
-                # Queue for printing number tested and found categories
-                processes.append(Process(target=print_categories, args=(num_processes, found_queue, num_tested_queue)))
-                for p in processes:
-                    p.start()
-                for p in processes:
-                    p.join()
-
-                continue
-                """
-
                 async def does_search_work(client):
                     store = datastore.DataStoreClient(client)
                     return await search_works(store)
@@ -4679,10 +7406,7 @@ async def main():
                         num_metas_threads = 8
                         num_download_threads = 8
 
-                        log_lock = Lock()
                         metas_queue = Queue()
-                        done_flag = Value("i", False)
-                        num_metas_threads_done = Value("i", 0)
 
                         while True:
                             metas_queue.put(
@@ -4701,7 +7425,8 @@ async def main():
                                 Process(
                                     target=get_datastore_metas,
                                     args=(
-                                        log_lock,
+                                        log_sink.queue,
+                                        writer.queue,
                                         game["key"],
                                         nex_version,
                                         nex_token.host,
@@ -4710,14 +7435,12 @@ async def main():
                                         nex_token.password,
                                         pretty_game_id,
                                         metas_queue,
-                                        done_flag,
                                         i,
                                         num_metas_threads,
                                         max_queryable,
                                         last_data_id,
                                         late_data_id,
-                                        num_metas_threads_done,
-                                        auth_info,
+                                        worker_auth,
                                     ),
                                 )
                             )
@@ -4726,7 +7449,8 @@ async def main():
                                 Process(
                                     target=get_datastore_data,
                                     args=(
-                                        log_lock,
+                                        log_sink.queue,
+                                        writer.queue,
                                         game["key"],
                                         nex_version,
                                         nex_token.host,
@@ -4735,14 +7459,19 @@ async def main():
                                         nex_token.password,
                                         pretty_game_id,
                                         metas_queue,
-                                        done_flag,
-                                        auth_info,
+                                        worker_auth,
                                     ),
                                 )
                             )
 
                         for p in processes:
                             p.start()
+
+                        # Every batch is queued once the metas processes have exited
+                        for p in processes[:num_metas_threads]:
+                            p.join()
+                        finish_work(metas_queue)
+
                         for p in processes:
                             p.join()
 
@@ -4752,10 +7481,12 @@ async def main():
                         log_file,
                     )
 
-        log_file.close()
+        writer.stop()
+        log_sink.stop()
 
     if sys.argv[1] == "datastore_sampling_3ds":
         con = sqlite3.connect(DATASTORE_DB, timeout=3600)
+        configure_sqlite(con)
         con.execute(
             """
     CREATE TABLE IF NOT EXISTS datastore_meta (
@@ -4817,12 +7548,19 @@ async def main():
         recipient TEXT
     )"""
         )
+        create_datastore_url_method(con)
+        create_unique_indexes(con, DATASTORE_UNIQUE_KEYS)
 
         f = open("../../find-nex-servers/nex3ds.json")
         nex_3ds_games = json.load(f)["games"][int(sys.argv[3]) :]
         f.close()
 
-        log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
+        log_sink = LogSink(DATASTORE_LOG)
+        log_sink.start()
+        log_file = QueuedLog(log_sink.queue)
+
+        writer = SQLiteWriter(DATASTORE_DB, log_sink.queue)
+        writer.start()
 
         for i, game in enumerate(nex_3ds_games):
             if i == int(sys.argv[4]):
@@ -4844,19 +7582,10 @@ async def main():
                 )
 
                 pretty_game_id = hex(game["aid"])[2:].upper().rjust(16, "0")
-                title_version = (
-                    game["nex"][0][0] * 10000
-                    + game["nex"][0][1] * 100
-                    + game["nex"][0][2]
-                )
-
-                nas = nasc.NASCClient()
-                nas.set_title(game["aid"], title_version)
-                nas.set_device(SERIAL_NUMBER_3DS, MAC_ADDRESS_3DS, FCD_CERT_3DS, "")
-                nas.set_locale(REGION_3DS, LANGUAGE_3DS)
-                nas.set_user(USERNAME_3DS, USERNAME_HMAC_3DS)
-
-                nex_token_old = await nas.login(game["aid"] & 0xFFFFFFFF)
+                nex_token_old = await TOKEN_MANAGER.get_nasc_token(game)
+                TOKEN_MANAGER.retain(nex_3ds_games[i : i + 2])
+                if i + 1 < len(nex_3ds_games):
+                    TOKEN_MANAGER.prefetch_nasc_token(nex_3ds_games[i + 1])
 
                 class NexToken3DS:
                     def __init__(self):
@@ -4872,11 +7601,11 @@ async def main():
                 nex_token.password = PASSWORD_3DS
 
                 if game["aid"] == 1125899907040768:
-                    auth_info = authentication.AuthenticationInfo()
-                    auth_info.token = nex_token_old.token
-                    auth_info.ngs_version = 2
+                    auth_info = await TOKEN_MANAGER.get_auth_info(game)
+                    worker_auth = await TOKEN_MANAGER.get_worker_auth(game)
                 else:
                     auth_info = None
+                    worker_auth = None
 
                 nex_version = (
                     game["nex"][0][0] * 10000
@@ -4884,26 +7613,6 @@ async def main():
                     + game["nex"][0][2]
                 )
 
-                """
-                # Run everything in processes
-                num_processes = 8
-                range_size = int(pow(2, 32) / num_processes)
-
-                found_queue = Queue()
-                num_tested_queue = Queue()
-
-                processes = [Process(target=range_test_category,
-                    args=(game["key"], nex_version, nex_token.host, nex_token.port, str(nex_token.pid), nex_token.password, i * range_size, i * range_size + 1000, found_queue, num_tested_queue)) for i in range(num_processes)]
-                # Queue for printing number tested and found categories
-                processes.append(Process(target=print_categories, args=(num_processes, found_queue, num_tested_queue)))
-                for p in processes:
-                    p.start()
-                for p in processes:
-                    p.join()
-
-                continue
-                """
-
                 async def does_search_work(client):
                     store = datastore.DataStoreClient(client)
                     return await search_works(store)
@@ -5028,10 +7737,7 @@ async def main():
                         num_metas_threads = 8
                         num_download_threads = 8
 
-                        log_lock = Lock()
                         metas_queue = Queue()
-                        done_flag = Value("i", False)
-                        num_metas_threads_done = Value("i", 0)
 
                         while True:
                             metas_queue.put(
@@ -5050,7 +7756,8 @@ async def main():
                                 Process(
                                     target=get_datastore_metas,
                                     args=(
-                                        log_lock,
+                                        log_sink.queue,
+                                        writer.queue,
                                         game["key"],
                                         nex_version,
                                         nex_token.host,
@@ -5059,14 +7766,12 @@ async def main():
                                         nex_token.password,
                                         pretty_game_id,
                                         metas_queue,
-                                        done_flag,
                                         i,
                                         num_metas_threads,
                                         max_queryable,
                                         last_data_id,
                                         late_data_id,
-                                        num_metas_threads_done,
-                                        auth_info
+                                        worker_auth,
                                     ),
                                 )
                             )
@@ -5075,7 +7780,8 @@ async def main():
                                 Process(
                                     target=get_datastore_data,
                                     args=(
-                                        log_lock,
+                                        log_sink.queue,
+                                        writer.queue,
                                         game["key"],
                                         nex_version,
                                         nex_token.host,
@@ -5084,14 +7790,19 @@ async def main():
                                         nex_token.password,
                                         pretty_game_id,
                                         metas_queue,
-                                        done_flag,
-                                        auth_info
+                                        worker_auth,
                                     ),
                                 )
                             )
 
                         for p in processes:
                             p.start()
+
+                        # Every batch is queued once the metas processes have exited
+                        for p in processes[:num_metas_threads]:
+                            p.join()
+                        finish_work(metas_queue)
+
                         for p in processes:
                             p.join()
 
@@ -5101,10 +7812,12 @@ async def main():
                         log_file,
                     )
 
-        log_file.close()
+        writer.stop()
+        log_sink.stop()
 
     if sys.argv[1] == "datastore_specific":
         con = sqlite3.connect(DATASTORE_DB, timeout=3600)
+        configure_sqlite(con)
         con.execute(
             """
     CREATE TABLE IF NOT EXISTS datastore_meta (
@@ -5166,8 +7879,15 @@ async def main():
         recipient TEXT
     )"""
         )
+        create_datastore_url_method(con)
+        create_unique_indexes(con, DATASTORE_UNIQUE_KEYS)
 
-        log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
+        log_sink = LogSink(DATASTORE_LOG)
+        log_sink.start()
+        log_file = QueuedLog(log_sink.queue)
+
+        writer = SQLiteWriter(DATASTORE_DB, log_sink.queue)
+        writer.start()
 
         class NexToken3DS:
             def __init__(self):
@@ -5274,10 +7994,7 @@ async def main():
                 num_metas_threads = 16
                 num_download_threads = 16
 
-                log_lock = Lock()
                 metas_queue = Queue()
-                done_flag = Value("i", False)
-                num_metas_threads_done = Value("i", 0)
 
                 processes = []
                 for i in range(num_metas_threads):
@@ -5285,7 +8002,8 @@ async def main():
                         Process(
                             target=get_datastore_metas,
                             args=(
-                                log_lock,
+                                log_sink.queue,
+                                writer.queue,
                                 game_key,
                                 nex_version,
                                 nex_token.host,
@@ -5294,13 +8012,11 @@ async def main():
                                 nex_token.password,
                                 pretty_game_id,
                                 metas_queue,
-                                done_flag,
                                 i,
                                 num_metas_threads,
                                 max_queryable,
                                 last_data_id,
                                 late_data_id,
-                                num_metas_threads_done,
                             ),
                         )
                     )
@@ -5309,7 +8025,8 @@ async def main():
                         Process(
                             target=get_datastore_data,
                             args=(
-                                log_lock,
+                                log_sink.queue,
+                                writer.queue,
                                 game_key,
                                 nex_version,
                                 nex_token.host,
@@ -5318,13 +8035,18 @@ async def main():
                                 nex_token.password,
                                 pretty_game_id,
                                 metas_queue,
-                                done_flag,
                             ),
                         )
                     )
 
                 for p in processes:
                     p.start()
+
+                # Every batch is queued once the metas processes have exited
+                for p in processes[:num_metas_threads]:
+                    p.join()
+                finish_work(metas_queue)
+
                 for p in processes:
                     p.join()
 
@@ -5333,8 +8055,12 @@ async def main():
                 "%s does not support search" % game["name"].replace("\n", " "), log_file
             )
 
+        writer.stop()
+        log_sink.stop()
+
     if sys.argv[1] == "datastore_use_db_specific":
         con = sqlite3.connect(DATASTORE_DB, timeout=3600)
+        configure_sqlite(con)
         con.execute(
             """
     CREATE TABLE IF NOT EXISTS datastore_meta (
@@ -5396,9 +8122,16 @@ async def main():
         recipient TEXT
     )"""
         )
+        create_datastore_url_method(con)
+        create_unique_indexes(con, DATASTORE_UNIQUE_KEYS)
         con.commit()
 
-        log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
+        log_sink = LogSink(DATASTORE_LOG)
+        log_sink.start()
+        log_file = QueuedLog(log_sink.queue)
+
+        writer = SQLiteWriter(DATASTORE_DB, log_sink.queue)
+        writer.start()
 
         class NexToken3DS:
             def __init__(self):
@@ -5504,10 +8237,7 @@ async def main():
 
                 num_download_threads = 16
 
-                log_lock = Lock()
                 metas_queue = Queue()
-                done_flag = Value("i", True)
-                num_metas_threads_done = Value("i", 0)
 
                 # Get all data IDs to download
                 entries = (
@@ -5527,7 +8257,8 @@ async def main():
                         Process(
                             target=get_datastore_data,
                             args=(
-                                log_lock,
+                                log_sink.queue,
+                                writer.queue,
                                 game_key,
                                 nex_version,
                                 nex_token.host,
@@ -5536,7 +8267,6 @@ async def main():
                                 nex_token.password,
                                 pretty_game_id,
                                 metas_queue,
-                                done_flag,
                             ),
                         )
                     )
@@ -5553,6 +8283,8 @@ async def main():
                     if len(entries) == 0:
                         break
 
+                finish_work(metas_queue)
+
                 for p in processes:
                     p.join()
 
@@ -5561,7 +8293,8 @@ async def main():
                 "%s does not support search" % game["name"].replace("\n", " "), log_file
             )
 
-        log_file.close()
+        writer.stop()
+        log_sink.stop()
 
     if sys.argv[1] == "check_overlap":
         f = open("../find-nex-servers/nexwiiu.json")
@@ -5576,6 +8309,7 @@ async def main():
 
     if sys.argv[1] == "datastore_persistence":
         con = sqlite3.connect(DATASTORE_DB, timeout=3600)
+        configure_sqlite(con)
         con.execute(
             """
     CREATE TABLE IF NOT EXISTS datastore_meta (
@@ -5646,6 +8380,8 @@ async def main():
         data_id INTEGER
     )"""
         )
+        create_datastore_url_method(con)
+        create_unique_indexes(con, DATASTORE_UNIQUE_KEYS)
         con.commit()
 
         f = open("../find-nex-servers/nexwiiu.json")
@@ -5656,7 +8392,12 @@ async def main():
             "games"
         ]
 
-        log_file = open(DATASTORE_LOG, "a", encoding="utf-8")
+        log_sink = LogSink(DATASTORE_LOG)
+        log_sink.start()
+        log_file = QueuedLog(log_sink.queue)
+
+        writer = SQLiteWriter(DATASTORE_DB, log_sink.queue)
+        writer.start()
 
         for i, game in enumerate(nex_wiiu_games):
             if i == int(sys.argv[4]):
@@ -5681,14 +8422,10 @@ async def main():
 
                 pretty_game_id = hex(game["aid"])[2:].upper().rjust(16, "0")
 
-                nas = nnas.NNASClient()
-                nas.set_device(DEVICE_ID, SERIAL_NUMBER, SYSTEM_VERSION)
-                nas.set_title(game["aid"], game["av"])
-                nas.set_locale(REGION_ID, COUNTRY_NAME, LANGUAGE)
-
-                access_token = await nas.login(USERNAME, PASSWORD)
-
-                nex_token = await nas.get_nex_token(access_token.token, game["id"])
+                nex_token = await TOKEN_MANAGER.get_nex_token(game)
+                TOKEN_MANAGER.retain(nex_wiiu_games[i : i + 2])
+                if i + 1 < len(nex_wiiu_games):
+                    TOKEN_MANAGER.prefetch_nex_token(nex_wiiu_games[i + 1])
 
                 nex_version = (
                     game["nex"][0][0] * 10000
@@ -5696,26 +8433,6 @@ async def main():
                     + game["nex"][0][2]
                 )
 
-                """
-                # Run everything in processes
-                num_processes = 8
-                range_size = int(pow(2, 32) / num_processes)
-
-                found_queue = Queue()
-                num_tested_queue = Queue()
-
-                processes = [Process(target=range_test_category,
-                    args=(game["key"], nex_version, nex_token.host, nex_token.port, str(nex_token.pid), nex_token.password, i * range_size, i * range_size + 1000, found_queue, num_tested_queue)) for i in range(num_processes)]
-                # Queue for printing number tested and found categories
-                processes.append(Process(target=print_categories, args=(num_processes, found_queue, num_tested_queue)))
-                for p in processes:
-                    p.start()
-                for p in processes:
-                    p.join()
-
-                continue
-                """
-
                 async def does_search_work(client):
                     store = datastore.DataStoreClient(client)
                     return await search_works(store)
@@ -5737,7 +8454,6 @@ async def main():
 
                     num_download_threads = 16
 
-                    log_lock = Lock()
                     pids_queue = Queue()
 
                     pids = (
@@ -5759,13 +8475,16 @@ async def main():
                         if len(pids) == 0:
                             break
 
+                    finish_work(pids_queue)
+
                     processes = []
                     for i in range(num_download_threads):
                         processes.append(
                             Process(
                                 target=get_datastore_metas_pids,
                                 args=(
-                                    log_lock,
+                                    log_sink.queue,
+                                    writer.queue,
                                     game["key"],
                                     nex_version,
                                     nex_token.host,
@@ -5790,10 +8509,11 @@ async def main():
                         log_file,
                     )
 
-        log_file.close()
+        writer.stop()
+        log_sink.stop()
 
 
 if __name__ == "__main__":
     if sys.platform == "linux" or sys.platform == "linux2":
         multiprocessing.set_start_method("spawn")
-    anyio.run(main)
+    anyio.run(run_with_session_pool, lambda: run_with_token_manager(main))